@@ -0,0 +1,74 @@
+"""Soak test for the reply callbacks of ChannelClient.
+
+Sends a large number of requests over a loopback channel that replies to
+most of them immediately and drops the rest, so those have to time out.
+Prints the number of pending callbacks, the size of the expiry heap and the
+process memory while the test runs. All three should stay flat.
+
+Run from the repository root:
+
+    python benchmarks/client_soak.py [--requests 1000000] [--drop 0.01] [--reply-timeout 200]
+"""
+import sys
+import time
+import random
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+import psutil
+from troup.client import ChannelClient
+from troup.messaging import message, serialize
+
+
+class LoopbackChannel:
+
+    def __init__(self, client, drop):
+        self.client = client
+        self.drop = drop
+
+    def send_message(self, msg):
+        if random.random() < self.drop:
+            return
+        reply = message().header('type', 'reply').header('reply-for', msg.id).\
+            value('error', None).value('reply', msg.id).build()
+        self.client._ChannelClient__on_channel_data(serialize(reply), self)
+
+    def close(self):
+        pass
+
+
+def rss_mb():
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='ChannelClient reply callbacks soak test')
+    parser.add_argument('--requests', type=int, default=1000000)
+    parser.add_argument('--drop', type=float, default=0.01, help='Fraction of requests never replied to')
+    parser.add_argument('--reply-timeout', type=int, default=200, help='Reply timeout in milliseconds')
+    parser.add_argument('--report-every', type=int, default=100000)
+    args = parser.parse_args()
+
+    client = ChannelClient(nodes_specs=['loopback:ws://localhost:0'], reply_timeout=args.reply_timeout)
+    client.channels['loopback'] = LoopbackChannel(client, args.drop)
+
+    timeouts = 0
+    promises = []
+
+    print('%10s %10s %10s %10s %10s' % ('requests', 'pending', 'heap', 'rss MB', 'req/s'))
+    start = last = time.perf_counter()
+    for i in range(1, args.requests + 1):
+        msg = message().header('type', 'command').header('command', 'info').build()
+        client.send_message_to_node(msg, 'loopback', None)
+        if i % args.report_every == 0:
+            now = time.perf_counter()
+            print('%10d %10d %10d %10.1f %10.0f' % (i, len(client.callbacks), len(client.callbacks._heap),
+                                                    rss_mb(), args.report_every / (now - last)))
+            last = now
+
+    elapsed = time.perf_counter() - start
+    time.sleep(args.reply_timeout / 1000 * 2)
+    print('done: %d requests in %.1fs (%.0f req/s), pending after timeout: %d, heap: %d' % (
+        args.requests, elapsed, args.requests / elapsed, len(client.callbacks), len(client.callbacks._heap)))
+    client.shutdown()
@@ -0,0 +1,86 @@
+"""Fixed and elastic task runner slots under a mixed load.
+
+Runs --tasks process tasks through a TasksRunner: every --cpu-every-th task
+is CPU bound (a Python loop for about --cpu-seconds), the others sleep for
+--sleep seconds. The fixed variant has --min-processes process slots, the
+elastic variant grows them up to --max-processes from the queue and the
+stats of a StatsTracker. Reports the wall time, the throughput and the peak
+number of slots.
+
+Run from the repository root:
+
+    python benchmarks/elastic_runner.py [--tasks 400] [--sleep 0.2] [--cpu-every 10] [--cpu-seconds 0.3]
+"""
+import sys
+import time
+import threading
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from troup.tasks import TasksRunner, LocalProcessTask
+from troup.process import ProcessSupervisor
+from troup.system import StatsTracker
+
+CPU_SCRIPT = 'import time\nend = time.time() + %s\nwhile time.time() < end:\n    pass\n'
+
+
+def tasks(args):
+    for i in range(args.tasks):
+        if i % args.cpu_every == 0:
+            data = {'executable': sys.executable, 'args': ['-c', CPU_SCRIPT % args.cpu_seconds]}
+            yield LocalProcessTask(process_type='LocalProcess', process_data=data, needs={'cpu': 100})
+        else:
+            data = {'executable': 'sleep', 'args': [str(args.sleep)]}
+            yield LocalProcessTask(process_type='LocalProcess', process_data=data)
+
+
+def run(args, elastic, tracker):
+    supervisor = ProcessSupervisor()
+    if elastic:
+        runner = TasksRunner(supervisor=supervisor, min_processes=args.min_processes,
+                             max_processes=args.max_processes, system_stats=tracker.get_stats,
+                             scale_interval=args.scale_interval)
+    else:
+        runner = TasksRunner(supervisor=supervisor, max_processes=args.min_processes)
+    peak = [0]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(0.01):
+            peak[0] = max(peak[0], runner.backlog()['limits']['process'])
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        start = time.perf_counter()
+        runs = [runner.run(task) for task in tasks(args)]
+        for task_run in runs:
+            task_run.future.result()
+        return time.perf_counter() - start, peak[0]
+    finally:
+        stop.set()
+        sampler.join()
+        runner.shutdown()
+        supervisor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Fixed and elastic runner slots')
+    parser.add_argument('--tasks', type=int, default=400)
+    parser.add_argument('--sleep', type=float, default=0.2)
+    parser.add_argument('--cpu-every', type=int, default=10, help='Every n-th task is CPU bound')
+    parser.add_argument('--cpu-seconds', type=float, default=0.3)
+    parser.add_argument('--min-processes', type=int, default=3)
+    parser.add_argument('--max-processes', type=int, default=64)
+    parser.add_argument('--scale-interval', type=int, default=100, help='Milliseconds between scaling checks')
+    args = parser.parse_args()
+
+    tracker = StatsTracker(period=100)
+    try:
+        print('%-10s %10s %10s %10s' % ('variant', 'seconds', 'tasks/s', 'peak slots'))
+        for label, elastic in (('fixed', False), ('elastic', True)):
+            elapsed, peak = run(args, elastic, tracker)
+            print('%-10s %10.2f %10.1f %10d' % (label, elapsed, args.tasks / elapsed, peak))
+    finally:
+        tracker.stop_tracking()
@@ -0,0 +1,71 @@
+"""Compares the JSON and binary message codecs.
+
+Reports encode/decode throughput and the size of the encoded message for a
+small command reply and for a sync message carrying many known nodes.
+
+Run from the repository root:
+
+    python benchmarks/messaging_codec.py [--nodes 200] [--iterations 2000]
+"""
+import sys
+import time
+import json
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from troup.messaging import message, deserialize, json_codec, binary_codec
+
+
+def load_nodes(path, count):
+    with open(path) as f:
+        templates = [node for name, node in json.loads(f.read()).items()]
+    nodes = []
+    for i in range(count):
+        node = dict(templates[i % len(templates)])
+        node['name'] = 'node-%d' % i
+        node['endpoint'] = 'ws://10.0.%d.%d:7000' % (i // 256, i % 256)
+        nodes.append(node)
+    return nodes
+
+
+def reply_message():
+    return message().header('reply-for', 'f3a4b17e-8a9c-4a0e-b7a1-1c2d3e4f5a6b').\
+        header('type', 'reply').value('error', None).\
+        value('reply', 'a5e1c1c2-55d6-4bd7-8d2e-9f0a1b2c3d4e').build()
+
+
+def sync_message(nodes):
+    return message().value('node', nodes[0]).value('known_nodes', nodes[1:]).\
+        header('type', 'sync-message').build()
+
+
+def bench(name, codec, msg, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        encoded = codec.encode(msg)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        deserialize(encoded)
+    decode_time = time.perf_counter() - start
+
+    print('%-8s %-7s %10d B %12.0f enc/s %12.0f dec/s' % (
+        name, codec.name, len(encoded), iterations / encode_time, iterations / decode_time))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Message codec benchmark')
+    parser.add_argument('--nodes', type=int, default=200, help='Known nodes in the sync message')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--nodes-file', default='tests/resources/node/rank_nodes.nodes_info.json')
+    args = parser.parse_args()
+
+    nodes = load_nodes(args.nodes_file, args.nodes)
+
+    print('%-8s %-7s %12s %16s %16s' % ('message', 'codec', 'size', 'encode', 'decode'))
+    for codec in [json_codec, binary_codec]:
+        bench('reply', codec, reply_message(), args.iterations * 50)
+    for codec in [json_codec, binary_codec]:
+        bench('sync', codec, sync_message(nodes), args.iterations)
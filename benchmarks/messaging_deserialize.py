@@ -0,0 +1,84 @@
+"""Measures decoding of a realistic sync message.
+
+Compares the compiled schema constructors used by ``node_info_from_dict``
+against the previous reflective ``hasattr``/``setattr`` implementation.
+
+Run from the repository root:
+
+    python benchmarks/messaging_deserialize.py [--nodes 300] [--iterations 200]
+"""
+import sys
+import time
+import json
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from troup.messaging import message, serialize, deserialize
+from troup.node import node_info_from_dict, NodeInfo
+from troup.system import SystemStats
+from troup.apps import App
+
+
+def reflective_deserialize_dict(dval, as_type):
+    val = as_type()
+    for name, value in dval.items():
+        if hasattr(val, name):
+            setattr(val, name, value)
+    return val
+
+
+def reflective_node_info_from_dict(node_dict):
+    apps = [reflective_deserialize_dict(dapp, App) for dapp in node_dict.get('apps') or []]
+    stats = reflective_deserialize_dict(node_dict.get('stats') or {}, SystemStats)
+    node = reflective_deserialize_dict(node_dict, NodeInfo)
+    node.apps = apps
+    node.stats = stats
+    return node
+
+
+def sync_message(path, count):
+    with open(path) as f:
+        templates = [node for name, node in json.loads(f.read()).items()]
+    nodes = []
+    for i in range(count):
+        node = dict(templates[i % len(templates)])
+        node['name'] = 'node-%d' % i
+        node['endpoint'] = 'ws://10.0.%d.%d:7000' % (i // 256, i % 256)
+        nodes.append(node)
+    return serialize(message().value('node', nodes[0]).value('known_nodes', nodes[1:]).
+                     header('type', 'sync-message').build())
+
+
+def nodes_from_message(msg, from_dict):
+    nodes = [from_dict(msg.data['node'])]
+    return nodes + [from_dict(node) for node in msg.data['known_nodes']]
+
+
+def bench(name, smsg, from_dict, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        nodes_from_message(deserialize(smsg), from_dict)
+    total = time.perf_counter() - start
+
+    msg = deserialize(smsg)
+    start = time.perf_counter()
+    for i in range(iterations):
+        nodes_from_message(msg, from_dict)
+    nodes_only = time.perf_counter() - start
+
+    print('%-12s %10.3f ms/message %10.3f ms/message (nodes only)' % (
+        name, total * 1000 / iterations, nodes_only * 1000 / iterations))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Sync message deserialization benchmark')
+    parser.add_argument('--nodes', type=int, default=300, help='Known nodes in the sync message')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--nodes-file', default='tests/resources/node/rank_nodes.nodes_info.json')
+    args = parser.parse_args()
+
+    smsg = sync_message(args.nodes_file, args.nodes)
+    print('sync-message with %d nodes, %d bytes' % (args.nodes, len(smsg)))
+    bench('reflective', smsg, reflective_node_info_from_dict, args.iterations)
+    bench('compiled', smsg, node_info_from_dict, args.iterations)
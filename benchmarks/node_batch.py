@@ -0,0 +1,50 @@
+"""Throughput of commands sent to a node with and without batching.
+
+Starts a single local node and sends it a number of commands from a
+ChannelClient that coalesces them into batches of the given sizes. Batch size
+1 sends every command in its own frame (the requests are still pipelined).
+
+Run from the repository root:
+
+    python benchmarks/node_batch.py [--requests 20000] [--batch-sizes 1,16,256] [--command info]
+"""
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from troup.client import ChannelClient, CommandAPI
+from troup.testtools import LocalCluster
+
+
+def run(endpoint, requests, batch_size, command, window):
+    client = ChannelClient(nodes_specs=['node:%s' % endpoint], reply_timeout=60000,
+                           batch_size=batch_size, batch_window=window)
+    try:
+        # open the channel before measuring
+        client.send_message_to_node(CommandAPI.command(command, None), 'node', None).result
+        start = time.perf_counter()
+        promises = [client.send_message_to_node(CommandAPI.command(command, None), 'node', None)
+                    for i in range(requests)]
+        for promise in promises:
+            promise.result
+        return time.perf_counter() - start
+    finally:
+        client.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Batched commands throughput')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--batch-sizes', default='1,16,256')
+    parser.add_argument('--batch-window', type=int, default=5, help='Batch window in milliseconds')
+    parser.add_argument('--command', default='info')
+    args = parser.parse_args()
+
+    with LocalCluster(1, config={'membership': {'probe_interval': 60000}}) as cluster:
+        endpoint = cluster[0].aio_server.get_server_endpoint()
+        print('%10s %10s %10s' % ('batch', 'seconds', 'req/s'))
+        for size in [int(s) for s in args.batch_sizes.split(',')]:
+            elapsed = run(endpoint, args.requests, size, args.command, args.batch_window)
+            print('%10d %10.2f %10.0f' % (size, elapsed, args.requests / elapsed))
@@ -0,0 +1,89 @@
+"""Ranking of a large number of nodes for an app.
+
+Builds synthetic nodes from tests/resources/node/rank_nodes.nodes_info.json
+(with randomized stats) and compares the time to pick the best nodes for an
+app with the previous implementation (score dicts built per node and a full
+sort on every call) and with NodeStatsTable, with NumPy (if installed) and
+with plain lists.
+
+Run from the repository root:
+
+    python benchmarks/node_ranking.py [--nodes 10000] [--top 3] [--repeat 50]
+"""
+import sys
+import json
+import time
+import random
+from copy import deepcopy
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from troup.node import node_info_from_dict
+from troup.ranking import NodeStatsTable, numpy
+
+
+def legacy_rank(app_needs, nodes_info):
+    m = max([v for k, v in app_needs.items()])
+    W = {}
+    for k, v in app_needs.items():
+        W[k] = v/m
+
+    def score(stats):
+        cpu = stats.cpu['bogomips']['total'] * (1 - stats.cpu['usage'])
+        return cpu * W['cpu'] + stats.memory['available'] * W['memory'] - stats.disk['ioload'] * W['disk']
+
+    return sorted([{'score': score(node_info.stats), 'stats': node_info.stats, 'node': node_info.name}
+                   for node_info in nodes_info], key=lambda x: x['score'], reverse=True)
+
+
+def synthetic_nodes(count):
+    with open('tests/resources/node/rank_nodes.nodes_info.json') as f:
+        templates = list(json.load(f).values())
+    rnd = random.Random(count)
+    nodes = []
+    for i in range(count):
+        node = deepcopy(templates[i % len(templates)])
+        node['name'] = 'node-%d' % i
+        node['stats']['cpu']['bogomips']['total'] = rnd.randint(1000, 8000)
+        node['stats']['cpu']['usage'] = rnd.random()
+        node['stats']['memory']['available'] = rnd.randint(0, 16384)
+        node['stats']['disk']['ioload'] = rnd.random() * 100
+        nodes.append(node_info_from_dict(node))
+    return nodes
+
+
+def measure(rank, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = rank()
+    return (time.perf_counter() - start) / repeat, result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Node ranking benchmark')
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--top', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    needs = {'cpu': 500, 'memory': 128, 'disk': 10, 'network': 0.05}
+    nodes = synthetic_nodes(args.nodes)
+    names = [node.name for node in nodes]
+
+    elapsed, expected = measure(lambda: legacy_rank(needs, nodes), args.repeat)
+    expected = [r['node'] for r in expected[:args.top]]
+    print('%-24s %10.3f ms' % ('legacy (full sort)', elapsed * 1000))
+
+    variants = [('lists', False)]
+    if numpy is not None:
+        variants.append(('numpy', True))
+    for label, use_numpy in variants:
+        table = NodeStatsTable(use_numpy=use_numpy)
+        for node in nodes:
+            table.update_node(node)
+        elapsed, ranked = measure(lambda: table.rank(needs, names=names, k=args.top), args.repeat)
+        assert [name for name, score in ranked] == expected, (ranked, expected)
+        print('%-24s %10.3f ms' % ('table, %s' % label, elapsed * 1000))
+        elapsed, ranked = measure(lambda: table.rank(needs, k=args.top), args.repeat)
+        print('%-24s %10.3f ms' % ('table, %s, all nodes' % label, elapsed * 1000))
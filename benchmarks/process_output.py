@@ -0,0 +1,102 @@
+"""Capturing the output of a chatty process.
+
+A child process writes --size MB of text (80 character lines). The output is
+captured keeping the last --buffer-size bytes with:
+
+ * lines: the previous LocalProcessTask capture - readline() into a deque
+   capped at --buffer-lines lines, joined with reduce() at the end;
+ * trim: a bytearray trimmed from the front after every chunk;
+ * ring: ByteRingBuffer;
+ * supervisor: the whole ProcessSupervisor path (ByteRingBuffer per stream).
+
+Run from the repository root:
+
+    python benchmarks/process_output.py [--size 1024] [--buffer-size 1048576] [--buffer-lines 10000]
+"""
+import os
+import sys
+import time
+from functools import reduce
+from collections import deque
+from subprocess import Popen, PIPE
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from troup.process import ByteRingBuffer, ProcessSupervisor
+
+CHUNK = 256 * 1024
+
+
+def command(size_mb):
+    return ['sh', '-c', 'yes "%s" | head -c %d' % ('x' * 79, size_mb * 1024 * 1024)]
+
+
+class TrimBuffer:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) > self.capacity:
+            del self.buffer[:len(self.buffer) - self.capacity]
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+
+def capture_lines(args):
+    process = Popen(command(args.size), stdout=PIPE)
+    lines = deque(maxlen=args.buffer_lines)
+    while True:
+        line = process.stdout.readline()
+        if not line:
+            break
+        lines.appendleft(line)
+    process.wait()
+    return len(reduce(lambda a, b: a + str(b, 'utf-8'), lines, ''))
+
+
+def capture_chunks(buffer, args):
+    process = Popen(command(args.size), stdout=PIPE)
+    fd = process.stdout.fileno()
+    while True:
+        chunk = os.read(fd, CHUNK)
+        if not chunk:
+            break
+        buffer.write(chunk)
+    process.wait()
+    return len(buffer.getvalue().decode('utf-8', 'replace'))
+
+
+def capture_supervised(args):
+    supervisor = ProcessSupervisor()
+    try:
+        process = supervisor.spawn(command(args.size), buffer_size=args.buffer_size)
+        process.wait()
+        return len(process.output['stdout'].decode())
+    finally:
+        supervisor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Process output capture')
+    parser.add_argument('--size', type=int, default=1024, help='Output size in MB')
+    parser.add_argument('--buffer-size', type=int, default=1024 * 1024, help='Bytes kept')
+    parser.add_argument('--buffer-lines', type=int, default=10000, help='Lines kept by the lines variant')
+    args = parser.parse_args()
+
+    variants = [
+        ('lines', lambda: capture_lines(args)),
+        ('trim', lambda: capture_chunks(TrimBuffer(args.buffer_size), args)),
+        ('ring', lambda: capture_chunks(ByteRingBuffer(args.buffer_size), args)),
+        ('supervisor', lambda: capture_supervised(args)),
+    ]
+    print('%-12s %10s %10s %12s' % ('variant', 'seconds', 'MB/s', 'kept chars'))
+    for label, capture in variants:
+        start = time.perf_counter()
+        kept = capture()
+        elapsed = time.perf_counter() - start
+        print('%-12s %10.2f %10.0f %12d' % (label, elapsed, args.size / elapsed, kept))
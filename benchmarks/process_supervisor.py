@@ -0,0 +1,80 @@
+"""Running many child processes at once, with threads and with the supervisor.
+
+Starts a number of processes that each write some output and sleep, and
+reports the wall time and the peak number of threads of this process. The
+thread variant is the previous LocalProcessTask: a thread waiting on the
+process and two threads reading its stdout and stderr line by line. The
+supervisor variant runs all the processes with ProcessSupervisor.
+
+Run from the repository root:
+
+    python benchmarks/process_supervisor.py [--processes 300] [--sleep 1] [--output-kb 64]
+"""
+import sys
+import time
+import threading
+from subprocess import Popen, PIPE
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from troup.process import ProcessSupervisor
+
+
+def script(sleep, output_kb):
+    return 'head -c %d /dev/zero | tr "\\0" "x" | fold -w 80; sleep %s' % (output_kb * 1024, sleep)
+
+
+def with_threads(count, command):
+    peak = [threading.active_count()]
+    lock = threading.Lock()
+
+    def consume(stream):
+        while stream.readline():
+            pass
+
+    def run():
+        process = Popen(['sh', '-c', command], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        readers = [threading.Thread(target=consume, args=(process.stdout,)),
+                   threading.Thread(target=consume, args=(process.stderr,))]
+        for reader in readers:
+            reader.start()
+        with lock:
+            peak[0] = max(peak[0], threading.active_count())
+        process.wait()
+        for reader in readers:
+            reader.join()
+
+    waiters = [threading.Thread(target=run) for i in range(count)]
+    for waiter in waiters:
+        waiter.start()
+    for waiter in waiters:
+        waiter.join()
+    return peak[0]
+
+
+def with_supervisor(count, command):
+    supervisor = ProcessSupervisor()
+    try:
+        processes = [supervisor.spawn(['sh', '-c', command], buffer_size=64 * 1024) for i in range(count)]
+        peak = threading.active_count()
+        for process in processes:
+            process.wait()
+        return peak
+    finally:
+        supervisor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Concurrent child processes')
+    parser.add_argument('--processes', type=int, default=300)
+    parser.add_argument('--sleep', default='1')
+    parser.add_argument('--output-kb', type=int, default=64)
+    args = parser.parse_args()
+
+    command = script(args.sleep, args.output_kb)
+    print('%-12s %10s %10s' % ('variant', 'seconds', 'threads'))
+    for label, run in (('threads', with_threads), ('supervisor', with_supervisor)):
+        start = time.perf_counter()
+        peak = run(args.processes, command)
+        print('%-12s %10.2f %10d' % (label, time.perf_counter() - start, peak))
@@ -62,6 +62,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'ranking': ['numpy'],
     },
 
     # If there are data files included in your packages that need to be
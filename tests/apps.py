@@ -0,0 +1,53 @@
+import unittest
+import sys
+
+sys.path.append('..')
+
+from troup.apps import App, AppsIndex
+
+
+def app(name, command=None):
+    return App(name=name, command=command or 'run %s' % name, needs={'cpu': 1})
+
+
+class AppsIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = AppsIndex(local_node='local')
+
+    def test_update_and_remove_node(self):
+        self.index.update_node('n1', [app('a'), app('b')])
+        self.index.update_node('n2', [app('b')])
+        assert self.index.get('a')['nodes'] == ['n1']
+        assert self.index.get('b')['nodes'] == ['n1', 'n2']
+
+        self.index.update_node('n1', [app('a')])
+        assert self.index.get('b')['nodes'] == ['n2']
+
+        self.index.remove_node('n2')
+        assert self.index.get('b') is None
+        assert set(self.index.snapshot()['apps']) == {'a'}
+
+    def test_snapshot_versioned(self):
+        self.index.update_node('n1', [app('a')])
+        snapshot = self.index.snapshot()
+        assert self.index.snapshot() is snapshot
+
+        # the same apps again - no change
+        assert not self.index.update_node('n1', [app('a')])
+        assert self.index.snapshot() is snapshot
+
+        assert self.index.update_node('n1', [app('a', command='run a --fast')])
+        changed = self.index.snapshot()
+        assert changed['version'] > snapshot['version']
+        assert changed['apps']['a']['command'] == 'run a --fast'
+
+    def test_local_definition_preferred(self):
+        self.index.update_node('n1', [app('a', command='remote')])
+        self.index.update_node('local', [app('a', command='local')])
+        assert self.index.get('a')['command'] == 'local'
+        assert self.index.get('a')['nodes'] == ['n1', 'local']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import unittest
+import sys
+
+sys.path.append('..')
+
+import time
+import asyncio
+from threading import Thread
+from troup.client import ChannelClient, AsyncChannelClient, AsyncCommandAPI, CommandAPI, MessageBatcher
+from troup.testtools import LocalCluster
+from troup.messaging import message, serialize
+from troup.distributed import DistributedException
+
+
+class RecordingChannel:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+    def close(self):
+        pass
+
+
+class ChannelClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ChannelClient(nodes_specs=['node:ws://localhost:0'], reply_timeout=100)
+        self.channel = RecordingChannel()
+        self.client.channels['node'] = self.channel
+
+    def tearDown(self):
+        self.client.shutdown()
+
+    def reply(self, msg, reply):
+        reply_msg = message().header('type', 'reply').header('reply-for', msg.id).\
+            value('error', None).value('reply', reply).build()
+        self.client._ChannelClient__on_channel_data(serialize(reply_msg), self.channel)
+
+    def test_reply_removes_callback(self):
+        msg = message().header('type', 'command').build()
+        promise = self.client.send_message_to_node(msg, 'node', None)
+        assert len(self.client.callbacks) == 1
+        self.reply(msg, 'done')
+        assert promise.result == 'done'
+        assert len(self.client.callbacks) == 0
+
+    def test_reply_timeout(self):
+        msg = message().header('type', 'command').build()
+        start = time.monotonic()
+        promise = self.client.send_message_to_node(msg, 'node', None)
+        with self.assertRaises(DistributedException):
+            promise.result
+        assert 0.09 <= time.monotonic() - start < 0.2
+        assert len(self.client.callbacks) == 0
+
+
+class MessageBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = RecordingChannel()
+
+    def test_flush_on_size(self):
+        batcher = MessageBatcher(self.channel, max_size=3, window=10000)
+        for i in range(7):
+            batcher.send_message(CommandAPI.command('info', i))
+        assert len(self.channel.sent) == 2
+        assert [len(b.data['messages']) for b in self.channel.sent] == [3, 3]
+        batcher.flush()
+        assert len(self.channel.sent) == 3
+        assert self.channel.sent[2].headers['type'] == 'command'
+
+    def test_flush_on_window(self):
+        batcher = MessageBatcher(self.channel, max_size=100, window=50)
+        batcher.send_message(CommandAPI.command('info', 1))
+        batcher.send_message(CommandAPI.command('info', 2))
+        assert not self.channel.sent
+        time.sleep(0.2)
+        assert len(self.channel.sent) == 1
+        assert self.channel.sent[0].headers['type'] == 'batch'
+
+
+class BatchCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = LocalCluster(1).start()
+        endpoint = self.cluster[0].aio_server.get_server_endpoint()
+        self.client = ChannelClient(nodes_specs=['node:%s' % endpoint], batch_size=16, batch_window=20)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.cluster.stop()
+
+    def test_batched_commands(self):
+        promises = [self.client.send_message_to_node(CommandAPI.command('info', None), 'node', None)
+                    for i in range(40)]
+        unknown = self.client.send_message_to_node(CommandAPI.command('no-such-command', None), 'node', None)
+        for promise in promises:
+            assert promise.result['name'] == 'node-0'
+        with self.assertRaises(DistributedException):
+            unknown.result
+
+    def test_explicit_batch(self):
+        api = CommandAPI(ChannelClient(nodes_specs=['node:%s' % self.client.nodes_ref['node']]))
+        try:
+            replies = api.send(CommandAPI.batch([CommandAPI.command('info', None),
+                                                 CommandAPI.command('no-such-command', None)]),
+                               to_node='node').result
+        finally:
+            api.shutdown()
+        assert len(replies) == 2
+        assert replies[0]['reply']['name'] == 'node-0'
+        assert replies[1]['error']
+
+
+class EchoChannel:
+    """Replies to every message from a separate thread, like a ws4py socket."""
+
+    opened = 0
+
+    def __init__(self, delay=0):
+        self.listeners = []
+        self.delay = delay
+
+    def register_listener(self, listener):
+        self.listeners.append(listener)
+
+    def open(self):
+        time.sleep(0.05)
+        EchoChannel.opened += 1
+
+    def send_message(self, msg):
+        if self.delay is None:
+            return
+
+        def reply():
+            time.sleep(self.delay)
+            reply_msg = message().header('type', 'reply').header('reply-for', msg.id).\
+                value('error', None).value('reply', msg.data).build()
+            for listener in self.listeners:
+                listener(serialize(reply_msg))
+        Thread(target=reply).start()
+
+    def close(self):
+        pass
+
+
+class AsyncChannelClientTest(unittest.TestCase):
+
+    def setUp(self):
+        EchoChannel.opened = 0
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncChannelClient(nodes_specs=['node:ws://localhost:0'], reply_timeout=1000, loop=self.loop)
+        self.client.create_channel = self.create_channel
+        self.delay = 0
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.loop.close()
+
+    def create_channel(self, name, ref):
+        channel = EchoChannel(self.delay)
+        channel.register_listener(lambda data: self.loop.call_soon_threadsafe(
+            self.client._AsyncChannelClient__on_channel_data, name, data))
+        return channel
+
+    def test_concurrent_commands_over_one_channel(self):
+        api = AsyncCommandAPI(self.client)
+
+        async def send_all():
+            return await asyncio.gather(*[api.command('echo', i, to_node='node') for i in range(1000)])
+
+        results = self.loop.run_until_complete(send_all())
+        assert results == list(range(1000))
+        assert EchoChannel.opened == 1
+        assert len(self.client.pending) == 0
+
+    def test_reply_timeout(self):
+        self.delay = None
+        self.client.reply_timeout = 100
+        with self.assertRaises(DistributedException):
+            self.loop.run_until_complete(self.client.send(CommandAPI.command('echo', 1), to_node='node'))
+        assert len(self.client.pending) == 0
+
+    def test_send_to_all_nodes(self):
+        self.client.nodes_ref['other'] = 'ws://localhost:0'
+        api = AsyncCommandAPI(self.client)
+
+        result = self.loop.run_until_complete(api.command('echo', 'hello'))
+        assert result is True
+        assert EchoChannel.opened == 2
+        assert len(self.client.pending) == 0
+
+    def test_command_api_from_thread(self):
+        api = CommandAPI(self.client.run_in_thread())
+        promise = api.send(CommandAPI.command('echo', 'hello'), to_node='node')
+        assert promise.result == 'hello'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import sys
+
+sys.path.append('..')
+
+import asyncio
+from threading import Thread
+from troup.infrastructure import IncommingChannel, AsyncIOWebSocketServer, OutgoingChannelOverWS
+from troup.messaging import message, deserialize, binary_codec, json_codec
+from troup.testtools import free_ports, wait_for
+
+
+class RecordingAdapter:
+
+    def __init__(self, loop):
+        self.server = self
+        self.aio_loop = loop
+        self.writes = []
+
+    def send_frames(self, frames):
+        self.writes.append(list(frames))
+
+
+class IncommingChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever)
+        self.loop_thread.start()
+        self.adapter = RecordingAdapter(self.loop)
+        self.channel = IncommingChannel('test', 'peer', adapter=self.adapter)
+        self.channel.open()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    def sync(self):
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.01), self.loop).result()
+
+    def test_send_from_threads(self):
+        def send(n):
+            for i in range(500):
+                self.channel.send('%d-%d' % (n, i))
+
+        threads = [Thread(target=send, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.sync()
+
+        frames = [data.decode() for write in self.adapter.writes for data, binary in write]
+        assert len(frames) == 2000
+        for n in range(4):
+            assert [f for f in frames if f.startswith('%d-' % n)] == ['%d-%d' % (n, i) for i in range(500)]
+        stats = self.channel.stats()
+        assert stats['queue_depth'] == 0
+        assert stats['queued_bytes'] == 0
+        assert stats['frames_sent'] == 2000
+        assert stats['bytes_sent'] == sum(len(f) for f in frames)
+        assert stats['drains'] == len(self.adapter.writes)
+
+    def test_frames_coalesced(self):
+        self.loop.call_soon_threadsafe(lambda: [self.channel.send(b'x' * 10) for i in range(100)])
+        self.sync()
+        assert len(self.adapter.writes) == 1
+        assert all(binary for data, binary in self.adapter.writes[0])
+        assert self.channel.stats()['max_queue_depth'] == 100
+
+
+class CodecHandshakeTest(unittest.TestCase):
+
+    def start_server(self, codecs=None):
+        port = free_ports(1)[0]
+        self.server = AsyncIOWebSocketServer(host='127.0.0.1', port=port, codecs=codecs)
+        self.server_frames = []
+        self.server_channels = []
+
+        def on_event(event, channel):
+            if event == 'channel.open':
+                self.server_channels.append(channel)
+                channel.register_listener(lambda data: self.server_frames.append(data))
+
+        self.server.on_event(on_event)
+        server_thread = Thread(target=self.server.start)
+        server_thread.start()
+        self.addCleanup(server_thread.join)
+        self.addCleanup(self.server.stop)
+        assert wait_for(lambda: self.server.server_address, timeout=5)
+        return 'ws://127.0.0.1:%d' % port
+
+    def connect(self, url):
+        self.client = OutgoingChannelOverWS(name='client', to_url=url)
+        self.client_frames = []
+        self.client.register_listener(lambda data: self.client_frames.append(data))
+        # sent before the channel opens and right after it, before any accept
+        self.client.send_message(message('early').build())
+        self.client.open()
+        self.client.send_message(message('opened').build())
+        self.addCleanup(self.client.close)
+        assert wait_for(lambda: self.server_channels, timeout=5)
+        return self.server_channels[0]
+
+    def test_binary_negotiated(self):
+        server_channel = self.connect(self.start_server())
+        assert wait_for(lambda: self.client.codec is binary_codec, timeout=5)
+        assert server_channel.codec is binary_codec
+        self.client.send_message(message('late').build())
+        server_channel.send_message(message('reply').build())
+        assert wait_for(lambda: len(self.server_frames) == 3 and self.client_frames, timeout=5)
+
+        # the frame sent before the accept arrived is JSON, the one after is binary
+        early, opened, late = self.server_frames
+        assert isinstance(early, str) and not isinstance(late, str)
+        assert [deserialize(frame).id for frame in self.server_frames] == ['early', 'opened', 'late']
+        assert not isinstance(self.client_frames[0], str)
+        assert deserialize(self.client_frames[0]).id == 'reply'
+
+    def test_fallback_to_json(self):
+        # the peer has no binary codec
+        server_channel = self.connect(self.start_server(codecs=[json_codec.name]))
+        assert wait_for(lambda: not self.client._awaiting_codec, timeout=5)
+        assert self.client.codec is json_codec
+        assert server_channel.codec is json_codec
+        self.client.send_message(message('late').build())
+        server_channel.send_message(message('reply').build())
+        assert wait_for(lambda: len(self.server_frames) == 3 and self.client_frames, timeout=5)
+
+        assert all(isinstance(frame, str) for frame in self.server_frames + self.client_frames)
+        assert [deserialize(frame).id for frame in self.server_frames] == ['early', 'opened', 'late']
+        assert deserialize(self.client_frames[0]).id == 'reply'
+
+
+if __name__ == '__main__':
+    unittest.main()
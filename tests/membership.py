@@ -0,0 +1,54 @@
+import unittest
+import sys
+
+sys.path.append('..')
+
+from troup.testtools import LocalCluster, wait_for
+from troup.membership import FailureDetector
+
+
+class FailureDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = LocalCluster(4, config={
+            'sync': {'interval': 200},
+            'membership': {'probe_interval': 100, 'ack_timeout': 40, 'fan_out': 2, 'suspect_timeout': 400}
+        }).start()
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def test_hung_node_removed(self):
+        hung = self.cluster[3]
+        # the node stays connected but stops answering probes and gossiping
+        hung.failure_detector.stop()
+        hung.sync_manager.stop()
+
+        def hung_node_removed():
+            return all(hung.node_id not in node.sync_manager.known_nodes for node in self.cluster.nodes[:3])
+
+        assert wait_for(hung_node_removed, timeout=10)
+
+        for node in self.cluster.nodes[:3]:
+            assert len(node.sync_manager.known_nodes) == 2, node.sync_manager.known_nodes
+
+    def test_messages_from_the_bus(self):
+        node = self.cluster[0]
+        detector = node.failure_detector
+        # the detector does not decode the raw channel frames itself
+        assert detector._on_message_ not in node.channel_manager.listeners.get('channel.data', [])
+        for msg_type in FailureDetector.MESSAGE_TYPES:
+            assert detector._on_message_ in node.bus.subscribers[msg_type]
+        detector.stop()
+        assert not any(detector._on_message_ in node.bus.subscribers.get(msg_type, [])
+                       for msg_type in FailureDetector.MESSAGE_TYPES)
+
+    def test_no_false_positives(self):
+        wait_for(lambda: False, timeout=1.5)
+        for node in self.cluster.nodes:
+            assert len(node.sync_manager.known_nodes) == 3
+            assert not node.failure_detector.suspects
+
+
+if __name__ == '__main__':
+    unittest.main()
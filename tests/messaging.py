@@ -0,0 +1,99 @@
+import unittest
+import sys
+
+sys.path.append('..')
+
+from troup.messaging import message, serialize, deserialize, deserialize_dict, binary_codec, json_codec, \
+    negotiate_codec, CodecError, Message, schemas
+from troup.apps import App
+
+
+class BinaryCodecTest(unittest.TestCase):
+
+    def test_encode_decode(self):
+        msg = message().header('type', 'command').header('command', 'apps').\
+            value('int', 42).value('big', 2**70).value('negative', -2**40).\
+            value('float', 0.25).value('flag', True).value('none', None).\
+            value('text', 'ascii and ютф-8').value('long-text', 'x' * 1000).\
+            value('list', [1, 'two', [3.0]]).value('nested', {'a': {'b': False}}).build()
+
+        encoded = binary_codec.encode(msg)
+        assert isinstance(encoded, bytes)
+
+        decoded = deserialize(encoded)
+        assert decoded.id == msg.id
+        assert decoded.headers == msg.headers
+        assert decoded.data == msg.data
+
+    def test_objects_encoded_as_dict(self):
+        app = App(name='app', command='run', needs={'cpu': 1, 'memory': 2, 'network': 0, 'disk': 0})
+        msg = message().value('apps', [app]).build()
+
+        decoded = deserialize(binary_codec.encode(msg))
+        assert decoded.data['apps'] == [app.__dict__]
+        assert decoded.data == deserialize(serialize(msg)).data
+
+    def test_invalid_frame(self):
+        with self.assertRaises(CodecError):
+            deserialize(b'{"id": 1}')
+        encoded = binary_codec.encode(message().value('text', 'some text').build())
+        with self.assertRaises(CodecError):
+            deserialize(encoded[:-3])
+
+
+class NegotiateCodecTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        assert negotiate_codec(['binary', 'json']) is binary_codec
+        assert negotiate_codec(['binary', 'json'], ['json']) is json_codec
+        assert negotiate_codec(['unknown']) is json_codec
+        assert negotiate_codec(None) is json_codec
+
+
+class SchemaTest(unittest.TestCase):
+
+    def test_deserialize_dict(self):
+        app = deserialize_dict({'name': 'app', 'command': 'run', 'unknown': 1}, App)
+        assert isinstance(app, App)
+        assert app.name == 'app'
+        assert app.command == 'run'
+        assert app.params == {}
+        assert not hasattr(app, 'unknown')
+
+    def test_mutable_defaults_not_shared(self):
+        first = deserialize_dict({}, App)
+        second = deserialize_dict({}, App)
+        first.params['p'] = 'v'
+        assert second.params == {}
+
+    def test_strict(self):
+        with self.assertRaises(Exception):
+            deserialize_dict({'name': 'app', 'unknown': 1}, App, strict=True)
+        with self.assertRaises(Exception):
+            deserialize('{"id": "1", "extra": true}', strict=True)
+        msg = deserialize('{"id": "1", "headers": {"type": "reply"}}', strict=True)
+        assert msg.headers == {'type': 'reply'}
+
+    def test_init_not_called(self):
+        class Counted:
+            created = []
+
+            def __init__(self):
+                Counted.created.append(self)
+                self.name = None
+                self.tags = {'a', 'b'}
+
+        schema = schemas.schema(Counted)
+        first = schema.construct({'name': 'first'})
+        second = schema.construct({})
+        assert len(Counted.created) == 1
+        assert first.name == 'first' and first.tags == {'a', 'b'}
+        assert first.tags is not second.tags
+
+    def test_schema_cached(self):
+        assert schemas.schema(App) is schemas.schema(App)
+        assert schemas.schema(App) is not schemas.schema(App, strict=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
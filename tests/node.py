@@ -1,6 +1,8 @@
 import unittest
 from unittest.mock import Mock, MagicMock, patch
 import sys
+import time
+import threading
 
 sys.path.append('..')
 
@@ -25,12 +27,17 @@ class AppsRankingTest(unittest.TestCase):
 
         ranked = Node._rank_nodes(app_needs, known_nodes)
         print(ranked)
+        scores = [r['score'] for r in ranked]
+        assert scores == sorted(scores, reverse=True)
+        assert ranked[0]['node'] == 'n2'
+        assert [r['node'] for r in Node._rank_nodes(app_needs, known_nodes, k=2)] == [r['node'] for r in ranked[:2]]
 
 
 
 from troup.node import Node, node_info_from_dict
-from troup.apps import App
+from troup.apps import App, AppsIndex
 from troup.system import SystemStats
+from troup.ranking import NodeStatsTable, ReservationLedger
 
 class RunAppTest(unittest.TestCase):
 
@@ -68,14 +75,361 @@ class RunAppTest(unittest.TestCase):
             known_nodes[node_id] = node_info_from_dict(node_dict)
 
         m_sync_manager.known_nodes = known_nodes
+        m_sync_manager.node_stats = NodeStatsTable()
+        m_sync_manager.apps_index = AppsIndex(local_node='test-node')
+        m_sync_manager.reservations = ReservationLedger(m_sync_manager.node_stats, local_node='test-node')
+        for node_info in known_nodes.values():
+            m_sync_manager.node_stats.update_node(node_info)
+            m_sync_manager.apps_index.update_node(node_info.name, node_info.apps)
 
         m_stats_tracker.get_stats.configure_mock(return_value=SystemStats())
 
         try:
-            node = Node(node_id='test-node', config={}, store=m_store, channel_manager=m_channel_manager,
+            node = Node(node_id='test-node', config={'remote': {'launch': 'ssh'}}, store=m_store, channel_manager=m_channel_manager,
                         aio_server=m_aio_server, stats_tracker=m_stats_tracker, sync_manager=m_sync_manager,
                         tasks_runner=m_tasks_runner)
             node.start()
             node.run_app('test-app')
         finally:
             node.stop()
+
+
+from troup.node import SyncManager, NodeInfo
+from troup.messaging import serialize
+
+
+class LoopbackChannel:
+
+    def __init__(self, to_sync_manager):
+        self.to_sync_manager = to_sync_manager
+        self.back = None
+        self.sent = []
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+        self.to_sync_manager._on_message_(serialize(msg), self.back)
+
+
+def loopback_channels(a, b):
+    a_to_b = LoopbackChannel(b)
+    b_to_a = LoopbackChannel(a)
+    a_to_b.back = b_to_a
+    b_to_a.back = a_to_b
+    return a_to_b, b_to_a
+
+
+def sync_manager(name):
+    node = Mock()
+    node.node_id = name
+    node.get_node_info.side_effect = lambda: NodeInfo(name=name, endpoint='ws://%s' % name, apps=[])
+    return SyncManager(node=node, channel_manager=Mock(), event_processor=None)
+
+
+class SyncManagerTest(unittest.TestCase):
+
+    def test_delta_sync(self):
+        a = sync_manager('a')
+        b = sync_manager('b')
+        a.register_node(NodeInfo(name='c', endpoint='ws://c', apps=[], version=5))
+
+        a_to_b, b_to_a = loopback_channels(a, b)
+
+        b._on_message_(serialize(a.get_digest_message()), b_to_a)
+
+        assert set(b.known_nodes.keys()) == {'a', 'c'}
+        assert b.known_nodes['c'].version == 5
+        assert set(a.known_nodes.keys()) == {'b', 'c'}
+
+        # nothing changed - the digest exchange sends no entries
+        b_to_a.sent = []
+        a_to_b.sent = []
+        b._on_message_(serialize(a.get_digest_message()), b_to_a)
+        assert not b_to_a.sent
+        assert not a_to_b.sent
+
+        # only the entry that changed is sent
+        a.version += 1
+        b._on_message_(serialize(a.get_digest_message()), b_to_a)
+        assert not b_to_a.sent[0].data['known_nodes']
+        assert b_to_a.sent[0].data['request'] == ['a']
+        assert [n.name for n in a_to_b.sent[0].data['known_nodes']] == ['a']
+        assert b.known_nodes['a'].version == a.version
+
+    def test_version_follows_changes(self):
+        from troup.system import SystemStats
+        apps = []
+        stats = SystemStats()
+        stats.cpu['bogomips']['total'] = 1000
+        stats.memory['available'] = 1000
+        a = sync_manager('a')
+        a.node.get_node_info.side_effect = lambda: NodeInfo(name='a', endpoint='ws://a', apps=list(apps),
+                                                            stats=stats)
+        a.sync_random_nodes()
+        version = a.version
+
+        # the stats are sampled again, but have not changed enough
+        stats.memory['available'] = 1020
+        a.sync_random_nodes()
+        assert a.version == version
+
+        stats.memory['available'] = 1100
+        a.sync_random_nodes()
+        assert a.version == version + 1
+
+        apps.append(App(name='x'))
+        a.sync_random_nodes()
+        assert a.version == version + 2
+
+        a.reservations.reserve('a', {'cpu': 10})
+        a.sync_random_nodes()
+        a.sync_random_nodes()
+        assert a.version == version + 3
+
+    def test_older_version_ignored(self):
+        a = sync_manager('a')
+        a.register_node(NodeInfo(name='c', endpoint='ws://c', apps=[], version=5))
+        a._merge_nodes_list_([NodeInfo(name='c', endpoint='ws://c-old', apps=[], version=4)])
+        assert a.known_nodes['c'].endpoint == 'ws://c'
+
+    def test_apps_index_follows_known_nodes(self):
+        a = sync_manager('a')
+        a.register_node(NodeInfo(name='c', endpoint='ws://c', apps=[App(name='x')], version=1))
+        assert a.apps_index.get('x')['nodes'] == ['c']
+        a._merge_nodes_list_([NodeInfo(name='c', endpoint='ws://c', apps=[App(name='y')], version=2)])
+        assert a.apps_index.get('x') is None
+        assert a.apps_index.get('y')['nodes'] == ['c']
+        a.remove_node('c')
+        assert a.apps_index.snapshot()['apps'] == {}
+
+
+class NodeExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        from troup.testtools import LocalCluster
+        self.cluster = LocalCluster(1, config={'executor': {'workers': 4, 'limits': {'slow': 1}}}).start()
+        self.node = self.cluster[0]
+        self.release = threading.Event()
+        self.node.command_handler('slow', lambda command: self.release.wait(5))
+
+    def tearDown(self):
+        self.release.set()
+        self.cluster.stop()
+
+    def test_slow_command_does_not_block_others(self):
+        from troup.client import ChannelClient, CommandAPI
+        client = ChannelClient(nodes_specs=['node:%s' % self.node.aio_server.get_server_endpoint()])
+        try:
+            slow = [client.send_message_to_node(CommandAPI.command('slow', None), 'node', None) for i in range(3)]
+            start = time.monotonic()
+            for i in range(10):
+                assert client.send_message_to_node(CommandAPI.command('info', None), 'node', None).\
+                    result['name'] == 'node-0'
+            assert time.monotonic() - start < 2
+            assert not any(promise.is_done for promise in slow)
+            self.release.set()
+            assert all(promise.result for promise in slow)
+        finally:
+            client.shutdown()
+
+
+class NodeBacklogTest(unittest.TestCase):
+
+    def test_backlog_in_node_info(self):
+        from troup.testtools import LocalCluster
+        with LocalCluster(1, config={'runner-max-processes': '4'}) as cluster:
+            backlog = cluster[0].get_node_info().data['backlog']
+            assert backlog['queued'] == 0
+            assert backlog['limits']['process'] == 4
+
+
+class TaskOutputStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        from troup.testtools import LocalCluster
+        self.cluster = LocalCluster(1).start()
+        self.node = self.cluster[0]
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def test_stream_output(self):
+        from troup.client import ChannelClient, CommandAPI
+        client = ChannelClient(nodes_specs=['node:%s' % self.node.aio_server.get_server_endpoint()])
+        try:
+            task_id = client.send_message_to_node(CommandAPI.task('LocalProcess', {
+                'executable': 'sh',
+                'args': ['-c', 'for i in $(seq 1 2000); do echo line $i; done; sleep 0.3; echo end']
+            }, ttl=60000, track_out=True, buffer=1024 * 1024), 'node', None).result
+            chunks = []
+            ended = threading.Event()
+            subscriber = client.subscribe_task_output('node', task_id, lambda offset, data: chunks.append(data),
+                                                      on_end=lambda code: ended.set(), credits=2, chunk_size=1000)
+            assert subscriber.promise.result['subscription'] == subscriber.id
+            assert ended.wait(10)
+            expected = ''.join('line %d\n' % i for i in range(1, 2001)) + 'end\n'
+            assert b''.join(chunks).decode() == expected
+            assert max(len(chunk) for chunk in chunks) <= 1000
+            assert subscriber.returncode == 0
+            assert subscriber.lost == 0
+            assert not self.node.subscriptions
+        finally:
+            client.shutdown()
+
+
+def multiply(a, b):
+    return a * b
+
+
+class FunctionTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        from troup.testtools import LocalCluster
+        self.cluster = LocalCluster(1, config={'code-workers': 1}).start()
+        self.node = self.cluster[0]
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def test_run_function(self):
+        from troup.client import ChannelClient, CommandAPI
+        from troup.testtools import wait_for
+        client = ChannelClient(nodes_specs=['node:%s' % self.node.aio_server.get_server_endpoint()])
+        try:
+            task_id = client.send_message_to_node(CommandAPI.function(multiply, (6, 7), ttl=60000),
+                                                  'node', None).result
+            assert wait_for(lambda: self.node.runner.get(task_id).status == 'DONE', timeout=10)
+            result = client.send_message_to_node(CommandAPI.command('task-result', {'task-id': task_id}),
+                                                 'node', None).result
+            assert result == 42
+        finally:
+            client.shutdown()
+
+
+class PlacementTest(unittest.TestCase):
+
+    def setUp(self):
+        from troup.testtools import LocalCluster
+        self.cluster = LocalCluster(4, config={
+            'sync': {'interval': 200, 'percent': 1},
+            'reservations': {'settle': 5000}
+        }).start()
+        for node in self.cluster.nodes:
+            node.store.add_app(App(name='burst', command='true',
+                                   needs={'cpu': 1000, 'memory': 512, 'disk': 0, 'network': 0}))
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def test_burst_spread(self):
+        from troup.testtools import wait_for
+        launcher = self.cluster[0]
+
+        def ready():
+            app = launcher.sync_manager.apps_index.get('burst')
+            return app and len(app['nodes']) == 4 and \
+                all(node.stats for node in launcher.sync_manager.known_nodes.values())
+
+        assert wait_for(ready, timeout=10)
+
+        placements = {node.node_id: 0 for node in self.cluster.nodes}
+
+        def place(app, ranked_node):
+            placements[ranked_node['node']] += 1
+
+        launcher._run_as_task = place
+        start = time.monotonic()
+        for i in range(500):
+            launcher.run_app('burst')
+        assert time.monotonic() - start < 1
+        for name, count in placements.items():
+            assert 100 <= count <= 150, placements
+
+        # the reservations are gossiped to the other nodes
+        assert wait_for(lambda: len(self.cluster[1].sync_manager.reservations) == 500, timeout=5)
+        assert self.cluster[1].sync_manager.reservations.reserved('node-2')['memory'] > 0
+
+
+
+class RemoteTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        from troup.testtools import LocalCluster
+        self.cluster = LocalCluster(2, config={'sync': {'interval': 200, 'percent': 1}}).start()
+        needs = {'cpu': 1, 'memory': 1024, 'disk': 0, 'network': 0}
+        self.cluster[1].store.add_app(App(name='remote-true', command='true', needs=needs))
+        self.cluster[1].store.add_app(App(name='remote-false', command='false', needs=needs))
+        self.cluster[1].store.add_app(App(name='remote-ssh', command='true', params={'ssh': True}, needs=needs))
+        self.cluster[1].store.add_app(App(name='remote-sleep', command='sleep', params={'args': ['30']},
+                                          needs=needs))
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def wait_for_apps(self, launcher):
+        from troup.testtools import wait_for
+
+        def ready():
+            app = launcher.sync_manager.apps_index.get('remote-false')
+            known = launcher.sync_manager.known_nodes.get('node-1')
+            return app and app['nodes'] == ['node-1'] and known and known.endpoint
+
+        assert wait_for(ready, timeout=10)
+
+    def test_forward_app(self):
+        from troup.tasks import TaskRun
+        launcher = self.cluster[0]
+        self.wait_for_apps(launcher)
+
+        run = launcher.run_app('remote-true')
+        assert run.node == 'node-1'
+        run.future.result(10)
+        assert run.status == TaskRun.DONE
+        assert self.cluster[1].runner.get(run.id).status == TaskRun.DONE
+        assert launcher.runner.get(run.id) is None
+        assert launcher.remote_tasks.get(run.id) is run
+
+        run = launcher.run_app('remote-false')
+        run.future.result(10)
+        assert run.status == TaskRun.ERROR
+        assert 'code: 1' in run.error
+
+    def test_task_result(self):
+        from troup.client import ChannelClient, CommandAPI
+        from troup.tasks import TaskRun
+        launcher = self.cluster[0]
+        self.wait_for_apps(launcher)
+
+        run = launcher.run_app('remote-true')
+        run.future.result(10)
+        assert run.status is TaskRun.DONE
+        client = ChannelClient(nodes_specs=['node:%s' % launcher.aio_server.get_server_endpoint()])
+        try:
+            reply = client.send_message_to_node(CommandAPI.command('task-result', {'task-id': run.id}),
+                                                'node', None)
+            result = reply.result
+            assert not reply.error, reply.error
+            assert result == ''
+        finally:
+            client.shutdown()
+
+    def test_node_left(self):
+        from troup.tasks import TaskRun
+        launcher = self.cluster[0]
+        self.wait_for_apps(launcher)
+
+        run = launcher.run_app('remote-sleep')
+        assert not run.future.done()
+        launcher.sync_manager.remove_node('node-1')
+        run.future.result(5)
+        assert run.status is TaskRun.ERROR
+        assert 'left' in run.error
+
+    def test_ssh_opt_in(self):
+        launcher = self.cluster[0]
+        self.wait_for_apps(launcher)
+        launcher.runner.run = Mock()
+
+        launcher.run_app('remote-ssh')
+        task = launcher.runner.run.call_args[0][0]
+        assert task.process.__class__.__name__ == 'SSHRemoteProcess'
+        assert not launcher.remote_tasks.stats()['runs']
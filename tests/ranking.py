@@ -0,0 +1,180 @@
+import unittest
+import sys
+
+sys.path.append('..')
+
+import random
+import time
+from troup.ranking import NodeStatsTable, ReservationLedger, normalized_weights, needs_row, numpy, MB
+from troup.system import SystemStats
+
+
+def stats(bogomips, usage, memory, ioload):
+    s = SystemStats()
+    s.cpu['bogomips']['total'] = bogomips
+    s.cpu['usage'] = usage
+    s.memory['available'] = memory
+    s.disk['ioload'] = ioload
+    return s
+
+
+def reference_rank(needs, nodes):
+    m = max(needs.values())
+    W = {k: v/m for k, v in needs.items()}
+    scores = []
+    for name, s in nodes.items():
+        score = s.cpu['bogomips']['total'] * (1 - s.cpu['usage']) * W['cpu'] + \
+            s.memory['available'] * W['memory'] - s.disk['ioload'] * W['disk']
+        scores.append((score, name))
+    return [name for score, name in sorted(scores, reverse=True)]
+
+
+class NodeStatsTableTest(unittest.TestCase):
+
+    needs = {'cpu': 500, 'memory': 128, 'disk': 10, 'network': 0.05}
+
+    def tables(self):
+        tables = [NodeStatsTable(use_numpy=False)]
+        if numpy is not None:
+            tables.append(NodeStatsTable(use_numpy=True))
+        return tables
+
+    def random_nodes(self, n):
+        rnd = random.Random(n)
+        return {'n%d' % i: stats(rnd.randint(1000, 5000), rnd.random(), rnd.randint(0, 4096), rnd.random() * 100)
+                for i in range(n)}
+
+    def test_rank_matches_reference(self):
+        nodes = self.random_nodes(200)
+        expected = reference_rank(self.needs, nodes)
+        for table in self.tables():
+            for name, s in nodes.items():
+                table.update(name, s)
+            assert [name for name, score in table.rank(self.needs)] == expected
+            assert [name for name, score in table.rank(self.needs, k=10)] == expected[:10]
+
+    def test_rank_subset_and_remove(self):
+        nodes = self.random_nodes(50)
+        for table in self.tables():
+            for name, s in nodes.items():
+                table.update(name, s)
+            for i in range(0, 50, 2):
+                table.remove('n%d' % i)
+            remaining = {name: s for name, s in nodes.items() if int(name[1:]) % 2}
+            assert len(table) == 25
+            assert [name for name, score in table.rank(self.needs)] == reference_rank(self.needs, remaining)
+            subset = ['n1', 'n3', 'n4', 'n7']
+            ranked = [name for name, score in table.rank(self.needs, names=subset)]
+            assert ranked == reference_rank(self.needs, {n: nodes[n] for n in ('n1', 'n3', 'n7')})
+
+    def test_nodes_without_stats_last(self):
+        for table in self.tables():
+            table.update('empty', None)
+            table.update('a', stats(1000, 0.5, 100, 1))
+            table.update('b', stats(2000, 0.5, 100, 1))
+            ranked = table.rank(self.needs)
+            assert [name for name, score in ranked] == ['b', 'a', 'empty']
+            assert ranked[2][1] is None
+
+    def test_growth(self):
+        nodes = self.random_nodes(100)
+        for table in self.tables():
+            for name, s in nodes.items():
+                table.update(name, s)
+            table.update('n5', stats(100000, 0, 100000, 0))
+            assert table.rank(self.needs, k=1)[0][0] == 'n5'
+
+    def test_weights_cached(self):
+        assert normalized_weights({'cpu': 2, 'memory': 1}) is normalized_weights({'memory': 1, 'cpu': 2})
+
+
+
+class ReservationLedgerTest(unittest.TestCase):
+
+    needs = {'cpu': 1000, 'memory': 100, 'disk': 0}
+
+    def setUp(self):
+        self.table = NodeStatsTable()
+        self.table.update('a', stats(4000, 0, 1000 * MB, 0))
+        self.table.update('b', stats(3500, 0, 1000 * MB, 0))
+        self.ledger = ReservationLedger(self.table, local_node='a', settle=1000, ttl=10000)
+
+    def best(self):
+        return self.table.rank(self.needs, k=1)[0][0]
+
+    def test_reservation_lowers_rank(self):
+        assert self.best() == 'a'
+        rid = self.ledger.reserve('a', self.needs, at=1000)
+        assert self.best() == 'b'
+        self.ledger.release(rid)
+        assert self.best() == 'a'
+
+    def test_released_by_fresh_stats(self):
+        self.ledger.reserve('a', self.needs, at=1000)
+        self.ledger.on_stats('a', 1500)
+        assert self.ledger.reserved('a') == self.needs
+        self.ledger.on_stats('a', 2000)
+        assert self.ledger.reserved('a') == {}
+        assert self.best() == 'a'
+
+    def test_expire(self):
+        self.ledger.reserve('a', self.needs, at=1000)
+        self.ledger.expire(now=5000)
+        assert len(self.ledger) == 1
+        self.ledger.expire(now=11000)
+        assert len(self.ledger) == 0
+        assert self.best() == 'a'
+
+    def test_merge(self):
+        self.ledger.on_stats('b', 5000)
+        other = ReservationLedger(NodeStatsTable(), local_node='b')
+        other.reserve('a', self.needs, at=4500)
+        other.reserve('b', self.needs, at=3000)
+        self.ledger.merge(list(other.reservations.values()), now=5000)
+        # the reservation on 'b' is already accounted for in its stats
+        assert [r['node'] for r in self.ledger.reservations.values()] == ['a']
+        assert self.best() == 'b'
+        self.ledger.merge(list(other.reservations.values()), now=5000)
+        assert len(self.ledger) == 1
+
+    def test_needs_in_stats_units(self):
+        assert needs_row({'cpu': 500, 'memory': 128, 'disk': 10}) == (500, 128 * MB, -0.1)
+        # an app that needs 128 MB on a node with 200 MB available
+        self.table.update('a', stats(4000, 0, 200 * MB, 0))
+        self.table.update('b', stats(4000, 0, 150 * MB, 0))
+        needs = {'cpu': 1, 'memory': 128}
+        assert self.table.rank(needs, k=1)[0][0] == 'a'
+        self.ledger.reserve('a', needs, at=1000)
+        assert self.table.rank(needs, k=1)[0][0] == 'b'
+
+    def test_gossip_new_reservations(self):
+        self.ledger.retransmit = 2
+        now = int(time.time() * 1000)
+        first = self.ledger.reserve('a', self.needs, at=now)
+        assert [r['id'] for r in self.ledger.gossip()] == [first]
+        second = self.ledger.reserve('b', self.needs, at=now)
+        assert sorted(r['id'] for r in self.ledger.gossip()) == sorted([first, second])
+        assert [r['id'] for r in self.ledger.gossip()] == [second]
+        assert self.ledger.gossip() == []
+        assert len(self.ledger.active()) == 2
+
+        # the reservations received are gossiped further, once
+        other = ReservationLedger(NodeStatsTable(), local_node='b', retransmit=1)
+        other.merge(self.ledger.active())
+        assert len(other.gossip()) == 2
+        other.merge(self.ledger.active())
+        assert other.gossip() == []
+
+    def test_expire_released(self):
+        rid = self.ledger.reserve('a', self.needs, at=1000)
+        self.ledger.reserve('b', self.needs, at=2000)
+        self.ledger.release(rid)
+        self.ledger.expire(now=11500)
+        assert len(self.ledger) == 1
+        assert len(self.ledger.deadlines) == 1
+        self.ledger.expire(now=12000)
+        assert len(self.ledger) == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
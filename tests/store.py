@@ -1,5 +1,9 @@
 import unittest
 import sys
+import os
+import json
+import shutil
+import tempfile
 
 sys.path.append('..')
 
@@ -23,3 +27,179 @@ class InMemorySyncStoreTest(unittest.TestCase):
                  params={'p1':'v1', 'p2':'v2'},\
                  needs={'cpu': 0, 'memory': 1, 'network': 2, 'disk': 3})
         self.store.add_app(app)
+
+    def test_apps_changed_event(self):
+        changes = []
+        self.store.on('apps.changed', lambda: changes.append(True))
+        self.store.add_app(App(name='event-app', command='run'))
+        self.store.remove_app('event-app')
+        assert len(changes) == 2
+
+
+class WriteBehindStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='troup-store-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read_apps(self):
+        with open(os.path.join(self.root, 'apps.json')) as file:
+            return json.load(file)
+
+    def test_changes_coalesced(self):
+        store = InMemorySyncedStore(root_path=self.root, flush_delay=60000)
+        writes = store.writes
+        for i in range(100):
+            store.add_app(App(name='app-%d' % i, command='run'))
+        store.set_setting('name', 'value')
+        assert store.writes == writes
+        assert self.read_apps() == {}
+        assert store.stats()['dirty'] == ['apps', 'settings']
+
+        store.flush()
+        assert store.writes == writes + 2
+        assert len(self.read_apps()) == 100
+        assert not [name for name in os.listdir(self.root) if name.endswith('.tmp')]
+
+        store.flush()
+        assert store.writes == writes + 2
+        store.close()
+
+    def test_delayed_flush(self):
+        from troup.testtools import wait_for
+        store = InMemorySyncedStore(root_path=self.root, flush_delay=50)
+        store.add_apps([App(name='app-%d' % i, command='run') for i in range(10)])
+        store.remove_app('app-0')
+        assert wait_for(lambda: len(self.read_apps()) == 9, timeout=5)
+        assert store.stats()['dirty'] == []
+
+    def test_failed_flush_retried(self):
+        from unittest.mock import patch
+        from troup.testtools import wait_for
+        import troup.store
+        failures = []
+        write = troup.store.atomic_write
+
+        def failing_write(path, data):
+            if not failures:
+                failures.append(path)
+                raise OSError('disk full')
+            write(path, data)
+
+        store = InMemorySyncedStore(root_path=self.root, flush_delay=50)
+        with patch('troup.store.atomic_write', failing_write):
+            store.add_app(App(name='app', command='run'))
+            assert wait_for(lambda: 'app' in self.read_apps(), timeout=5)
+        assert failures
+        assert store.stats()['dirty'] == []
+        store.close()
+
+    def test_failed_write_keeps_other_changes(self):
+        from unittest.mock import patch
+        import troup.store
+        write = troup.store.atomic_write
+
+        def failing_write(path, data):
+            if path.endswith('apps.json'):
+                raise OSError('disk full')
+            write(path, data)
+
+        store = InMemorySyncedStore(root_path=self.root, flush_delay=60000)
+        store.add_app(App(name='app', command='run'))
+        store.set_setting('name', 'value')
+        with patch('troup.store.atomic_write', failing_write):
+            with self.assertRaises(OSError):
+                store.flush()
+        assert store.stats()['dirty'] == ['apps']
+        with open(os.path.join(self.root, 'settings.json')) as file:
+            assert json.load(file) == {'name': 'value'}
+
+        store.flush()
+        assert store.stats()['dirty'] == []
+        assert 'app' in self.read_apps()
+        store.close()
+
+    def test_close_writes_pending_changes(self):
+        store = InMemorySyncedStore(root_path=self.root, flush_delay=60000)
+        store.add_app(App(name='app', command='run'))
+        store.store_settings({'a': 1})
+        store.close()
+
+        reloaded = InMemorySyncedStore(root_path=self.root)
+        assert reloaded.find_app('app').command == 'run'
+        assert reloaded.get_setting('a') == 1
+
+
+class LogStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='troup-log-store-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_replay(self):
+        from troup.store import LogStore
+        store = LogStore(root_path=self.root)
+        changes = []
+        store.on('apps.changed', lambda: changes.append(True))
+        store.add_app(App(name='app-1', command='run', params={'p': 'v'}))
+        store.add_apps([App(name='app-2', command='run'), App(name='app-3', command='run')])
+        store.update_app(App(name='app-1', command='run again'))
+        store.remove_app('app-2')
+        store.set_setting('name', 'value')
+        assert len(changes) == 4
+        assert store.stats()['appends'] == 5
+        store.close()
+
+        reloaded = LogStore(root_path=self.root)
+        assert sorted(reloaded.apps) == ['app-1', 'app-3']
+        assert reloaded.find_app('app-1').command == 'run again'
+        assert reloaded.get_setting('name') == 'value'
+        assert reloaded.seq == 6
+        reloaded.close()
+
+    def test_torn_entry_dropped(self):
+        from troup.store import LogStore
+        store = LogStore(root_path=self.root)
+        store.add_app(App(name='app', command='run'))
+        store.close()
+        with open(os.path.join(self.root, 'journal.log'), 'ab') as file:
+            file.write(b'{"op": "remove-app", "na')
+
+        reloaded = LogStore(root_path=self.root)
+        assert reloaded.find_app('app')
+        reloaded.add_app(App(name='other', command='run'))
+        reloaded.close()
+        assert sorted(LogStore(root_path=self.root).apps) == ['app', 'other']
+
+    def test_compaction(self):
+        from troup.store import LogStore
+        store = LogStore(root_path=self.root, compact_size=1024)
+        for i in range(200):
+            store.add_app(App(name='app-%d' % (i % 10), command='run %d' % i))
+        stats = store.stats()
+        assert stats['compactions'] > 0
+        assert stats['journal_size'] <= max(1024, stats['snapshot_size']) + 200
+        store.close()
+
+        reloaded = LogStore(root_path=self.root)
+        assert len(reloaded.apps) == 10
+        assert reloaded.find_app('app-9').command == 'run 199'
+        assert reloaded.seq == 200
+        reloaded.close()
+
+    def test_changes(self):
+        from troup.store import LogStore
+        store = LogStore(root_path=self.root, feed_size=5)
+        fed = []
+        store.on('store.changed', fed.append)
+        for i in range(8):
+            store.add_app(App(name='app-%d' % i, command='run'))
+        assert [entry['seq'] for entry in store.changes(5)] == [6, 7, 8]
+        assert store.changes(8) == []
+        assert store.changes(1) is None
+        assert len(fed) == 8 and fed[-1]['app']['name'] == 'app-7'
+        store.close()
@@ -1,10 +1,20 @@
 import unittest
+from unittest.mock import patch
 import sys
 
 sys.path.append('..')
 
 import time
-from troup.tasks import Task, TaskRun, TasksRunner
+import threading
+from troup.tasks import Task, TaskRun, TasksRunner, LocalProcessTask, OutputSubscription, TaskException, SlotScaler
+from troup.tasks import FunctionBytecodeTask, function_task_data
+from troup.system import SystemStats
+from troup.process import ProcessSupervisor, ByteRingBuffer, CodePool, CodeError, Zygote, SSHMasters, SSHRemoteProcess
+from concurrent.futures import TimeoutError, CancelledError
+from base64 import b64decode
+import marshal
+import tempfile
+import os
 
 
 class DemoTask(Task):
@@ -70,5 +80,771 @@ class TasksRunnerTest(unittest.TestCase):
         self.runner.stop(dt.id, wait=True)
         assert run.status is TaskRun.DONE
 
+class TaskRetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = TasksRunner()
+
+    def tearDown(self):
+        self.runner.shutdown()
+
+    def wait_done(self, run):
+        run.future.result(5)
+        # the runner handles the end of the run in a callback of the future
+        time.sleep(0.01)
+
+    def test_no_ttl_dropped_when_done(self):
+        task = DemoTask()
+        self.wait_done(self.runner.run(task))
+        assert self.runner.get(task.id) is None
+        assert self.runner.counters['total'] == 0
+
+    def test_retained_for_ttl_after_done(self):
+        task = DelayedTestTask(delay=0.2)
+        task.ttl = 100
+        run = self.runner.run(task)
+        time.sleep(0.05)
+        assert self.runner.counters[TaskRun.RUNNING] == 1
+        self.wait_done(run)
+        counters = self.runner.counters
+        assert counters[TaskRun.RUNNING] == 0
+        assert counters[TaskRun.DONE] == 1
+        assert counters['retained'] == 1
+        # the ttl counts from the end of the run, in milliseconds
+        time.sleep(0.05)
+        assert self.runner.get(task.id) is run
+        time.sleep(0.1)
+        assert self.runner.get(task.id) is None
+        counters = self.runner.counters
+        assert counters[TaskRun.DONE] == 0
+        assert counters['expired'] == 1
+
+    def test_negative_ttl_kept_until_cleared(self):
+        task = DemoTask(ttl=-1)
+        self.wait_done(self.runner.run(task))
+        assert self.runner.counters['retained'] == 0
+        assert self.runner.get(task.id).status is TaskRun.DONE
+        self.runner.clear(task.id)
+        assert self.runner.get(task.id) is None
+        assert self.runner.counters[TaskRun.DONE] == 0
+
+    def test_clear_running(self):
+        task = DelayedTestTask(delay=0.2)
+        run = self.runner.run(task)
+        time.sleep(0.05)
+        with self.assertRaises(Exception):
+            self.runner.clear(task.id)
+        self.wait_done(run)
+
+    def test_counters_after_stop(self):
+        task = DelayedTestTask(delay=0.3)
+        task.ttl = 1000
+        run = self.runner.run(task)
+        time.sleep(0.05)
+        self.runner.stop(task.id, wait=True)
+        time.sleep(0.01)
+        counters = self.runner.counters
+        assert counters['total'] == 0
+        assert all(counters[status] == 0 for status in TaskRun.STATUSES)
+
+
+class BlockingTask(Task):
+
+    def __init__(self, release, done, task_id=None):
+        super(BlockingTask, self).__init__(task_id=task_id)
+        self.release = release
+        self.done = done
+
+    def run(self, context=None):
+        self.release.wait(5)
+        self.done.append(self.id)
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = TasksRunner(max_workers=1)
+        self.release = threading.Event()
+        self.done = []
+
+    def tearDown(self):
+        self.release.set()
+        self.runner.shutdown()
+
+    def task(self, task_id):
+        return BlockingTask(self.release, self.done, task_id=task_id)
+
+    def test_interactive_before_batch(self):
+        self.runner.run(self.task('first'))
+        time.sleep(0.05)
+        for i in range(3):
+            self.runner.run(self.task('batch-%d' % i), priority='batch')
+        last = self.runner.run(self.task('interactive'), priority='interactive')
+        backlog = self.runner.backlog()
+        assert backlog['queued'] == 4
+        assert backlog['classes'] == {'interactive': 1, 'normal': 0, 'batch': 3}
+        assert backlog['active'] == {'thread': 1, 'process': 0}
+        assert self.runner.counters[TaskRun.CREATED] == 4
+        self.release.set()
+        self.runner.get('batch-2').future.result(5)
+        assert self.done == ['first', 'interactive', 'batch-0', 'batch-1', 'batch-2']
+        assert self.runner.backlog()['queued'] == 0
+
+    def test_fair_share_between_submitters(self):
+        self.runner.run(self.task('first'))
+        for i in range(4):
+            self.runner.run(self.task('a-%d' % i), submitter='a')
+        self.runner.run(self.task('b-0'), submitter='b')
+        self.release.set()
+        self.runner.get('a-3').future.result(5)
+        assert self.done == ['first', 'a-0', 'b-0', 'a-1', 'a-2', 'a-3']
+
+    def test_stop_queued(self):
+        self.runner.run(self.task('first'))
+        queued = self.runner.run(self.task('queued'))
+        self.runner.stop('queued', wait=True, timeout=1)
+        assert queued.status is TaskRun.DONE
+        assert self.runner.get('queued') is None
+        self.release.set()
+        self.runner.get('first').future.result(5)
+        time.sleep(0.05)
+        assert self.done == ['first']
+        assert self.runner.backlog()['active']['thread'] == 0
+
+    def test_process_slots(self):
+        supervisor = ProcessSupervisor()
+        runner = TasksRunner(max_processes=2, supervisor=supervisor)
+        try:
+            runs = [runner.run(LocalProcessTask(process_type='LocalProcess',
+                                                process_data={'executable': 'sleep', 'args': ['0.2']}))
+                    for i in range(5)]
+            time.sleep(0.05)
+            assert supervisor.stats()['running'] == 2
+            assert runner.backlog()['queued'] == 3
+            for run in runs:
+                run.future.result(5)
+            assert supervisor.stats()['exited'] == 5
+        finally:
+            runner.shutdown()
+            supervisor.shutdown()
+
+
+def system_stats(usage=0.1, bogomips=1000, available=1000):
+    stats = SystemStats()
+    stats.cpu['usage'] = usage
+    stats.cpu['bogomips'] = {'total': bogomips}
+    stats.memory['available'] = available
+    return stats
+
+
+class SlotScalerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scaler = SlotScaler(2, 10, grow_after=2, shrink_after=3)
+
+    def test_grow_after_consecutive_checks(self):
+        assert self.scaler.update(2, queued=5, active=2) == 2
+        assert self.scaler.update(2, queued=5, active=2) == 4
+        assert self.scaler.update(4, queued=1, active=4) == 4
+        assert self.scaler.update(4, queued=1, active=4) == 5
+
+    def test_grow_up_to_maximum(self):
+        for i in range(10):
+            slots = self.scaler.update(8, queued=50, active=8)
+        assert slots == 10
+
+    def test_streak_reset(self):
+        self.scaler.update(2, queued=5, active=2)
+        self.scaler.update(2, queued=0, active=2)
+        assert self.scaler.update(2, queued=5, active=2) == 2
+
+    def test_shrink_when_idle(self):
+        assert self.scaler.update(6, queued=0, active=0) == 6
+        assert self.scaler.update(6, queued=0, active=0) == 6
+        assert self.scaler.update(6, queued=0, active=0) == 5
+        # one idle slot is kept
+        for i in range(5):
+            assert self.scaler.update(5, queued=0, active=4) == 5
+
+    def test_never_below_minimum(self):
+        for i in range(10):
+            assert self.scaler.update(2, queued=0, active=0) == 2
+
+    def test_needs_not_available(self):
+        # the memory needs are in megabytes
+        stats = system_stats(usage=0.5, bogomips=1000, available=1000 * 1024 * 1024)
+        for i in range(3):
+            assert self.scaler.update(2, 3, 2, stats, needs=[{'cpu': 300}, {'cpu': 300}]) == 2
+        for i in range(3):
+            assert self.scaler.update(2, 3, 2, stats, needs=[{'memory': 600}, {'memory': 600}]) == 2
+        self.scaler.update(2, 3, 2, stats, needs=[{'cpu': 200, 'memory': 400}, {}])
+        assert self.scaler.update(2, 3, 2, stats, needs=[{'cpu': 200, 'memory': 400}, {}]) == 4
+
+    def test_shrink_when_overloaded(self):
+        stats = system_stats(usage=0.95)
+        slots = 6
+        for i in range(6):
+            slots = self.scaler.update(slots, queued=10, active=slots, stats=stats)
+        assert slots == 4
+
+
+class ElasticRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = TasksRunner(min_workers=1, max_workers=4, scale_interval=20,
+                                  scaling={'grow_after': 1, 'shrink_after': 1})
+        self.release = threading.Event()
+        self.done = []
+
+    def tearDown(self):
+        self.release.set()
+        self.runner.shutdown()
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_workers_follow_load(self):
+        for i in range(6):
+            self.runner.run(BlockingTask(self.release, self.done, task_id='t%d' % i))
+        assert self.wait_until(lambda: self.runner.backlog()['active']['thread'] == 4)
+        backlog = self.runner.backlog()
+        assert backlog['limits']['thread'] == 4
+        assert backlog['queued'] == 2
+        assert backlog['elastic'] == {'thread': [1, 4]}
+        self.release.set()
+        assert self.wait_until(lambda: len(self.done) == 6)
+        assert self.wait_until(lambda: self.runner.backlog()['limits']['thread'] == 1)
+        assert self.wait_until(lambda: self.runner.workers.threads == 1)
+
+
+class ByteRingBufferTest(unittest.TestCase):
+
+    def test_not_full(self):
+        buffer = ByteRingBuffer(8)
+        assert buffer.getvalue() == b''
+        buffer.write(b'abc')
+        buffer.write(b'de')
+        assert buffer.getvalue() == b'abcde'
+        assert len(buffer) == 5
+
+    def test_wrap_around(self):
+        buffer = ByteRingBuffer(8)
+        for chunk in (b'abcde', b'fghij', b'kl'):
+            buffer.write(chunk)
+        assert buffer.getvalue() == b'efghijkl'
+        assert buffer.total == 12
+        assert len(buffer._buffer) == 8
+
+    def test_chunk_larger_than_capacity(self):
+        buffer = ByteRingBuffer(4)
+        buffer.write(b'ab')
+        buffer.write(b'0123456789')
+        assert buffer.getvalue() == b'6789'
+        buffer.write(b'x')
+        assert buffer.getvalue() == b'789x'
+
+    def test_read_from_offset(self):
+        buffer = ByteRingBuffer(8)
+        buffer.write(b'0123456789')
+        assert buffer.start == 2
+        assert buffer.read(0, 3) == (2, b'234')
+        assert buffer.read(5, 100) == (5, b'56789')
+        assert buffer.read(10, 4) == (10, b'')
+        buffer.write(b'abcd')
+        # wraps around the end of the array
+        assert buffer.read(7, 5) == (7, b'789ab')
+
+    def test_zero_capacity(self):
+        buffer = ByteRingBuffer(0)
+        buffer.write(b'abc')
+        assert buffer.getvalue() == b''
+        assert buffer.total == 3
+        assert buffer._buffer is None
+
+    def test_decode_split_character(self):
+        buffer = ByteRingBuffer(2)
+        buffer.write('aπb'.encode('utf-8'))
+        assert buffer.decode() == '\ufffdb'
+
+
+class ProcessSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor()
+
+    def tearDown(self):
+        self.supervisor.shutdown()
+
+    def test_output_and_returncode(self):
+        process = self.supervisor.spawn(['sh', '-c', 'echo out; echo err >&2; exit 3'], buffer_size=1024)
+        assert process.wait(5) == 3
+        assert process.returncode == 3
+        assert process.stdout == b'out\n'
+        assert process.stderr == b'err\n'
+
+    def test_large_output_is_bounded(self):
+        process = self.supervisor.spawn(['sh', '-c', 'head -c 1000000 /dev/zero; echo end'], buffer_size=100)
+        assert process.wait(5) == 0
+        assert process.bytes_read == 1000004
+        assert len(process.stdout) == 100
+        assert process.stdout.endswith(b'end\n')
+
+    def test_spawn_error(self):
+        with self.assertRaises(FileNotFoundError):
+            self.supervisor.spawn(['/no/such/executable'])
+        assert self.supervisor.stats()['failed'] == 1
+
+    def test_kill(self):
+        process = self.supervisor.spawn(['sleep', '10'])
+        process.kill()
+        assert process.wait(5) == -9
+        assert self.supervisor.stats()['running'] == 0
+
+    def test_many_processes_few_threads(self):
+        self.supervisor.start()
+        threads = threading.active_count()
+        processes = [self.supervisor.spawn(['sh', '-c', 'sleep 2; echo %d' % i], buffer_size=64)
+                     for i in range(200)]
+        assert self.supervisor.stats()['running'] > 100
+        assert threading.active_count() - threads < 10
+        for i, process in enumerate(processes):
+            assert process.wait(10) == 0
+            assert process.stdout == b'%d\n' % i
+        stats = self.supervisor.stats()
+        assert stats['running'] == 0
+        assert stats['exited'] == 200
+
+
+class OutputSubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor()
+        self.sent = []
+        self.eof = threading.Event()
+
+    def tearDown(self):
+        self.supervisor.shutdown()
+
+    def send(self, chunk):
+        self.sent.append(chunk)
+        if chunk['eof']:
+            self.eof.set()
+
+    def start_task(self, script, buffer_size=1024 * 1024):
+        task = LocalProcessTask(process_type='LocalProcess', consume_process_out=True, buffer_size=buffer_size,
+                                process_data={'executable': 'sh', 'args': ['-c', script]})
+        done = task.run_async(self.supervisor)
+        return task, done
+
+    def test_credits(self):
+        task, done = self.start_task('head -c 100000 /dev/zero')
+        done.result(5)
+        subscription = OutputSubscription(task, self.send, credits=3, chunk_size=10000)
+        subscription.start()
+        time.sleep(0.1)
+        assert [chunk['offset'] for chunk in self.sent] == [0, 10000, 20000]
+        subscription.grant(100)
+        assert self.eof.wait(5)
+        assert sum(len(chunk['data']) for chunk in self.sent) == 100000
+        assert self.sent[-1]['returncode'] == 0
+        assert subscription.closed
+
+    def test_streams_while_running(self):
+        task, done = self.start_task('echo first; sleep 0.5; echo second')
+        subscription = OutputSubscription(task, self.send)
+        subscription.start()
+        time.sleep(0.3)
+        assert [chunk['data'] for chunk in self.sent] == [b'first\n']
+        assert self.eof.wait(5)
+        assert [chunk['data'] for chunk in self.sent] == [b'first\n', b'second\n', b'']
+
+    def test_resume_from_offset(self):
+        task, done = self.start_task('head -c 5000 /dev/zero', buffer_size=1000)
+        done.result(5)
+        OutputSubscription(task, self.send, offset=0).start()
+        assert self.eof.wait(5)
+        # the first 4000 bytes were overwritten before the subscription
+        assert self.sent[0]['offset'] == 4000
+        self.sent = []
+        self.eof.clear()
+        OutputSubscription(task, self.send, offset=4500).start()
+        assert self.eof.wait(5)
+        assert self.sent[0]['offset'] == 4500
+        assert len(self.sent[0]['data']) == 500
+
+    def test_output_not_captured(self):
+        task = LocalProcessTask(process_type='LocalProcess', consume_process_out=False,
+                                process_data={'executable': 'true', 'args': []})
+        task.run_async(self.supervisor).result(5)
+        with self.assertRaises(TaskException):
+            OutputSubscription(task, self.send)
+
+
+class LocalProcessTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor()
+        self.runner = TasksRunner(max_workers=1, supervisor=self.supervisor)
+
+    def tearDown(self):
+        self.runner.shutdown()
+        self.supervisor.shutdown()
+
+    def process_task(self, script, consume=True):
+        return LocalProcessTask(process_type='LocalProcess', ttl=60000, consume_process_out=consume,
+                                process_data={'executable': 'sh', 'args': ['-c', script]})
+
+    def test_result(self):
+        task = self.process_task('echo one; echo two')
+        run = self.runner.run(task)
+        run.future.result(5)
+        assert run.status is TaskRun.DONE
+        assert task.result == 'one\ntwo\n'
+
+    def test_error(self):
+        task = self.process_task('echo failed >&2; exit 2')
+        run = self.runner.run(task)
+        run.future.result(5)
+        assert run.status is TaskRun.ERROR
+        assert str(run.error) == 'code: 2failed\n'
+
+    def test_stop(self):
+        task = self.process_task('sleep 10')
+        run = self.runner.run(task)
+        assert run.status is TaskRun.RUNNING
+        self.runner.stop(task.id, wait=True, timeout=5)
+        assert run.status is TaskRun.DONE
+
+    def test_processes_do_not_occupy_workers(self):
+        tasks = [self.process_task('sleep 0.3') for i in range(20)]
+        start = time.monotonic()
+        runs = [self.runner.run(task) for task in tasks]
+        for run in runs:
+            run.future.result(5)
+        # a single worker would run the processes one after another
+        assert time.monotonic() - start < 3
+        assert all(run.status is TaskRun.DONE for run in runs)
+
+    def test_run_blocking(self):
+        task = self.process_task('echo sync')
+        task.run()
+        assert task.result == 'sync\n'
+
+
+
+WORKER_SCRIPT = """
+import os
+import sys
+import time
+print('parent %d cwd %s args %s' % (os.getppid(), os.getcwd(), ' '.join(sys.argv[1:])))
+print('to stderr', file=sys.stderr)
+time.sleep(float(os.environ.get('SLEEP', '0')))
+sys.exit(int(os.environ.get('EXIT', '0')))
+"""
+
+
+class ZygoteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.script = os.path.join(self.directory, 'worker.py')
+        with open(self.script, 'w') as f:
+            f.write(WORKER_SCRIPT)
+        self.zygote = Zygote(preload=['json'], max_workers=1)
+        self.supervisor = ProcessSupervisor(zygote=self.zygote)
+
+    def tearDown(self):
+        self.supervisor.shutdown()
+        os.remove(self.script)
+        os.rmdir(self.directory)
+
+    def spawn(self, **env):
+        return self.supervisor.spawn_python(self.script, ['a', 'b'], module=False, cwd=self.directory,
+                                            env=dict(os.environ, **env), buffer_size=1000)
+
+    def test_forked_from_zygote(self):
+        process = self.spawn(EXIT='3')
+        assert process.wait(10) == 3
+        expected = 'parent %d cwd %s args a b\n' % (self.zygote.process.pid, os.path.realpath(self.directory))
+        assert process.stdout.decode() == expected
+        assert process.stderr == b'to stderr\n'
+        assert self.supervisor.stats()['zygote']['forked'] == 1
+
+    def test_module(self):
+        process = self.supervisor.spawn_python('json.tool', ['--help'], buffer_size=10000)
+        assert process.wait(10) == 0
+        assert b'json.tool' in process.stdout
+
+    def test_falls_back_to_exec_at_max_workers(self):
+        first = self.spawn(SLEEP='1')
+        second = self.spawn()
+        assert second.wait(10) == 0
+        assert second.stdout.startswith(b'parent %d ' % os.getpid())
+        assert first.wait(10) == 0
+        assert first.stdout.startswith(b'parent %d ' % self.zygote.process.pid)
+
+    def test_kill(self):
+        process = self.spawn(SLEEP='10')
+        time.sleep(0.2)
+        process.kill()
+        assert process.wait(5) == -9
+
+    def test_restart_after_zygote_exit(self):
+        assert self.spawn().wait(10) == 0
+        self.zygote.process.kill()
+        self.zygote.process.wait()
+        process = self.spawn()
+        assert process.wait(10) == 0
+        assert process.stdout.startswith(b'parent %d ' % self.zygote.process.pid)
+        assert self.zygote.stats()['restarts'] == 1
+
+    def test_python_process_task(self):
+        task = LocalProcessTask(process_type='PythonProcess', consume_process_out=True,
+                                process_data={'script': self.script, 'args': ['x']})
+        assert task.run_async(self.supervisor).result(10).endswith('args x\n')
+
+    def test_unsupported_falls_back_to_exec(self):
+        with patch('troup.process.zygote_supported', return_value=False):
+            zygote = Zygote(max_workers=1)
+        supervisor = ProcessSupervisor(zygote=zygote)
+        try:
+            process = supervisor.spawn_python(self.script, ['a'], module=False, cwd=self.directory,
+                                              buffer_size=1000)
+            assert process.wait(10) == 0
+            assert process.stdout.startswith(b'parent %d ' % os.getpid())
+            assert zygote.process is None
+        finally:
+            supervisor.shutdown()
+
+
+FAKE_SSH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'ssh', 'ssh')
+
+
+def process_alive(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except OSError:
+        return False
+
+
+class SSHMastersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = tempfile.mktemp()
+        os.environ['TROUP_FAKE_SSH_LOG'] = self.log
+        self.masters = SSHMasters(ssh=FAKE_SSH, idle_timeout=60000, check_interval=60000)
+        self.supervisor = ProcessSupervisor(ssh_masters=self.masters)
+
+    def tearDown(self):
+        self.supervisor.shutdown()
+        if os.path.exists(self.log):
+            os.remove(self.log)
+
+    def launch(self, text, host='host', supervisor=None):
+        process = SSHRemoteProcess(id=None, name='echo', args=[text], target_host=host, ssh_user='user',
+                                   ssh=FAKE_SSH)
+        process.spawn(supervisor or self.supervisor, buffer_size=1000)
+        assert process.process.wait(10) == 0
+        return process.process.stdout.decode()
+
+    def connections(self):
+        with open(self.log) as f:
+            return f.read().split('\n')[:-1]
+
+    def master_pid(self, host='host'):
+        with open(self.masters.control_path('user', host, '22')) as f:
+            return int(f.read())
+
+    def test_reuse_master(self):
+        assert self.launch('one') == 'one\n'
+        start = time.monotonic()
+        assert self.launch('two') == 'two\n'
+        assert time.monotonic() - start < 0.3
+        self.launch('three', host='other')
+        assert self.connections() == ['connect user@host', 'mux user@host', 'connect user@other']
+        stats = self.supervisor.stats()['ssh']
+        assert stats['masters'] == 2
+        assert stats['started'] == 2
+        assert stats['reused'] == 1
+
+    def test_without_masters(self):
+        supervisor = ProcessSupervisor()
+        try:
+            self.launch('one', supervisor=supervisor)
+            self.launch('two', supervisor=supervisor)
+        finally:
+            supervisor.shutdown()
+        assert self.connections() == ['connect user@host', 'connect user@host']
+
+    def test_dead_master(self):
+        self.launch('one')
+        os.kill(self.master_pid(), 9)
+        time.sleep(0.1)
+        self.masters.maintain()
+        assert self.masters.stats()['dead'] == 1
+        assert self.masters.stats()['masters'] == 0
+        self.launch('two')
+        assert self.connections() == ['connect user@host', 'connect user@host']
+
+    def test_evict_idle_master(self):
+        self.masters.idle_timeout = 200
+        self.launch('one')
+        pid = self.master_pid()
+        time.sleep(0.3)
+        self.masters.maintain()
+        assert self.masters.stats()['evicted'] == 1
+        assert not os.path.exists(self.masters.control_path('user', 'host', '22'))
+        time.sleep(0.1)
+        assert not process_alive(pid)
+
+    def test_keep_master_with_sessions(self):
+        self.masters.idle_timeout = 200
+        session = SSHRemoteProcess(id=None, name='sleep', args=['0.6'], target_host='host', ssh_user='user',
+                                   ssh=FAKE_SSH)
+        session.spawn(self.supervisor)
+        time.sleep(0.5)
+        self.masters.maintain()
+        assert self.masters.stats()['evicted'] == 0
+        assert process_alive(self.master_pid())
+
+        assert session.process.wait(10) == 0
+        time.sleep(0.3)
+        self.masters.maintain()
+        assert self.masters.stats()['evicted'] == 1
+
+
+def add(a, b, scale=1):
+    return (a + b) * scale
+
+
+def worker_pid():
+    import os
+    return os.getpid()
+
+
+def fail():
+    raise ValueError('bad value')
+
+
+def sleep(seconds):
+    import time
+    time.sleep(seconds)
+    return seconds
+
+
+class CodePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = CodePool(size=2, max_tasks=3)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def submit(self, function, *args, **kwargs):
+        return self.pool.submit(marshal.dumps(function.__code__), args, kwargs,
+                                defaults=function.__defaults__, timeout=kwargs.pop('timeout', None))
+
+    def test_result(self):
+        assert self.submit(add, 1, 2).result(10) == 3
+        assert self.submit(add, 1, 2, scale=10).result(10) == 30
+
+    def test_error(self):
+        future = self.submit(fail)
+        self.assertRaises(CodeError, future.result, 10)
+        assert 'ValueError: bad value' in str(future.exception())
+        assert self.submit(add, 1, 1).result(10) == 2
+
+    def test_runs_in_parallel(self):
+        start = time.monotonic()
+        futures = [self.submit(sleep, 0.5) for i in range(2)]
+        assert [future.result(10) for future in futures] == [0.5, 0.5]
+        assert time.monotonic() - start < 0.9
+
+    def test_timeout(self):
+        future = self.pool.submit(marshal.dumps(sleep.__code__), [5], timeout=0.3)
+        self.assertRaises(TimeoutError, future.result, 10)
+        assert self.pool.stats()['timeouts'] == 1
+        assert self.submit(add, 2, 2).result(10) == 4
+
+    def test_timeout_without_process_kill(self):
+        # Python before 3.7 has no Process.kill()
+        import multiprocessing.context
+        with patch.object(multiprocessing.context.SpawnProcess, 'kill', side_effect=AttributeError('kill'),
+                          create=True):
+            future = self.pool.submit(marshal.dumps(sleep.__code__), [5], timeout=0.3)
+            self.assertRaises(TimeoutError, future.result, 10)
+            future = self.submit(sleep, 5)
+            time.sleep(0.5)
+            self.pool.cancel(future)
+            self.assertRaises(CancelledError, future.result, 10)
+            assert self.submit(add, 2, 2).result(10) == 4
+
+    def test_recycle_workers(self):
+        pids = set()
+        for i in range(12):
+            pids.add(self.submit(worker_pid).result(10))
+        assert len(pids) >= 4
+        assert self.pool.stats()['recycled'] >= 2
+
+    def test_cancel_running(self):
+        future = self.submit(sleep, 5)
+        time.sleep(0.5)
+        self.pool.cancel(future)
+        self.assertRaises(CancelledError, future.result, 10)
+        assert self.submit(add, 3, 3).result(10) == 6
+
+
+class FunctionBytecodeTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = TasksRunner(code_pool=CodePool(size=2))
+
+    def tearDown(self):
+        self.runner.shutdown()
+
+    def task(self, function, args=(), kwargs=None, timeout=None):
+        data = function_task_data(function, args, kwargs)
+        return FunctionBytecodeTask(None, b64decode(data['code']), data['args'], data['kwargs'], None,
+                                    defaults=data['defaults'], timeout=timeout)
+
+    def test_run(self):
+        run = self.runner.run(self.task(add, (2, 3), {'scale': 2}))
+        run.future.result(10)
+        assert run.status is TaskRun.DONE
+        assert run.task.result == 10
+
+    def test_default_arguments(self):
+        run = self.runner.run(self.task(add, (2, 3)))
+        run.future.result(10)
+        assert run.task.result == 5
+
+    def test_error(self):
+        run = self.runner.run(self.task(fail))
+        run.future.result(10)
+        assert run.status is TaskRun.ERROR
+        assert isinstance(run.error, CodeError)
+
+    def test_timeout(self):
+        run = self.runner.run(self.task(sleep, (5,), timeout=200))
+        run.future.result(10)
+        assert run.status is TaskRun.ERROR
+        assert isinstance(run.error, TimeoutError)
+
+    def test_stop(self):
+        run = self.runner.run(self.task(sleep, (5,)))
+        time.sleep(0.5)
+        self.runner.stop(run.id, wait=True, timeout=5)
+        run.future.result(10)
+        assert run.status is TaskRun.DONE
+
+    def test_no_closures(self):
+        scale = 2
+        self.assertRaises(TaskException, function_task_data, lambda x: x * scale)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,324 @@
+import unittest
+import sys
+
+sys.path.append('..')
+
+import time
+from troup.threading import TimerScheduler, IntervalTimer, ExpiryHeap, LimitedExecutor, FairShareQueue, ElasticPool
+from threading import Event, Lock, current_thread
+
+
+class TimerSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = TimerScheduler()
+
+    def test_call_later(self):
+        calls = []
+        self.scheduler.call_later(50, calls.append, 'called')
+        assert self.scheduler.stats()['one_shot'] == 1
+        time.sleep(0.02)
+        assert not calls
+        time.sleep(0.1)
+        assert calls == ['called']
+        assert self.scheduler.stats()['timers'] == 0
+
+    def test_cancel(self):
+        calls = []
+        call = self.scheduler.call_later(50, calls.append, 'called')
+        call.cancel()
+        time.sleep(0.1)
+        assert not calls
+        assert self.scheduler.stats()['timers'] == 0
+
+    def test_call_every_with_offset(self):
+        ticks = []
+        call = self.scheduler.call_every(20, lambda: ticks.append(time.monotonic()), offset=100)
+        start = time.monotonic()
+        time.sleep(0.08)
+        assert not ticks
+        time.sleep(0.15)
+        call.cancel()
+        assert len(ticks) >= 5
+        assert ticks[0] - start >= 0.09
+        stats = self.scheduler.stats()
+        assert stats['periodic'] == 0
+        assert stats['ticks'] == len(ticks)
+
+    def test_drift_correction(self):
+        ticks = []
+
+        def slow_tick():
+            ticks.append(time.monotonic())
+            time.sleep(0.015)
+
+        call = self.scheduler.call_every(20, slow_tick)
+        time.sleep(0.21)
+        call.cancel()
+        # ticks stay on the 20ms grid even though every tick takes 15ms
+        assert len(ticks) >= 9
+        assert abs((ticks[-1] - ticks[0]) - 0.02 * (len(ticks) - 1)) < 0.02
+
+    def test_slow_tick_skipped(self):
+        ticks = []
+
+        def slow_tick():
+            ticks.append(time.monotonic())
+            time.sleep(0.05)
+
+        call = self.scheduler.call_every(10, slow_tick)
+        time.sleep(0.12)
+        call.cancel()
+        assert len(ticks) <= 3
+        assert self.scheduler.stats()['skipped_ticks'] > 0
+
+    def test_jitter(self):
+        ticks = []
+        call = self.scheduler.call_every(20, lambda: ticks.append(time.monotonic()), jitter=0.5)
+        time.sleep(0.3)
+        call.cancel()
+        assert len(ticks) >= 10
+        for i in range(1, len(ticks)):
+            assert ticks[i] - ticks[i - 1] < 0.045
+
+    def test_blocking_calls_off_the_workers(self):
+        scheduler = TimerScheduler(workers=2, blocking_workers=3)
+        release = Event()
+        ticks = []
+        blocked = [scheduler.call_every(10, release.wait, 1, blocking=True) for _ in range(3)]
+        scheduler.call_later(50, ticks.append, 'called')
+        time.sleep(0.15)
+        stats = scheduler.stats()
+        release.set()
+        for call in blocked:
+            call.cancel()
+        # the blocked callbacks hold the blocking workers, not the two workers
+        assert ticks == ['called']
+        assert stats['blocking_busy'] == 3
+        assert stats['skipped_ticks'] > 0
+
+    def test_blocking_calls_reuse_threads(self):
+        scheduler = TimerScheduler(workers=1, blocking_workers=2)
+        names = set()
+        slow = Lock()
+
+        def tick():
+            names.add(current_thread().name)
+            with slow:
+                time.sleep(0.01)
+
+        calls = [scheduler.call_every(5, tick, blocking=True) for _ in range(4)]
+        for i in range(20):
+            scheduler.call_later(i * 5, tick, blocking=True)
+        time.sleep(0.2)
+        for call in calls:
+            call.cancel()
+        # every tick ran on one of the two long-lived blocking workers
+        assert names == {'TimerScheduler-blocking-0', 'TimerScheduler-blocking-1'}
+        assert scheduler.stats()['blocking_workers'] == 2
+
+
+class IntervalTimerTest(unittest.TestCase):
+
+    def test_interval_timer(self):
+        scheduler = TimerScheduler()
+        ticks = []
+        timer = IntervalTimer(interval=20, offset=40, target=lambda: ticks.append(1), scheduler=scheduler)
+        timer.start()
+        assert timer.running
+        time.sleep(0.03)
+        assert not ticks
+        time.sleep(0.1)
+        timer.cancel()
+        count = len(ticks)
+        assert count >= 3
+        time.sleep(0.05)
+        assert len(ticks) == count
+        assert not timer.running
+
+
+class ExpiryHeapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.expired = []
+        self.heap = ExpiryHeap(on_expired=lambda key, value: self.expired.append((key, value, time.monotonic())),
+                               scheduler=TimerScheduler())
+
+    def test_expire_at_deadline(self):
+        start = time.monotonic()
+        self.heap.add('b', 2, 80)
+        self.heap.add('a', 1, 40)
+        time.sleep(0.06)
+        assert [(k, v) for k, v, t in self.expired] == [('a', 1)]
+        time.sleep(0.05)
+        assert [(k, v) for k, v, t in self.expired] == [('a', 1), ('b', 2)]
+        assert abs(self.expired[0][2] - start - 0.04) < 0.015
+        assert abs(self.expired[1][2] - start - 0.08) < 0.015
+        assert len(self.heap) == 0
+
+    def test_remove(self):
+        self.heap.add('a', 1, 30)
+        assert 'a' in self.heap
+        assert self.heap.remove('a') == 1
+        assert self.heap.remove('a') is None
+        time.sleep(0.05)
+        assert not self.expired
+
+    def test_heap_compacted(self):
+        for i in range(10000):
+            self.heap.add(i, i, 60000)
+            self.heap.remove(i)
+        assert len(self.heap) == 0
+        assert len(self.heap._heap) <= 64
+
+
+
+class LimitedExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = LimitedExecutor(workers=4, limits={'slow': 1})
+        self.release = Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def test_limit_per_key(self):
+        done = []
+        for i in range(3):
+            self.executor.submit('slow', self.release.wait)
+        for i in range(5):
+            self.executor.submit('fast', done.append, i)
+        deadline = time.monotonic() + 2
+        while len(done) < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sorted(done) == list(range(5))
+        stats = self.executor.stats()
+        assert stats['running'] == {'slow': 1}
+        assert stats['waiting'] == {'slow': 2}
+
+        self.release.set()
+        deadline = time.monotonic() + 2
+        while self.executor.stats()['running'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert self.executor.stats()['completed'] == 8
+
+    def test_default_limit_leaves_a_worker(self):
+        done = Event()
+        for i in range(6):
+            self.executor.submit('other-slow', self.release.wait)
+        self.executor.submit('info', done.set)
+        assert done.wait(2)
+        assert self.executor.stats()['running']['other-slow'] == 3
+
+    def test_failing_job(self):
+        done = Event()
+        self.executor.submit('a', lambda: 1 / 0)
+        self.executor.submit('a', done.set)
+        assert done.wait(1)
+
+
+class FairShareQueueTest(unittest.TestCase):
+
+    def drain(self, queue):
+        jobs = []
+        job = queue.get()
+        while job is not None:
+            jobs.append(job)
+            job = queue.get()
+        return jobs
+
+    def test_priority_classes(self):
+        queue = FairShareQueue()
+        queue.put('b1', priority='batch')
+        queue.put('n1')
+        queue.put('i1', priority='interactive')
+        queue.put('x1', priority='unknown')
+        assert queue.depth() == {'interactive': 1, 'normal': 2, 'batch': 1}
+        assert self.drain(queue) == ['i1', 'n1', 'x1', 'b1']
+        assert len(queue) == 0
+
+    def test_fair_share_between_submitters(self):
+        queue = FairShareQueue()
+        for i in range(6):
+            queue.put('a%d' % i, submitter='a')
+        queue.put('b0', submitter='b')
+        queue.put('b1', submitter='b')
+        assert queue.stats()['submitters'] == {'a': 6, 'b': 2}
+        assert self.drain(queue) == ['a0', 'b0', 'a1', 'b1', 'a2', 'a3', 'a4', 'a5']
+
+    def test_weights(self):
+        queue = FairShareQueue(weights={'a': 2})
+        for i in range(4):
+            queue.put('a%d' % i, submitter='a')
+            queue.put('b%d' % i, submitter='b')
+        # a gets two turns for every turn of b; ties go to the job queued first
+        assert self.drain(queue) == ['a0', 'b0', 'a1', 'a2', 'b1', 'a3', 'b2', 'b3']
+
+    def test_late_submitter_not_penalized(self):
+        queue = FairShareQueue()
+        for i in range(4):
+            queue.put('a%d' % i, submitter='a')
+        assert queue.get() == 'a0'
+        assert queue.get() == 'a1'
+        # b has not used its share and comes next
+        queue.put('b0', submitter='b')
+        assert queue.get() == 'b0'
+
+    def test_peek(self):
+        queue = FairShareQueue()
+        queue.put('b0', priority='batch')
+        queue.put('n0')
+        queue.put('i0', priority='interactive')
+        assert queue.peek(2) == ['i0', 'n0']
+        assert queue.peek(5) == ['i0', 'n0', 'b0']
+        assert len(queue) == 3
+
+
+class ElasticPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ElasticPool(2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def wait_threads(self, count):
+        deadline = time.monotonic() + 5
+        while self.pool.threads != count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.pool.threads
+
+    def test_grow_and_shrink(self):
+        release = Event()
+        lock = Lock()
+        running = [0, 0]
+
+        def job():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+        for i in range(4):
+            self.pool.submit(job)
+        self.pool.resize(4)
+        time.sleep(0.1)
+        assert running[1] == 4
+        release.set()
+        self.pool.resize(1)
+        assert self.wait_threads(1) == 1
+
+    def test_shutdown(self):
+        done = Event()
+        self.pool.submit(done.set)
+        self.pool.shutdown()
+        assert done.is_set()
+        assert self.pool.threads == 0
+        self.assertRaises(RuntimeError, self.pool.submit, done.set)
+
+
+if __name__ == '__main__':
+    unittest.main()
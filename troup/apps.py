@@ -14,8 +14,17 @@
 
 __author__ = 'pavle'
 
+from threading import RLock
+
 
 class App:
+    """An app that the node can run.
+
+    *needs* are the resources the app needs: ``cpu`` in bogomips, ``memory``
+    in megabytes, ``disk`` in percent of the io capacity of a node, and
+    ``network``. They weigh the stats when ranking the nodes and are reserved
+    on the node an app is placed on.
+    """
 
     def __init__(self, name=None, description=None, command=None, params=None, needs=None):
         self.name = name
@@ -23,3 +32,103 @@ class App:
         self.command = command
         self.params = params or {}
         self.needs = needs or { "cpu": 0, "memory": 0, "network": 0, "disk": 0 }
+
+
+class AppsIndex:
+    """Index of the apps available on the known nodes: app name -> names of the
+    nodes that provide it.
+
+    The index is updated per node, when the apps of a node change or the node
+    leaves, so looking up an app is a dict access. The entry of an app has the
+    definition of the app (from *local_node* if it provides it) and the list
+    of its nodes. :meth:`snapshot` returns all entries together with the
+    version of the index; it is rebuilt only after a change.
+    """
+
+    def __init__(self, local_node=None):
+        self.local_node = local_node
+        self.providers = {}
+        self.node_apps = {}
+        self.entries = {}
+        self.version = 0
+        self._snapshot = None
+        self.lock = RLock()
+
+    def update_node(self, node_name, apps):
+        """Sets the apps provided by a node. Returns ``True`` if the index has changed."""
+        apps = {app.name: app for app in apps or []}
+        with self.lock:
+            old = self.node_apps.get(node_name) or {}
+            changed = False
+            for name in old:
+                if name not in apps:
+                    self.__remove_provider(name, node_name)
+                    changed = True
+            for name, app in apps.items():
+                if name not in old or old[name].__dict__ != app.__dict__:
+                    providers = self.providers.get(name)
+                    if providers is None:
+                        providers = self.providers[name] = {}
+                    providers[node_name] = app
+                    self.entries.pop(name, None)
+                    changed = True
+            if apps:
+                self.node_apps[node_name] = apps
+            else:
+                self.node_apps.pop(node_name, None)
+            if changed:
+                self.__changed()
+            return changed
+
+    def remove_node(self, node_name):
+        with self.lock:
+            apps = self.node_apps.pop(node_name, None)
+            if not apps:
+                return False
+            for name in apps:
+                self.__remove_provider(name, node_name)
+            self.__changed()
+            return True
+
+    def get(self, app_name):
+        """The entry for the app, or ``None`` if no known node provides it.
+        The entry is shared and must not be modified.
+        """
+        with self.lock:
+            entry = self.entries.get(app_name)
+            if entry is None:
+                providers = self.providers.get(app_name)
+                if not providers:
+                    return None
+                app = providers.get(self.local_node) or next(iter(providers.values()))
+                entry = self.entries[app_name] = {
+                    'name': app.name,
+                    'description': app.description,
+                    'command': app.command,
+                    'params': app.params,
+                    'needs': app.needs,
+                    'nodes': list(providers)
+                }
+            return entry
+
+    def snapshot(self):
+        """All entries, as ``{'version': version, 'apps': {name: entry}}``."""
+        with self.lock:
+            if self._snapshot is None:
+                self._snapshot = {
+                    'version': self.version,
+                    'apps': {name: self.get(name) for name in self.providers}
+                }
+            return self._snapshot
+
+    def __remove_provider(self, app_name, node_name):
+        providers = self.providers.get(app_name)
+        if providers is not None:
+            providers.pop(node_name, None)
+            if not providers:
+                del self.providers[app_name]
+        self.entries.pop(app_name, None)
+
+    def __changed(self):
+        self.version += 1
+        self._snapshot = None
@@ -13,13 +13,18 @@
 # limitations under the License.
 
 from troup.infrastructure import OutgoingChannelOverWS
-from troup.distributed import Promise
-from troup.threading import IntervalTimer
+from troup.distributed import Promise, DistributedException
+from troup.threading import ExpiryHeap, call_later
 from troup.node import read_local_node_lock
+from troup.tasks import function_task_data
 from troup.messaging import message, serialize, deserialize, Message
 
-from threading import Thread
+from threading import Thread, Lock
 from datetime import datetime, timedelta
+from base64 import b64decode
+from uuid import uuid4
+import asyncio
+import logging
 
 
 class CallbackWrapper:
@@ -31,7 +36,10 @@ class CallbackWrapper:
 
     def check_expired(self):
         if datetime.now() > (timedelta(milliseconds=self.valid_for) + self.created_on):
-            self.promise.complete(error='Timeout', result=Exception('Timeout'))
+            self.expire()
+
+    def expire(self):
+        self.promise.complete(error='Timeout', result=Exception('Timeout'))
 
     def execute_callback(self, result):
         if self.callback:
@@ -42,14 +50,159 @@ class CallbackWrapper:
         self.promise.complete(result=result)
 
 
+def batch(messages):
+    """Builds a batch message that carries *messages* (commands or tasks). The
+    node executes them in order and answers with a single ``batch-reply``.
+    """
+    return message().header('type', 'batch').value('messages', list(messages)).build()
+
+
+class MessageBatcher:
+    """Coalesces the messages sent over a channel into batch messages.
+
+    A batch is sent when *max_size* messages are queued, or *window*
+    milliseconds after the first message was queued, whichever comes first. A
+    single queued message is sent as is. *schedule(delay, callback)* runs the
+    window timer, by default on the shared timer scheduler.
+    """
+
+    def __init__(self, channel, max_size=16, window=5, schedule=None):
+        self.channel = channel
+        self.max_size = max_size
+        self.window = window
+        self.schedule = schedule or call_later
+        self.queue = []
+        self.timer = None
+        self.lock = Lock()
+
+    def send_message(self, msg):
+        with self.lock:
+            self.queue.append(msg)
+            if len(self.queue) < self.max_size:
+                if not self.timer:
+                    self.timer = self.schedule(self.window, self.flush)
+                return
+            messages = self.__take()
+        self.__send(messages)
+
+    def flush(self):
+        with self.lock:
+            messages = self.__take()
+        self.__send(messages)
+
+    def __take(self):
+        messages = self.queue
+        self.queue = []
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        return messages
+
+    def __send(self, messages):
+        if len(messages) == 1:
+            self.channel.send_message(messages[0])
+        elif messages:
+            self.channel.send_message(batch(messages))
+
+
+class TaskOutputSubscriber:
+    """Client end of a ``task-subscribe`` stream of the output of a task.
+
+    *on_output* is called with the offset and the bytes of every chunk of
+    output, and *on_end* with the return code of the process once all of the
+    output was received. After every ``credits // 2`` chunks handled, the
+    node is granted as many new credits, so a slow *on_output* slows down
+    the node instead of making it buffer.
+
+    :attr:`offset` follows the last byte received; subscribing again from it
+    resumes the stream. :attr:`lost` counts the bytes that were overwritten
+    on the node before they could be sent.
+    """
+
+    def __init__(self, client, node, task_id, on_output, on_end=None, stream='stdout', offset=0, credits=8,
+                 chunk_size=None):
+        self.id = str(uuid4())
+        self.client = client
+        self.node = node
+        self.task_id = task_id
+        self.on_output = on_output
+        self.on_end = on_end
+        self.stream = stream
+        self.offset = offset
+        self.credits = credits
+        self.chunk_size = chunk_size
+        self.handled = 0
+        self.lost = 0
+        self.ended = False
+        self.returncode = None
+        self.promise = None
+
+    def subscribe(self):
+        self.promise = self.client.send_message_to_node(CommandAPI.command('task-subscribe', {
+            'subscription': self.id,
+            'task-id': self.task_id,
+            'stream': self.stream,
+            'offset': self.offset,
+            'credits': self.credits,
+            'chunk-size': self.chunk_size
+        }), self.node, None)
+        return self.promise
+
+    def unsubscribe(self):
+        self.client.subscriptions.pop(self.id, None)
+        return self.client.send_message_to_node(CommandAPI.command('task-unsubscribe', {'subscription': self.id}),
+                                                self.node, None)
+
+    def on_message(self, msg):
+        chunk = msg.data
+        if chunk.get('eof'):
+            self.ended = True
+            self.returncode = chunk.get('returncode')
+            self.client.subscriptions.pop(self.id, None)
+            if self.on_end:
+                self.on_end(self.returncode)
+            return
+        data = chunk.get('data') or b''
+        if chunk.get('encoding') == 'base64':
+            data = b64decode(data)
+        if chunk['offset'] > self.offset:
+            self.lost += chunk['offset'] - self.offset
+        try:
+            self.on_output(chunk['offset'], data)
+        except Exception:
+            logging.exception('Output callback failed')
+        self.offset = chunk['offset'] + len(data)
+        self.handled += 1
+        if self.handled >= max(1, self.credits // 2):
+            self.client.send_message_to_node(CommandAPI.command('task-credit', {
+                'subscription': self.id,
+                'credits': self.handled
+            }), self.node, None)
+            self.handled = 0
+
+
 class ChannelClient:
-    def __init__(self, nodes_specs=None, reply_timeout=5000, check_interval=5000):
+    """Sends messages to nodes and matches the replies to the sent messages.
+
+    Requests waiting for a reply are kept in an :class:`troup.threading.ExpiryHeap`.
+    They are removed when the reply arrives, or completed with a timeout error
+    exactly *reply_timeout* milliseconds after being sent. *check_interval* is
+    no longer used and is kept for compatibility.
+
+    With *batch_size* greater than 1 the messages sent to a node are coalesced
+    into batch messages by a :class:`MessageBatcher`, flushed after at most
+    *batch_window* milliseconds.
+    """
+    def __init__(self, nodes_specs=None, reply_timeout=5000, check_interval=5000, batch_size=1, batch_window=5):
         self.nodes_ref = {}
         self.channels = {}
-        self.callbacks = {}
-        self.reply_timeout = reply_timeout
+        self.batchers = {}
+        self.subscriptions = {}
+        self.callbacks = ExpiryHeap(on_expired=self.__on_reply_timeout)
+        self.reply_timeout = int(reply_timeout)
         self.check_interval = check_interval
-        self.maintenance_timer = self.__build_timer()
+        self.batch_size = int(batch_size)
+        self.batch_window = int(batch_window)
         self.__build_nodes_refs__(nodes_specs)
 
     def __build_nodes_refs__(self, nodes_specs):
@@ -57,36 +210,44 @@ class ChannelClient:
             parsed = spec.partition(':')
             self.nodes_ref[parsed[0]] = parsed[2]
 
-    def __build_timer(self):
-        timer = IntervalTimer(interval=self.check_interval, offset=self.check_interval,
-                              target=self.__check_expired_callbacks)
-        timer.start()
-        return timer
-
-    def __check_expired_callbacks(self):
-        for msgid, wrapper in self.callbacks.items():
-            wrapper.check_expired()
+    def __on_reply_timeout(self, msgid, wrapper):
+        wrapper.expire()
 
     def __reg_wrapper(self, message, callback):
-        wrapper = CallbackWrapper(callback=callback, valid_for=5000)
-        self.callbacks[message.id] = wrapper
+        wrapper = CallbackWrapper(callback=callback, valid_for=self.reply_timeout)
+        self.callbacks.add(message.id, wrapper, self.reply_timeout)
         return wrapper
 
     def __on_channel_data(self, data, channel):
         msg = deserialize(data, Message)
         if msg.headers.get('type') == 'reply':
             self.__process_reply(msg)
+        elif msg.headers.get('type') == 'batch-reply':
+            self.__process_batch_reply(msg)
+        elif msg.headers.get('type') == 'task-output':
+            subscriber = self.subscriptions.get(msg.headers.get('subscription'))
+            if subscriber:
+                subscriber.on_message(msg)
 
     def __process_reply(self, reply):
         id = reply.headers.get('reply-for')
         if not id:
             raise Exception('Invalid reply %s' % reply)
-        wrapper = self.callbacks.get(id)
+        self.__complete(id, reply.data.get('reply'), reply.data.get('error'))
+
+    def __process_batch_reply(self, reply):
+        replies = reply.data.get('replies') or []
+        for item in replies:
+            self.__complete(item.get('reply-for'), item.get('reply'), item.get('error'))
+        self.__complete(reply.headers.get('reply-for'), replies, None)
+
+    def __complete(self, id, reply, error):
+        wrapper = self.callbacks.remove(id)
         if wrapper:
-            if reply.data.get('error'):
-                wrapper.promise.complete(error=reply.data.get('reply'))
+            if error:
+                wrapper.promise.complete(error=reply)
             else:
-                wrapper.promise.complete(result=reply.data.get('reply'))
+                wrapper.promise.complete(result=reply)
 
     def send_message(self, message, to_node=None, on_reply=None):
         def reply_callback_wrapper(*args, **kwargs):
@@ -122,10 +283,30 @@ class ChannelClient:
     def send_message_to_node(self, message, node, on_reply):
         channel = self.get_channel(node)
         wrapper = self.__reg_wrapper(message=message, callback=on_reply)
-        ser_message = serialize(message)
-        channel.send(ser_message)
+        if self.batch_size > 1:
+            channel = self.get_batcher(node, channel)
+        channel.send_message(message)
         return wrapper.promise
 
+    def get_batcher(self, node, channel):
+        batcher = self.batchers.get(node)
+        if not batcher or batcher.channel is not channel:
+            batcher = self.batchers[node] = MessageBatcher(channel, max_size=self.batch_size,
+                                                           window=self.batch_window)
+        return batcher
+
+    def subscribe_task_output(self, node, task_id, on_output, on_end=None, stream='stdout', offset=0, credits=8,
+                              chunk_size=None):
+        """Streams the output of a task running on *node*. Returns the
+        :class:`TaskOutputSubscriber`; its ``promise`` is completed with the
+        reply of the node to the subscription.
+        """
+        subscriber = TaskOutputSubscriber(self, node, task_id, on_output, on_end=on_end, stream=stream,
+                                          offset=offset, credits=credits, chunk_size=chunk_size)
+        self.subscriptions[subscriber.id] = subscriber
+        subscriber.subscribe()
+        return subscriber
+
     def get_channel(self, for_node):
         channel = self.channels.get(for_node)
         if not channel:
@@ -151,9 +332,13 @@ class ChannelClient:
         return chn
 
     def shutdown(self):
+        for batcher in self.batchers.values():
+            batcher.flush()
+        self.batchers = {}
+        self.subscriptions = {}
         for name, channel in self.channels.items():
             channel.close()
-        self.maintenance_timer.cancel()
+        self.callbacks.clear()
 
 
 def client_to_local_node():
@@ -172,19 +357,237 @@ class CommandAPI:
     def monitor(self, command_ref):
         pass
 
+    @staticmethod
     def command(name, data):
         return message(data=data).header('type', 'command').header('command', name).build()
 
-    def task(type, data, ttl=None, track_out=False, buffer=None):
+    @staticmethod
+    def task(type, data, ttl=None, track_out=False, buffer=None, priority=None):
         return message().header('type', 'task').header('ttl', ttl).\
             header('task-type', 'process').header('process-type', type).\
             header('consume-out', track_out).header('buffer-size', buffer).\
-            value('process', data).build()
+            header('priority', priority).value('process', data).build()
+
+    @staticmethod
+    def function(function, args=(), kwargs=None, ttl=None, timeout=None, priority=None):
+        """A task calling *function* on the node, in a worker process. See
+        :func:`troup.tasks.function_task_data`. *timeout* is in milliseconds.
+        """
+        return message().header('type', 'task').header('ttl', ttl).\
+            header('task-type', 'function').header('timeout', timeout).\
+            header('priority', priority).data(function_task_data(function, args, kwargs)).build()
+
+    @staticmethod
+    def batch(messages):
+        return batch(messages)
+
+    def subscribe(self, task_id, to_node, on_output, on_end=None, stream='stdout', offset=0, credits=8):
+        return self.channel_client.subscribe_task_output(to_node, task_id, on_output, on_end=on_end, stream=stream,
+                                                         offset=offset, credits=credits)
 
     def shutdown(self):
         self.channel_client.shutdown()
 
 
+class AsyncChannelClient:
+    """asyncio version of :class:`ChannelClient`.
+
+    All requests to a node are multiplexed over a single channel, and every
+    request is a future resolved by the reply with the matching id - no thread
+    is started per request. The channels are ws4py client connections: the
+    received frames are handed over to the event loop and the connection is
+    opened in the default executor.
+
+    The coroutines must be awaited on *loop*. For callers without an event loop,
+    :meth:`run_in_thread` runs the loop in a background thread and
+    :meth:`send_message` returns a :class:`troup.distributed.Promise`, so the
+    client can be wrapped by :class:`CommandAPI`.
+
+    *batch_size* and *batch_window* coalesce requests into batch messages, the
+    same way as in :class:`ChannelClient`. The window timer runs on the loop.
+    """
+
+    def __init__(self, nodes_specs=None, reply_timeout=5000, loop=None, batch_size=1, batch_window=5):
+        self.nodes_ref = {}
+        self.channels = {}
+        self.connecting = {}
+        self.pending = {}
+        self.batchers = {}
+        self.reply_timeout = int(reply_timeout)
+        self.batch_size = int(batch_size)
+        self.batch_window = int(batch_window)
+        self.loop = loop or asyncio.new_event_loop()
+        self.loop_thread = None
+        self.log = logging.getLogger(self.__class__.__name__)
+        for spec in nodes_specs or []:
+            name, sep, ref = spec.partition(':')
+            self.nodes_ref[name] = ref
+
+    async def send(self, message, to_node=None):
+        """Sends the message to *to_node*, or to all nodes, and returns the reply.
+        When sent to more than one node the result is ``True``.
+        """
+        if to_node:
+            return await self.send_to_node(message, to_node)
+        results = await asyncio.gather(*[self.send_to_node(message, name) for name in self.nodes_ref])
+        if len(results) == 1:
+            return results[0]
+        return True
+
+    async def send_to_node(self, message, node):
+        """Sends the message to *node* and returns its reply. The replies are
+        matched by node and message id, so the same message can be sent to
+        several nodes at once.
+        """
+        channel = await self.get_channel(node)
+        reply = self.loop.create_future()
+        self.pending[(node, message.id)] = reply
+        if self.batch_size > 1:
+            channel = self.get_batcher(node, channel)
+        try:
+            channel.send_message(message)
+            return await asyncio.wait_for(reply, self.reply_timeout/1000)
+        except asyncio.TimeoutError:
+            raise DistributedException('Timeout')
+        finally:
+            self.pending.pop((node, message.id), None)
+
+    def get_batcher(self, node, channel):
+        batcher = self.batchers.get(node)
+        if not batcher or batcher.channel is not channel:
+            batcher = self.batchers[node] = MessageBatcher(
+                channel, max_size=self.batch_size, window=self.batch_window,
+                schedule=lambda delay, callback: self.loop.call_later(delay/1000, callback))
+        return batcher
+
+    async def get_channel(self, node):
+        channel = self.channels.get(node)
+        if channel:
+            return channel
+        opening = self.connecting.get(node)
+        if not opening:
+            opening = self.connecting[node] = asyncio.ensure_future(self.__open_channel(node), loop=self.loop)
+        return await asyncio.shield(opening)
+
+    async def __open_channel(self, node):
+        try:
+            ref = self.nodes_ref.get(node)
+            if not ref:
+                raise Exception('Unknown node reference [%s]' % node)
+            channel = self.create_channel(node, ref)
+            await self.loop.run_in_executor(None, channel.open)
+            self.channels[node] = channel
+            return channel
+        finally:
+            del self.connecting[node]
+
+    def create_channel(self, node_name, reference):
+        chn = OutgoingChannelOverWS(node_name, reference)
+
+        def on_data(data):
+            self.loop.call_soon_threadsafe(self.__on_channel_data, node_name, data)
+
+        chn.register_listener(on_data)
+        return chn
+
+    def __on_channel_data(self, node, data):
+        try:
+            msg = deserialize(data, Message)
+        except Exception as e:
+            self.log.exception('Invalid message: %s', e)
+            return
+        if msg.headers.get('type') == 'reply':
+            self.__complete(node, msg.headers.get('reply-for'), msg.data.get('reply'), msg.data.get('error'))
+        elif msg.headers.get('type') == 'batch-reply':
+            replies = msg.data.get('replies') or []
+            for item in replies:
+                self.__complete(node, item.get('reply-for'), item.get('reply'), item.get('error'))
+            self.__complete(node, msg.headers.get('reply-for'), replies, None)
+
+    def __complete(self, node, id, reply, error):
+        future = self.pending.pop((node, id), None)
+        if future and not future.done():
+            if error:
+                future.set_exception(DistributedException(reply))
+            else:
+                future.set_result(reply)
+
+    async def close(self):
+        for batcher in self.batchers.values():
+            batcher.flush()
+        self.batchers = {}
+        for name, channel in list(self.channels.items()):
+            channel.close()
+        self.channels = {}
+        for reply in self.pending.values():
+            reply.cancel()
+
+    # -- for callers outside of the event loop
+
+    def run_in_thread(self):
+        """Runs the event loop of this client in a background thread."""
+        if not self.loop_thread:
+            self.loop_thread = Thread(target=self.loop.run_forever, name='AsyncChannelClient', daemon=True)
+            self.loop_thread.start()
+        return self
+
+    def send_message(self, message, to_node=None, on_reply=None):
+        """Thread-safe send for callers outside the event loop. Returns a
+        :class:`troup.distributed.Promise`. Must not be called from the loop
+        thread itself.
+        """
+        promise = Promise()
+        future = asyncio.run_coroutine_threadsafe(self.send(message, to_node), self.loop)
+
+        def on_done(f):
+            try:
+                result = f.result()
+            except Exception as e:
+                promise.complete(error=str(e), result=e)
+                return
+            if on_reply:
+                on_reply(result)
+            promise.complete(result=result)
+
+        future.add_done_callback(on_done)
+        return promise
+
+    def shutdown(self):
+        if self.loop_thread:
+            asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop_thread = None
+        elif not self.loop.is_running():
+            self.loop.run_until_complete(self.close())
+
+
+class AsyncCommandAPI:
+    """Command API for :class:`AsyncChannelClient`. All calls are coroutines."""
+
+    def __init__(self, channel_client):
+        self.channel_client = channel_client
+
+    async def send(self, command, to_node=None):
+        return await self.channel_client.send(command, to_node=to_node)
+
+    async def command(self, name, data=None, to_node=None):
+        return await self.send(CommandAPI.command(name, data), to_node=to_node)
+
+    async def task(self, type, data, ttl=None, track_out=False, buffer=None, to_node=None, priority=None):
+        return await self.send(CommandAPI.task(type, data, ttl=ttl, track_out=track_out, buffer=buffer,
+                                               priority=priority),
+                               to_node=to_node)
+
+    async def function(self, function, args=(), kwargs=None, ttl=None, timeout=None, to_node=None, priority=None):
+        return await self.send(CommandAPI.function(function, args, kwargs, ttl=ttl, timeout=timeout,
+                                                   priority=priority),
+                               to_node=to_node)
+
+    async def shutdown(self):
+        await self.channel_client.close()
+
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     from json import loads, dumps
@@ -197,7 +600,8 @@ if __name__ == '__main__':
     parser.add_argument('-H', '--header', nargs='+', help='Message headers in the form HEADER_NAME=VALUE.')
 
     parser.add_argument('--reply-timeout', default=5000, help='Message reply timeout in milliseconds.')
-    parser.add_argument('--check-interval', default=1000, help='Interval to check for timeouts in milliseconds.')
+    parser.add_argument('--check-interval', default=1000,
+                        help='Deprecated. Replies time out exactly after --reply-timeout.')
 
     parser.add_argument('-c', '--command', help='The command name. Used only when type is "command".')
 
@@ -22,6 +22,12 @@ def print_threads(cmd):
         print(th)
 
 
+def print_timer_stats(cmd):
+    from troup.threading import default_scheduler
+    for name, value in sorted(default_scheduler().stats().items()):
+        print('%15s: %s' % (name, value))
+
+
 def print_help(cmd):
     for cmd_name, entry in DBG_HANDLERS.items():
         desc, hnd = entry
@@ -36,6 +42,7 @@ class ExitCliException(Exception):
 
 DBG_HANDLERS = {
     'pt': ('Print Threads', print_threads),
+    'ts': ('Print timer scheduler stats', print_timer_stats),
     '?': ('Prints this help message', print_help),
     'help': ('Prints this help message', print_help),
     'q': ('Quits the debug cli', quit_cli),
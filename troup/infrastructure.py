@@ -17,8 +17,13 @@ __author__ = 'pavle'
 from types import FunctionType
 from types import MethodType
 from troup.observer import Observable
+from troup.messaging import message, serialize, deserialize, json_codec, negotiate_codec, PREFERRED_CODECS
 import logging
-from queue import Queue
+from queue import Queue, Empty
+
+
+CODEC_OFFER = 'codec-offer'
+CODEC_ACCEPT = 'codec-accept'
 
 
 class ChannelError(Exception):
@@ -44,6 +49,7 @@ class Channel:
         self.listeners = []
         self.event_listeners = {}
         self.to_url = to_url
+        self.codec = json_codec
         self.log = logging.getLogger(self.__class__.__name__)
 
     def open(self):
@@ -90,6 +96,16 @@ class Channel:
     def send(self, data):
         self.log.debug('[CH<Channel>: %s]: empty send' % self.name)
 
+    def send_message(self, msg):
+        """Serializes the message with the codec negotiated for this channel
+        and sends it.
+        """
+        self.send(self.codec.encode(msg))
+
+    def set_codec(self, codec):
+        self.log.debug('[CH: %s]: using codec %s' % (self.name, codec.name))
+        self.codec = codec
+
     def data_received(self, data):
         for listener in self.listeners:
             try:
@@ -135,15 +151,33 @@ class ListenerWrapper:
 
 
 from ws4py.async_websocket import WebSocket
-from threading import Event
+from threading import Event, Lock
+from collections import deque
 
 
 class IncommingChannel(Channel):
+    """Channel opened by a peer to the server of this node.
+
+    Sent frames are put in an outbound queue that is drained on the event loop
+    of the server, so sending is safe from any thread. All frames queued until
+    the drain runs are written to the transport at once. :meth:`stats` reports
+    the depth of the queue and the number of frames and bytes sent.
+    """
 
-    def __init__(self, name, to_url, adapter=None):
+    def __init__(self, name, to_url, adapter=None, codecs=None):
         super(IncommingChannel, self).__init__(name, to_url)
         self.adapter = adapter
         self.close_event = Event()
+        self.codecs = codecs or PREFERRED_CODECS
+        self._first_frame = True
+        self.outbound = deque()
+        self.outbound_lock = Lock()
+        self.drain_scheduled = False
+        self.queued_bytes = 0
+        self.max_queue_depth = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.drains = 0
 
     def disconnect(self):
         self.adapter.close(code=1000, reason="client-closing")
@@ -154,10 +188,72 @@ class IncommingChannel(Channel):
         self.close_event.set()
 
     def send(self, data):
-        if self.status is Channel.OPEN:
-            self.adapter.send(payload=data)
-        else:
+        if self.status is not Channel.OPEN:
             raise ChannelError('Not open')
+        binary = isinstance(data, (bytes, bytearray))
+        if not binary:
+            data = data.encode('utf-8')
+        with self.outbound_lock:
+            self.outbound.append((data, binary))
+            self.queued_bytes += len(data)
+            if len(self.outbound) > self.max_queue_depth:
+                self.max_queue_depth = len(self.outbound)
+            if self.drain_scheduled:
+                return
+            self.drain_scheduled = True
+        server = getattr(self.adapter, 'server', None)
+        if server:
+            server.aio_loop.call_soon_threadsafe(self._drain_)
+        else:
+            self._drain_()
+
+    def _drain_(self):
+        with self.outbound_lock:
+            frames = self.outbound
+            sent_bytes = self.queued_bytes
+            self.outbound = deque()
+            self.queued_bytes = 0
+            self.drain_scheduled = False
+        if not frames:
+            return
+        self.drains += 1
+        self.frames_sent += len(frames)
+        self.bytes_sent += sent_bytes
+        self.adapter.send_frames(frames)
+
+    def stats(self):
+        with self.outbound_lock:
+            return {
+                'queue_depth': len(self.outbound),
+                'queued_bytes': self.queued_bytes,
+                'max_queue_depth': self.max_queue_depth,
+                'frames_sent': self.frames_sent,
+                'bytes_sent': self.bytes_sent,
+                'drains': self.drains
+            }
+
+    def data_received(self, data):
+        if self._first_frame:
+            # the peer may offer codecs only in its very first frame
+            self._first_frame = False
+            if self._handle_codec_offer(data):
+                return
+        super(IncommingChannel, self).data_received(data)
+
+    def _handle_codec_offer(self, data):
+        if not isinstance(data, str):
+            return False
+        try:
+            msg = deserialize(data)
+        except Exception:
+            return False
+        if msg.headers.get('type') != CODEC_OFFER:
+            return False
+        codec = negotiate_codec((msg.data or {}).get('codecs'), self.codecs)
+        # the accept is sent with the old codec, the new one applies after it
+        self.send(serialize(message().header('type', CODEC_ACCEPT).value('codec', codec.name).build()))
+        self.set_codec(codec)
+        return True
 
 
 class IncomingChannelWSAdapter(WebSocket):
@@ -174,7 +270,8 @@ class IncomingChannelWSAdapter(WebSocket):
             self.channel = IncommingChannel(
                 name="channel[%s-%s]" % (self.local_address, self.peer_address),
                 to_url=str(self.peer_address),
-                adapter=self)
+                adapter=self,
+                codecs=self.server.codecs)
             self.channel.open()
             self.server.on_channel_open(self.channel)
         except Exception as e:
@@ -186,11 +283,27 @@ class IncomingChannelWSAdapter(WebSocket):
         self.channel.notify_close()
         self.server.on_channel_closed(self.channel)
 
+    def send_frames(self, frames):
+        """Writes the (data, binary) frames to the transport in a single write.
+        Must be called on the event loop.
+        """
+        transport = self.proto.writer.transport
+        if transport.is_closing():
+            return
+        self.proto.writer.write(b''.join([self.__frame(data, binary) for data, binary in frames]))
+
+    def __frame(self, data, binary):
+        message_sender = self.stream.binary_message if binary else self.stream.text_message
+        return message_sender(data).single(mask=self.stream.always_mask)
+
     def received_message(self, message):
         #print(' -> %s' % str(message))
         #print('Message is text %s - data[%s]' % (message.is_text,message.data))
         try:
-            self.channel.data_received(str(message))
+            if message.is_text:
+                self.channel.data_received(str(message))
+            else:
+                self.channel.data_received(message.data)
         except Exception as e:
             logging.exception(e)
 
@@ -232,11 +345,12 @@ import asyncio
 
 class AsyncIOWebSocketServer:
 
-    def __init__(self, host='', port=1700, web_socket_class=IncomingChannelWSAdapter):
+    def __init__(self, host='', port=1700, web_socket_class=IncomingChannelWSAdapter, codecs=None):
         self.host = host
         self.port = port
         self.web_socket_class = web_socket_class
-        self.aio_loop = asyncio.get_event_loop()
+        self.codecs = codecs or PREFERRED_CODECS
+        self.aio_loop = asyncio.new_event_loop()
         self.running = False
         self.channels = {}
         self.listeners = []
@@ -251,7 +365,7 @@ class AsyncIOWebSocketServer:
         s = self.aio_loop.run_until_complete(sf)
         self.server_address = s.sockets[0].getsockname()
         self.log.info('Server stared on %s' % str(s.sockets[0].getsockname()))
-        self.aio_sf = sf
+        self.aio_sf = s
         self.aio_loop.run_forever()
         self.aio_loop.close()
         self.log.debug('Async Event loop closed.')
@@ -259,7 +373,8 @@ class AsyncIOWebSocketServer:
 
     def stop(self):
         def stop_server_and_loop():
-            self.aio_sf.close()
+            if self.aio_sf:
+                self.aio_sf.close()
             self.aio_loop.stop()
             self.log.debug('Server closed. Event loop notified for stop.')
         self.aio_loop.call_soon_threadsafe(stop_server_and_loop)
@@ -270,7 +385,7 @@ class AsyncIOWebSocketServer:
         self.notify_event('channel.open', channel)
 
     def on_channel_closed(self, channel):
-        del self.channels[channel]
+        self.channels.pop(channel.name, None)
         self.notify_event('channel.closed', channel)
 
     def on_event(self, callback):
@@ -315,7 +430,7 @@ class OutgoingChannelWSAdapter(WebSocketClient):
 
 class OutgoingChannelOverWS(Channel):
     
-    def __init__(self, name, to_url, early_messages='queue', queue_max_size=1000):
+    def __init__(self, name, to_url, early_messages='queue', queue_max_size=1000, codecs=None):
         super(OutgoingChannelOverWS, self).__init__(name, to_url)
         self.web_socket = OutgoingChannelWSAdapter(url=to_url,
                                                    handlers={
@@ -326,6 +441,12 @@ class OutgoingChannelOverWS(Channel):
         self._early_messages = early_messages
         self._queue_max_size = queue_max_size
         self.queue = None
+        self.codecs = codecs or PREFERRED_CODECS
+        self._awaiting_codec = self.codecs != [json_codec.name]
+        # ws4py calls opened() on its own thread after connect() returns; until
+        # then the frames are held back so that the codec offer goes first
+        self._opened = False
+        self._opened_lock = Lock()
         self.__setup_early_strategy()
         
     def __setup_early_strategy(self):
@@ -334,16 +455,47 @@ class OutgoingChannelOverWS(Channel):
     
     def __handle_early_messages(self):
         if self._early_messages == 'queue':
-            while not self.queue.empty():
-                msg = self.queue.get_nowait()
-                self.send(msg)
+            while True:
+                try:
+                    msg = self.queue.get_nowait()
+                except Empty:
+                    return
+                self.__send_now(msg)
                 
     
     def _on_open_handler_(self):
         self.trigger('open', self)
+        with self._opened_lock:
+            self.__offer_codecs()
+            self.__handle_early_messages()
+            self._opened = True
+        # the frames queued while the lock was held
         self.__handle_early_messages()
         self.on_opened()
 
+    def __offer_codecs(self):
+        if not self._awaiting_codec:
+            return
+        offer = message().header('type', CODEC_OFFER).value('codecs', self.codecs).build()
+        self.web_socket.send(payload=serialize(offer))
+
+    def data_received(self, data):
+        if self._awaiting_codec and isinstance(data, str) and self.__handle_codec_accept(data):
+            return
+        super(OutgoingChannelOverWS, self).data_received(data)
+
+    def __handle_codec_accept(self, data):
+        try:
+            msg = deserialize(data)
+        except Exception:
+            return False
+        if msg.headers.get('type') != CODEC_ACCEPT:
+            return False
+        self._awaiting_codec = False
+        codec_name = (msg.data or {}).get('codec')
+        self.set_codec(negotiate_codec([codec_name], self.codecs))
+        return True
+
     def on_opened(self):
         pass
 
@@ -366,15 +518,26 @@ class OutgoingChannelOverWS(Channel):
         self.web_socket.close()
 
     def send(self, data):
-        if self.status == Channel.OPEN:
-            try:
-                self.web_socket.send(payload=data)
-            except (ConnectionRefusedError, ConnectionAbortedError, ConnectionResetError) as e:
-                raise ChannelClosedError() from e
-        elif self.status in [Channel.CREATED, Channel.CONNECTING]:
+        if self.status == Channel.OPEN and self._opened:
+            self.__send_now(data)
+        elif self.status in [Channel.CREATED, Channel.CONNECTING, Channel.OPEN]:
+            with self._opened_lock:
+                early = not self._opened and (self.status != Channel.OPEN or self._early_messages == 'queue')
+            if not early:
+                self.__send_now(data)
+                return
             self.__send_early(data)
+            if self._opened:
+                # opened() may have drained the queue just before the put
+                self.__handle_early_messages()
         else:
             raise ChannelClosedError('Cannot send: invalid channel status')
+
+    def __send_now(self, data):
+        try:
+            self.web_socket.send(payload=data, binary=isinstance(data, (bytes, bytearray)))
+        except (ConnectionRefusedError, ConnectionAbortedError, ConnectionResetError) as e:
+            raise ChannelClosedError() from e
     
     def __send_early(self, data):
         if self._early_messages == 'queue':
@@ -388,10 +551,11 @@ class OutgoingChannelOverWS(Channel):
 
 class ChannelManager(Observable):
 
-    def __init__(self, aio_server):
+    def __init__(self, aio_server, codecs=None):
         #self.config = config
         super(ChannelManager, self).__init__()
         self.aio_server = aio_server
+        self.codecs = codecs
         self.channels = {}
         self.by_url = {}
         self.log = logging.getLogger('channel-manager')
@@ -421,7 +585,7 @@ class ChannelManager(Observable):
         return channel
 
     def open_channel_to(self, name, url):
-        och = OutgoingChannelOverWS(name=name, to_url=url)
+        och = OutgoingChannelOverWS(name=name, to_url=url, codecs=self.codecs)
         self._on_open_channel_(och)
         try:
             och.open()
@@ -433,6 +597,15 @@ class ChannelManager(Observable):
     def close_channel(self, name=None, endpoint=None):
         pass
 
+    def shutdown(self):
+        for name, channel in list(self.channels.items()):
+            try:
+                channel.close()
+            except ChannelError as e:
+                self.log.debug('Failed to close channel %s: %s' % (name, e))
+        self.channels = {}
+        self.by_url = {}
+
     def _on_open_channel_(self, channel):
         channel.on('channel.closed', self._handle_closed_channel_)
 
@@ -462,6 +635,14 @@ class ChannelManager(Observable):
             channel.close()
             self._handle_closed_channel_(channel, 1006, str(e))
 
+    def send_message(self, name=None, to_url=None, message=None):
+        channel = self.channel(name, to_url)
+        try:
+            channel.send_message(message)
+        except ChannelClosedError as e:
+            channel.close()
+            self._handle_closed_channel_(channel, 1006, str(e))
+
     def on_data(self, callback, from_channel=None):
         def actual_callback_no_filter(data, chn):
             callback(data)
@@ -30,9 +30,46 @@ def configure_node_parser():
     
     # Store
     parser.add_argument('--storage-root', default='.data', help='Root path of the storage directory')
+    parser.add_argument('--store-backend', default='files', choices=['files', 'journal'],
+                        help='Keep the apps and settings in JSON files or in an append-only journal')
+    parser.add_argument('--store-compact-size', default=1024*1024,
+                        help='Size in bytes of the store journal after which it is compacted to a snapshot')
+    parser.add_argument('--store-flush-delay', default=1000,
+                        help='Milliseconds for which store changes are gathered into one write (0 to write at once)')
     
     # System statistics
     parser.add_argument('--stats-update-interval', default=30000, help='Statistics update interval in milliseconds')
+
+    # Membership
+    parser.add_argument('--probe-interval', default=1000, help='Failure detection probe interval in milliseconds')
+    parser.add_argument('--probe-fan-out', default=3, help='Number of nodes asked to probe an unresponsive node')
+    parser.add_argument('--suspect-timeout', default=5000,
+                        help='Time in milliseconds before a suspected node is considered failed')
+
+    # Command execution
+    parser.add_argument('--executor-workers', default=8, help='Number of threads that execute commands and tasks')
+    parser.add_argument('--run-app-limit', default=2, help='Maximal number of concurrent run-app commands')
+    parser.add_argument('--max-processes', default=64,
+                        help='Maximal number of concurrently running process tasks (0 for no limit)')
+    parser.add_argument('--min-processes', default=16,
+                        help='Number of process task slots kept when the node is idle')
+    parser.add_argument('--min-workers', default=3, help='Number of task worker threads kept when the node is idle')
+    parser.add_argument('--max-workers', default=None, help='Maximal number of task worker threads')
+    parser.add_argument('--code-workers', default=0,
+                        help='Number of worker processes that run code tasks (default: one per cpu)')
+    parser.add_argument('--code-max-tasks', default=100,
+                        help='Number of code tasks after which a code worker process is replaced')
+    parser.add_argument('--zygote', action='store_true',
+                        help='Fork Python process tasks from a pre-imported zygote process')
+    parser.add_argument('--zygote-workers', default=16,
+                        help='Maximal number of Python processes forked from the zygote at a time')
+    parser.add_argument('--zygote-preload', default='', help='Comma separated modules to import in the zygote')
+    parser.add_argument('--no-ssh-multiplex', action='store_true',
+                        help='Do not share ssh master connections between remote processes')
+    parser.add_argument('--ssh-idle-timeout', default=300000,
+                        help='Time in milliseconds after which an unused ssh master connection is closed')
+    parser.add_argument('--remote-launch', default='forward', choices=['forward', 'ssh'],
+                        help='Launch apps on other nodes by forwarding them as tasks to the node, or over ssh')
     
     parser.add_argument('--log-level', '-l', default='info', help='Logging level')
 
@@ -60,7 +97,10 @@ def run_node():
     
     config = {
         'store': {
-            'path': args.storage_root
+            'path': args.storage_root,
+            'flush-delay': args.store_flush_delay,
+            'backend': args.store_backend,
+            'compact-size': args.store_compact_size
         },
         'server': {
             'hostname': args.host,
@@ -69,9 +109,32 @@ def run_node():
         'stats': {
             'update_interval': args.stats_update_interval
         },
+        'membership': {
+            'probe_interval': args.probe_interval,
+            'fan_out': args.probe_fan_out,
+            'suspect_timeout': args.suspect_timeout
+        },
+        'executor': {
+            'workers': args.executor_workers,
+            'limits': {'run-app': int(args.run_app_limit)}
+        },
+        'runner-max-processes': args.max_processes,
+        'runner-min-processes': args.min_processes,
+        'runner-min-workers': args.min_workers,
+        'code-workers': args.code_workers,
+        'code-max-tasks': args.code_max_tasks,
+        'ssh': {
+            'multiplex': not args.no_ssh_multiplex,
+            'idle-timeout': args.ssh_idle_timeout
+        },
+        'remote': {'launch': args.remote_launch},
         'neighbours': args.neighbours,
         'lock': args.lock
     }
+    if args.zygote:
+        config['zygote'] = {'workers': args.zygote_workers, 'preload': args.zygote_preload}
+    if args.max_workers:
+        config['runner-max-workers'] = args.max_workers
     node = Node(node_id=args.node, config=config)
     
     def handle_node_shutdown(signal, frame):
@@ -0,0 +1,291 @@
+# Copyright 2016 Pavle Jonoski
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = 'pavle'
+
+from troup.infrastructure import ChannelError
+from troup.messaging import message
+from troup.threading import IntervalTimer, AtomicIncrement, call_later
+from threading import RLock
+from math import ceil, log
+from time import time
+import random
+import logging
+
+
+class FailureDetector:
+    """SWIM style failure detector for the nodes known to the
+    :class:`troup.node.SyncManager`.
+
+    On every probe interval one node is picked (round-robin over a shuffled list
+    of the known nodes) and pinged. If no ack arrives within *ack_timeout*,
+    *fan_out* other nodes are asked to ping it on our behalf (ping-req). If there
+    is still no ack at the end of the probe interval the node is suspected. A
+    suspected node that does not refute the suspicion within *suspect_timeout*
+    is confirmed as failed and removed from the known nodes.
+
+    Suspect, alive and confirm updates are piggybacked on the ping and ack
+    messages - at most *max_piggyback* per message, each retransmitted about
+    ``3 * log(n)`` times. The failure detection traffic per node is constant
+    and does not grow with the size of the cluster.
+
+    The ping, ping-req and ack messages are taken, already decoded, from the
+    message *bus* of the node.
+
+    All intervals are in milliseconds.
+    """
+
+    ALIVE = 'alive'
+    SUSPECT = 'suspect'
+    CONFIRM = 'confirm'
+
+    PING = 'swim-ping'
+    PING_REQ = 'swim-ping-req'
+    ACK = 'swim-ack'
+
+    MESSAGE_TYPES = (PING, PING_REQ, ACK)
+
+    def __init__(self, node_id, channel_manager, sync_manager, bus, probe_interval=1000, ack_timeout=300,
+                 fan_out=3, suspect_timeout=5000, max_piggyback=6, on_failed=None):
+        self.node_id = node_id
+        self.channel_manager = channel_manager
+        self.sync_manager = sync_manager
+        self.bus = bus
+        self.probe_interval = probe_interval
+        self.ack_timeout = min(ack_timeout, probe_interval)
+        self.fan_out = fan_out
+        self.suspect_timeout = suspect_timeout
+        self.max_piggyback = max_piggyback
+        self.on_failed = on_failed
+
+        self.incarnation = 0
+        self.incarnations = {}
+        self.suspects = {}
+        self.probes = {}
+        self.relays = {}
+        self.updates = {}
+        self.probe_order = []
+        self.seq = AtomicIncrement()
+        self.lock = RLock()
+        self.log = logging.getLogger('FailureDetector(%s)' % node_id)
+        # probes open channels to the nodes, which blocks on unreachable ones
+        self.probe_timer = IntervalTimer(interval=probe_interval, offset=probe_interval, target=self.probe,
+                                         name='FailureDetector(%s)' % node_id, blocking=True)
+
+    def start(self):
+        for msg_type in FailureDetector.MESSAGE_TYPES:
+            self.bus.on(msg_type, self._on_message_)
+        self.probe_timer.start()
+
+    def stop(self):
+        self.probe_timer.cancel()
+        for msg_type in FailureDetector.MESSAGE_TYPES:
+            self.bus.remove(msg_type, self._on_message_)
+
+    # -- probing
+
+    def probe(self):
+        self._expire_suspects_()
+        target = self._next_target_()
+        if not target:
+            return
+        seq = self._next_seq_()
+        with self.lock:
+            self.probes[seq] = target
+        self._send_to_(target, self._build_message_(FailureDetector.PING, seq=seq))
+        self._schedule_(self.ack_timeout, self._on_ack_timeout_, seq, target)
+
+    def _on_ack_timeout_(self, seq, target):
+        with self.lock:
+            if seq not in self.probes:
+                return
+            helpers = [name for name in self._members_() if name != target]
+        node = self.sync_manager.known_nodes.get(target)
+        if node:
+            for helper in random.sample(helpers, min(self.fan_out, len(helpers))):
+                self._send_to_(helper, self._build_message_(FailureDetector.PING_REQ, seq=seq,
+                                                            target=target, endpoint=node.endpoint))
+        self._schedule_(self.probe_interval - self.ack_timeout, self._on_probe_timeout_, seq, target)
+
+    def _on_probe_timeout_(self, seq, target):
+        with self.lock:
+            if self.probes.pop(seq, None) is None:
+                return
+            self.log.debug('No ack from %s' % target)
+            self._suspect_(target, self.incarnations.get(target, 0))
+
+    def _next_target_(self):
+        members = self._members_()
+        with self.lock:
+            while self.probe_order:
+                target = self.probe_order.pop()
+                if target in members:
+                    return target
+            if not members:
+                return None
+            self.probe_order = list(members)
+            random.shuffle(self.probe_order)
+            return self.probe_order.pop()
+
+    def _members_(self):
+        return [name for name, node in list(self.sync_manager.known_nodes.items())
+                if name != self.node_id and node.endpoint]
+
+    def _next_seq_(self):
+        self.seq.inc()
+        return self.seq.value
+
+    def _schedule_(self, delay, target, *args):
+        call_later(max(delay, 0), target, *args, blocking=True)
+
+    # -- membership updates
+
+    def _suspect_(self, name, incarnation):
+        if name not in self.sync_manager.known_nodes:
+            return
+        if incarnation < self.incarnations.get(name, 0):
+            return
+        suspected = self.suspects.get(name)
+        if suspected and suspected[0] >= incarnation:
+            return
+        self.log.info('Node %s is suspected to have failed' % name)
+        self.suspects[name] = (incarnation, time() + self.suspect_timeout/1000)
+        self.incarnations[name] = incarnation
+        self._queue_update_(FailureDetector.SUSPECT, name, incarnation)
+
+    def _alive_(self, name, incarnation, direct=False):
+        """Handles an alive update. Only an update with a newer incarnation
+        overrides a suspicion and is gossiped further. A message received
+        directly from the node clears the local suspicion as well.
+        """
+        suspected = self.suspects.get(name)
+        if incarnation > self.incarnations.get(name, 0) or (suspected and incarnation > suspected[0]):
+            self.incarnations[name] = incarnation
+            self._queue_update_(FailureDetector.ALIVE, name, incarnation)
+        elif not (direct and suspected):
+            return
+        if self.suspects.pop(name, None):
+            self.log.info('Node %s is alive' % name)
+
+    def _confirm_(self, name, incarnation):
+        self.suspects.pop(name, None)
+        self.incarnations.pop(name, None)
+        node = self.sync_manager.remove_node(name)
+        if node:
+            self.log.info('Node %s has failed' % name)
+            self._queue_update_(FailureDetector.CONFIRM, name, incarnation)
+            if self.on_failed:
+                self.on_failed(node)
+
+    def _refute_(self, incarnation):
+        if incarnation >= self.incarnation:
+            self.incarnation = incarnation + 1
+            self._queue_update_(FailureDetector.ALIVE, self.node_id, self.incarnation)
+
+    def _expire_suspects_(self):
+        now = time()
+        with self.lock:
+            for name, (incarnation, deadline) in list(self.suspects.items()):
+                if deadline <= now:
+                    self._confirm_(name, incarnation)
+
+    def _apply_update_(self, update):
+        kind = update.get('type')
+        name = update.get('node')
+        incarnation = update.get('incarnation') or 0
+        if name == self.node_id:
+            if kind in (FailureDetector.SUSPECT, FailureDetector.CONFIRM):
+                self._refute_(incarnation)
+        elif kind == FailureDetector.ALIVE:
+            self._alive_(name, incarnation)
+        elif kind == FailureDetector.SUSPECT:
+            self._suspect_(name, incarnation)
+        elif kind == FailureDetector.CONFIRM:
+            self._confirm_(name, incarnation)
+
+    def _queue_update_(self, kind, name, incarnation):
+        transmissions = int(ceil(3 * log(len(self.sync_manager.known_nodes) + 2)))
+        self.updates[name] = [{'type': kind, 'node': name, 'incarnation': incarnation}, transmissions]
+
+    def _piggyback_(self):
+        with self.lock:
+            pending = sorted(self.updates.items(), key=lambda u: u[1][1], reverse=True)[:self.max_piggyback]
+            updates = []
+            for name, entry in pending:
+                updates.append(entry[0])
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.updates[name]
+            return updates
+
+    # -- messages
+
+    def _build_message_(self, msg_type, **values):
+        msg = message().header('type', msg_type).value('from', self.node_id).\
+            value('incarnation', self.incarnation).value('updates', self._piggyback_())
+        for name, value in values.items():
+            msg.value(name, value)
+        return msg.build()
+
+    def _send_to_(self, name, msg, endpoint=None):
+        if not endpoint:
+            node = self.sync_manager.known_nodes.get(name)
+            if not node:
+                return
+            endpoint = node.endpoint
+        try:
+            self.channel_manager.send_message(to_url=endpoint, message=msg)
+        except (ChannelError, ConnectionError) as e:
+            self.log.debug('Failed to send %s to %s: %s' % (msg.headers.get('type'), name, e))
+
+    def _reply_(self, channel, msg):
+        try:
+            channel.send_message(msg)
+        except (ChannelError, ConnectionError) as e:
+            self.log.debug('Failed to reply over %s: %s' % (channel, e))
+
+    def _on_message_(self, msg, channel):
+        msg_type = msg.headers.get('type')
+        with self.lock:
+            for update in msg.data.get('updates') or []:
+                self._apply_update_(update)
+            sender = msg.data.get('from')
+            if sender and sender in self.sync_manager.known_nodes:
+                self._alive_(sender, msg.data.get('incarnation') or 0, direct=True)
+
+        if msg_type == FailureDetector.PING:
+            self._reply_(channel, self._build_message_(FailureDetector.ACK, seq=msg.data.get('seq')))
+        elif msg_type == FailureDetector.PING_REQ:
+            self._on_ping_req_(msg, channel)
+        else:
+            self._on_ack_(msg)
+
+    def _on_ping_req_(self, msg, channel):
+        seq = self._next_seq_()
+        with self.lock:
+            self.relays[seq] = (channel, msg.data.get('seq'))
+        self._send_to_(msg.data.get('target'), self._build_message_(FailureDetector.PING, seq=seq),
+                       endpoint=msg.data.get('endpoint'))
+        self._schedule_(self.probe_interval, self.relays.pop, seq, None)
+
+    def _on_ack_(self, msg):
+        seq = msg.data.get('seq')
+        with self.lock:
+            target = self.probes.pop(seq, None)
+            relay = self.relays.pop(seq, None)
+        if relay:
+            channel, relayed_seq = relay
+            self._reply_(channel, self._build_message_(FailureDetector.ACK, seq=relayed_seq))
+        elif target:
+            self.log.debug('Ack from %s' % target)
@@ -13,7 +13,10 @@
 # limitations under the License.
 
 from uuid import uuid4 as uuid4
+from copy import deepcopy
+from ast import literal_eval
 import json
+import struct
 
 class Message:
     def __init__(self):
@@ -73,27 +76,437 @@ def serialize(msg, indent=None):
 
 def deserialize(smsg, as_type=None, strict=False):
     msg_type = as_type or Message
-    dmsg = json.loads(smsg)
-    
-    msg = msg_type()
-    
-    for name, value in dmsg.items():
-        if hasattr(msg, name):
-            setattr(msg, name, value)
-        elif strict:
-            raise Exception('No such property %s' % name)
-    
-    return msg 
+    if isinstance(smsg, (bytes, bytearray, memoryview)):
+        dmsg = binary_codec.decode_dict(smsg)
+    else:
+        dmsg = json.loads(smsg)
+
+    return schemas.schema(msg_type, strict).construct(dmsg)
 
 
 def deserialize_dict(dval, as_type, strict=None):
-    val = as_type()
-    
-    for name, value in dval.items():
-        if hasattr(val, name):
-            setattr(val, name, value)
-        elif strict:
-            raise Exception('No such property %s' % name)
-    
-    return val
+    return schemas.schema(as_type, strict).construct(dval)
+
+
+class Schema:
+    """Compiled constructor for a type that is deserialized from a dict.
+
+    The fields and their default values are taken from an instance created with
+    the no-argument constructor of *as_type*. From those a constructor function
+    is generated once, so building an object from a dict does a single dict
+    lookup per field instead of ``hasattr``/``setattr`` calls. Mutable defaults
+    are created anew for every object - as literals in the generated code when
+    possible, otherwise by copying the default value.
+
+    In *strict* mode a dict containing a key that is not a field of the type
+    raises an exception.
+
+    The objects are created without calling ``__init__``: a field missing
+    from the dict gets the value it had in the prototype instance, so fields
+    that ``__init__`` computes (ids, timestamps, locks) are shared or stale.
+    Such types should not be deserialized through a schema.
+    """
+
+    def __init__(self, as_type, strict=False):
+        self.as_type = as_type
+        self.strict = bool(strict)
+        self.defaults = dict(as_type().__dict__)
+        self.fields = frozenset(self.defaults)
+        self.construct = self.__compile()
+
+    def __compile(self):
+        env = {
+            '_new': object.__new__,
+            '_cls': self.as_type,
+            '_copy': deepcopy,
+            '_fields': self.fields,
+            '_unknown': self.__unknown_fields
+        }
+        values = []
+        for i, (name, default) in enumerate(self.defaults.items()):
+            default_ref = '_d%d' % i
+            env[default_ref] = default
+            if default is None or isinstance(default, (bool, int, float, str, bytes, tuple, frozenset)):
+                values.append('        %r: get(%r, %s),' % (name, name, default_ref))
+            else:
+                new_default = Schema.__literal(default) or '_copy(%s)' % default_ref
+                values.append('        %r: dval[%r] if %r in dval else %s,' % (name, name, name, new_default))
+
+        lines = ['def construct(dval):']
+        if self.strict:
+            lines.append('    if not _fields.issuperset(dval):')
+            lines.append('        _unknown(dval)')
+        lines.append('    get = dval.get')
+        lines.append('    obj = _new(_cls)')
+        lines.append('    obj.__dict__ = {')
+        lines += values
+        lines.append('    }')
+        lines.append('    return obj')
+
+        exec('\n'.join(lines), env)
+        return env['construct']
+
+    @staticmethod
+    def __literal(value):
+        literal = repr(value)
+        try:
+            if literal_eval(literal) == value:
+                return literal
+        except (ValueError, SyntaxError):
+            pass
+        return None
+
+    def __unknown_fields(self, dval):
+        for name in dval:
+            if name not in self.fields:
+                raise Exception('No such property %s' % name)
+
+
+class SchemaRegistry:
+    """Caches the compiled :class:`Schema` for each (type, strict) pair."""
+
+    def __init__(self):
+        self.schemas = {}
+
+    def schema(self, as_type, strict=False):
+        key = (as_type, bool(strict))
+        schema = self.schemas.get(key)
+        if schema is None:
+            schema = self.schemas[key] = Schema(as_type, strict)
+        return schema
+
+    def register(self, *types):
+        for as_type in types:
+            self.schema(as_type)
+            self.schema(as_type, strict=True)
+
+
+schemas = SchemaRegistry()
+
+
+def register_schema(*types):
+    """Compiles the schemas of *types* ahead of the first deserialization.
+
+    The deserialized objects are created without calling ``__init__`` of the
+    type (see :class:`Schema`), so only register types whose ``__init__``
+    just sets the default values of the fields.
+    """
+    schemas.register(*types)
+
+
+
+class CodecError(Exception):
+    pass
+
+
+class JSONCodec:
+    """The default text codec. Messages are serialized as JSON strings and sent
+    as text frames.
+    """
+    name = 'json'
+    binary = False
+
+    def encode(self, msg):
+        return serialize(msg)
+
+    def decode(self, data, as_type=None):
+        return deserialize(data, as_type=as_type)
+
+
+class BinaryCodec:
+    """Compact binary codec for :class:`Message`.
+
+    A frame starts with the magic ``TR`` and a version byte, followed by three
+    typed values: the message id, the headers and the data. Every value is
+    prefixed with a one byte type tag; strings, bytes, lists and dicts are
+    length-prefixed. Dictionary keys are interned per frame - a key is written
+    in full the first time it appears and as a two byte reference afterwards,
+    which keeps messages with many similar objects (sync messages) compact.
+    Objects are encoded by their ``__dict__``, the same way :class:`DictEncoder`
+    does it for JSON.
+    """
+    name = 'binary'
+    binary = True
+
+    MAGIC = b'TR'
+    VERSION = 1
+
+    NONE = 0x00
+    TRUE = 0x01
+    FALSE = 0x02
+    INT8 = 0x03
+    INT32 = 0x04
+    INT64 = 0x05
+    BIGINT = 0x06
+    FLOAT = 0x07
+    SHORT_STR = 0x08
+    STR = 0x09
+    BYTES = 0x0A
+    LIST = 0x0B
+    DICT = 0x0C
+
+    KEY_NEW = 0x00
+    KEY_REF = 0x01
+
+    MAX_KEYS = 0xFFFF
+
+    _HEADER = struct.Struct('>2sB')
+    _U16 = struct.Struct('>H')
+    _U32 = struct.Struct('>I')
+    _I8 = struct.Struct('>b')
+    _I32 = struct.Struct('>i')
+    _I64 = struct.Struct('>q')
+    _F64 = struct.Struct('>d')
+
+    def __init__(self):
+        self._encoders = {
+            type(None): self._encode_none,
+            bool: self._encode_bool,
+            int: self._encode_int,
+            float: self._encode_float,
+            str: self._encode_str,
+            bytes: self._encode_bytes,
+            bytearray: self._encode_bytes,
+            list: self._encode_list,
+            tuple: self._encode_list,
+            dict: self._encode_dict
+        }
+        self._decoders = [None] * 256
+        for tag, decoder in [(BinaryCodec.NONE, self._decode_none),
+                             (BinaryCodec.TRUE, self._decode_true),
+                             (BinaryCodec.FALSE, self._decode_false),
+                             (BinaryCodec.INT8, self._decode_int8),
+                             (BinaryCodec.INT32, self._decode_int32),
+                             (BinaryCodec.INT64, self._decode_int64),
+                             (BinaryCodec.BIGINT, self._decode_bigint),
+                             (BinaryCodec.FLOAT, self._decode_float),
+                             (BinaryCodec.SHORT_STR, self._decode_short_str),
+                             (BinaryCodec.STR, self._decode_str),
+                             (BinaryCodec.BYTES, self._decode_bytes),
+                             (BinaryCodec.LIST, self._decode_list),
+                             (BinaryCodec.DICT, self._decode_dict)]:
+            self._decoders[tag] = decoder
+
+    def encode(self, msg):
+        buff = bytearray(BinaryCodec._HEADER.pack(BinaryCodec.MAGIC, BinaryCodec.VERSION))
+        keys = {}
+        self._encode(msg.id, buff, keys)
+        self._encode(msg.headers, buff, keys)
+        self._encode(msg.data, buff, keys)
+        return bytes(buff)
+
+    def decode(self, data, as_type=None):
+        return deserialize(data, as_type=as_type)
+
+    def decode_dict(self, data):
+        data = memoryview(data)
+        if len(data) < BinaryCodec._HEADER.size:
+            raise CodecError('Frame too short')
+        magic, version = BinaryCodec._HEADER.unpack_from(data, 0)
+        if magic != BinaryCodec.MAGIC:
+            raise CodecError('Not a binary message frame')
+        if version != BinaryCodec.VERSION:
+            raise CodecError('Unsupported binary frame version %d' % version)
+        offset = BinaryCodec._HEADER.size
+        keys = []
+        try:
+            msg_id, offset = self._decode(data, offset, keys)
+            headers, offset = self._decode(data, offset, keys)
+            msg_data, offset = self._decode(data, offset, keys)
+        except (struct.error, IndexError) as e:
+            raise CodecError('Truncated frame') from e
+        return {'id': msg_id, 'headers': headers or {}, 'data': msg_data}
+
+    # -- encoding
+
+    def _encode(self, value, buff, keys):
+        encoder = self._encoders.get(type(value))
+        if encoder:
+            encoder(value, buff, keys)
+            return
+        try:
+            values = value.__dict__
+        except AttributeError:
+            values = None
+        if values is None:
+            self._encode_none(None, buff, keys)
+        else:
+            self._encode_dict(values, buff, keys)
+
+    def _encode_none(self, value, buff, keys):
+        buff.append(BinaryCodec.NONE)
+
+    def _encode_bool(self, value, buff, keys):
+        buff.append(BinaryCodec.TRUE if value else BinaryCodec.FALSE)
+
+    def _encode_int(self, value, buff, keys):
+        if -0x80 <= value <= 0x7F:
+            buff.append(BinaryCodec.INT8)
+            buff += BinaryCodec._I8.pack(value)
+        elif -0x80000000 <= value <= 0x7FFFFFFF:
+            buff.append(BinaryCodec.INT32)
+            buff += BinaryCodec._I32.pack(value)
+        elif -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+            buff.append(BinaryCodec.INT64)
+            buff += BinaryCodec._I64.pack(value)
+        else:
+            buff.append(BinaryCodec.BIGINT)
+            self._encode_str(str(value), buff, keys)
+
+    def _encode_float(self, value, buff, keys):
+        buff.append(BinaryCodec.FLOAT)
+        buff += BinaryCodec._F64.pack(value)
+
+    def _encode_str(self, value, buff, keys):
+        encoded = value.encode('utf-8')
+        if len(encoded) < 256:
+            buff.append(BinaryCodec.SHORT_STR)
+            buff.append(len(encoded))
+        else:
+            buff.append(BinaryCodec.STR)
+            buff += BinaryCodec._U32.pack(len(encoded))
+        buff += encoded
+
+    def _encode_bytes(self, value, buff, keys):
+        buff.append(BinaryCodec.BYTES)
+        buff += BinaryCodec._U32.pack(len(value))
+        buff += value
+
+    def _encode_list(self, value, buff, keys):
+        buff.append(BinaryCodec.LIST)
+        buff += BinaryCodec._U32.pack(len(value))
+        encode = self._encode
+        for item in value:
+            encode(item, buff, keys)
+
+    def _encode_dict(self, value, buff, keys):
+        buff.append(BinaryCodec.DICT)
+        buff += BinaryCodec._U32.pack(len(value))
+        encode = self._encode
+        for key, item in value.items():
+            # keys are always strings, same as in JSON
+            if type(key) is not str:
+                key = str(key)
+            ref = keys.get(key)
+            if ref is None:
+                if len(keys) < BinaryCodec.MAX_KEYS:
+                    keys[key] = len(keys)
+                buff.append(BinaryCodec.KEY_NEW)
+                self._encode_str(key, buff, keys)
+            else:
+                buff.append(BinaryCodec.KEY_REF)
+                buff += BinaryCodec._U16.pack(ref)
+            encode(item, buff, keys)
+
+    # -- decoding
+
+    def _decode(self, data, offset, keys):
+        decoder = self._decoders[data[offset]]
+        if not decoder:
+            raise CodecError('Unknown type tag 0x%02x at offset %d' % (data[offset], offset))
+        return decoder(data, offset + 1, keys)
+
+    def _decode_none(self, data, offset, keys):
+        return None, offset
+
+    def _decode_true(self, data, offset, keys):
+        return True, offset
+
+    def _decode_false(self, data, offset, keys):
+        return False, offset
+
+    def _decode_int8(self, data, offset, keys):
+        return BinaryCodec._I8.unpack_from(data, offset)[0], offset + 1
+
+    def _decode_int32(self, data, offset, keys):
+        return BinaryCodec._I32.unpack_from(data, offset)[0], offset + 4
+
+    def _decode_int64(self, data, offset, keys):
+        return BinaryCodec._I64.unpack_from(data, offset)[0], offset + 8
+
+    def _decode_bigint(self, data, offset, keys):
+        value, offset = self._decode(data, offset, keys)
+        return int(value), offset
+
+    def _decode_float(self, data, offset, keys):
+        return BinaryCodec._F64.unpack_from(data, offset)[0], offset + 8
+
+    def _decode_short_str(self, data, offset, keys):
+        end = offset + 1 + data[offset]
+        if end > len(data):
+            raise CodecError('Truncated frame')
+        return str(data[offset + 1:end], 'utf-8'), end
+
+    def _decode_str(self, data, offset, keys):
+        end = offset + 4 + BinaryCodec._U32.unpack_from(data, offset)[0]
+        if end > len(data):
+            raise CodecError('Truncated frame')
+        return str(data[offset + 4:end], 'utf-8'), end
+
+    def _decode_bytes(self, data, offset, keys):
+        end = offset + 4 + BinaryCodec._U32.unpack_from(data, offset)[0]
+        if end > len(data):
+            raise CodecError('Truncated frame')
+        return bytes(data[offset + 4:end]), end
+
+    def _decode_list(self, data, offset, keys):
+        count = BinaryCodec._U32.unpack_from(data, offset)[0]
+        offset += 4
+        items = []
+        decoders = self._decoders
+        for i in range(count):
+            decoder = decoders[data[offset]]
+            if not decoder:
+                raise CodecError('Unknown type tag 0x%02x at offset %d' % (data[offset], offset))
+            item, offset = decoder(data, offset + 1, keys)
+            items.append(item)
+        return items, offset
+
+    def _decode_dict(self, data, offset, keys):
+        count = BinaryCodec._U32.unpack_from(data, offset)[0]
+        offset += 4
+        values = {}
+        decoders = self._decoders
+        unpack_ref = BinaryCodec._U16.unpack_from
+        for i in range(count):
+            if data[offset] == BinaryCodec.KEY_REF:
+                key = keys[unpack_ref(data, offset + 1)[0]]
+                offset += 3
+            else:
+                key, offset = self._decode(data, offset + 1, keys)
+                if len(keys) < BinaryCodec.MAX_KEYS:
+                    keys.append(key)
+            decoder = decoders[data[offset]]
+            if not decoder:
+                raise CodecError('Unknown type tag 0x%02x at offset %d' % (data[offset], offset))
+            values[key], offset = decoder(data, offset + 1, keys)
+        return values, offset
+
+
+json_codec = JSONCodec()
+binary_codec = BinaryCodec()
+
+CODECS = {
+    json_codec.name: json_codec,
+    binary_codec.name: binary_codec
+}
+
+PREFERRED_CODECS = [binary_codec.name, json_codec.name]
+
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if not codec:
+        raise CodecError('Unknown codec %s' % name)
+    return codec
+
 
+def negotiate_codec(offered, supported=None):
+    """Picks the first codec from the *offered* list that is also *supported*
+    locally. Falls back to JSON, which every node understands.
+    """
+    supported = supported or PREFERRED_CODECS
+    for name in offered or []:
+        if name in supported and name in CODECS:
+            return CODECS[name]
+    return json_codec
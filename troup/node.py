@@ -14,19 +14,25 @@
 
 __author__ = 'pavle'
 
-from troup.store import InMemorySyncedStore
-from troup.infrastructure import AsyncIOWebSocketServer, IncomingChannelWSAdapter, ChannelManager, ChannelClosedError, message_bus, bus
+from troup.store import InMemorySyncedStore, LogStore
+from troup.infrastructure import AsyncIOWebSocketServer, IncomingChannelWSAdapter, ChannelManager, ChannelError, ChannelClosedError, message_bus, bus
 from troup.system import StatsTracker, SystemStats
-from troup.messaging import message, serialize, deserialize, deserialize_dict, Message
+from troup.messaging import message, serialize, deserialize, deserialize_dict, Message, schemas, register_schema
 import threading
-from troup.threading import IntervalTimer
-from troup.apps import App
-from troup.process import this_process_info_file, open_process_lock_file
-from troup.tasks import TasksRunner, build_task, task_for_app
+from troup.threading import IntervalTimer, LimitedExecutor, default_scheduler
+from troup.apps import App, AppsIndex
+from troup.process import this_process_info_file, open_process_lock_file, CodePool, ProcessSupervisor, Zygote, \
+    SSHMasters
+from troup.tasks import TasksRunner, TaskRun, OutputSubscription, build_task, task_for_app, app_process_data
+from troup.remote import RemoteTasks
+from troup.membership import FailureDetector
+from troup.ranking import NodeStatsTable, ReservationLedger, stats_row
 import random
 from math import ceil
-from os import getpid
+from os import getpid, cpu_count
+from time import time
 from functools import reduce
+from base64 import b64encode
 import logging
 
 
@@ -43,10 +49,25 @@ class Node:
     * *node_id* is the node identifier. This should be uniqe on the system.
     * *config* is the configuration :func:`dict` for the node.
     * *store* is the :class:`troup.store.Store` instance used by this node.
+
+    Commands, tasks and batches are not handled on the event loop of the
+    server but on the workers of a :class:`troup.threading.LimitedExecutor`,
+    configured with ``config['executor']``: ``workers``, ``limits`` - the
+    maximal number of concurrently running commands of one name (or of tasks
+    and batches, under ``task`` and ``batch``) - and ``default-limit`` for
+    the names not in ``limits`` (one less than the workers by default).
+
+    The messages that come over one channel are therefore not handled in
+    order: a command may run before a command of another name sent before
+    it, e.g. a ``task-credit`` before the ``task-subscribe`` it is meant for.
+    Clients that depend on the order must wait for the reply first.
     """
+
+    OFF_LOOP_TYPES = ('command', 'task', 'batch')
+
     def __init__(self, node_id, config, store=None, channel_manager=None,
                  aio_server=None, stats_tracker=None, sync_manager=None,
-                 tasks_runner=None):
+                 tasks_runner=None, failure_detector=None, bus=None, executor=None):
         self.node_id = node_id
 
         self.log = logging.getLogger('Node(%s)' % self.node_id)
@@ -57,14 +78,51 @@ class Node:
         self.aio_server = aio_server or None
         self.stats_tracker = stats_tracker or None
         self.sync_manager = sync_manager or None
-        self.bus = message_bus
+        self.failure_detector = failure_detector or None
+        self.bus = bus or message_bus
         self.lock = None
         self.pid = getpid()
         self.commands = {}
-        self.runner = tasks_runner or TasksRunner(max_workers=int(self.config.get('runner-max-workers', '3')))
+        self.channel_commands = set()
+        self.subscriptions = {}
+        self.supervisor = self._build_supervisor_()
+        self.remote_tasks = None
+        self.runner = tasks_runner or self._build_runner_()
+        self.executor = executor or self._build_executor_()
 
         self.__register_commands()
 
+    def _build_runner_(self):
+        return TasksRunner(min_workers=int(self.config.get('runner-min-workers', '3')),
+                           max_workers=int(self.config.get('runner-max-workers', max(3, 4 * (cpu_count() or 1)))),
+                           min_processes=int(self.config.get('runner-min-processes', '16')),
+                           max_processes=int(self.config.get('runner-max-processes', '64')),
+                           weights=self.config.get('runner-weights'),
+                           system_stats=self.__system_stats,
+                           scale_interval=int(self.config.get('runner-scale-interval', '1000')),
+                           code_pool=CodePool(size=int(self.config.get('code-workers', 0)) or None,
+                                              max_tasks=int(self.config.get('code-max-tasks', '100'))),
+                           supervisor=self.supervisor)
+
+    def _build_supervisor_(self):
+        zygote = None
+        zygote_config = self.config.get('zygote')
+        if zygote_config:
+            preload = zygote_config.get('preload') or []
+            if isinstance(preload, str):
+                preload = [module for module in preload.split(',') if module]
+            zygote = Zygote(preload=preload, max_workers=int(zygote_config.get('workers', 16)))
+        ssh_masters = None
+        ssh_config = self.config.get('ssh') or {}
+        if ssh_config.get('multiplex', True):
+            ssh_masters = SSHMasters(directory=ssh_config.get('control-dir'),
+                                     idle_timeout=int(ssh_config.get('idle-timeout', 300000)),
+                                     check_interval=int(ssh_config.get('check-interval', 30000)))
+        return ProcessSupervisor(zygote=zygote, ssh_masters=ssh_masters)
+
+    def __system_stats(self):
+        return self.stats_tracker.get_stats() if self.stats_tracker else None
+
     def __lock(self):
         if self.lock:
             return self.lock
@@ -84,7 +142,8 @@ class Node:
             return self.channel_manager
         aio_srv = self.aio_server or AsyncIOWebSocketServer(host=self.config['server'].get('hostname'),
                                          port=self.config['server']['port'],
-                                         web_socket_class=IncomingChannelWSAdapter)
+                                         web_socket_class=IncomingChannelWSAdapter,
+                                         codecs=self.config.get('codecs'))
 
         def start_aio_server():
             self.log.debug('AIO Server start')
@@ -93,7 +152,7 @@ class Node:
 
         th = threading.Thread(target=start_aio_server)
         th.start()
-        channel_manager = ChannelManager(aio_srv)
+        channel_manager = ChannelManager(aio_srv, codecs=self.config.get('codecs'))
         self.aio_server = aio_srv
         self.log.debug('AIO Server set up')
         return channel_manager
@@ -102,17 +161,34 @@ class Node:
         def on_channel_data(message_str, channel):
             try:
                 msg = deserialize(message_str)
-                if msg.headers.get('type'):
-                    self.bus.publish(msg.headers['type'], msg, channel)
+                msg_type = msg.headers.get('type')
+                if msg_type in Node.OFF_LOOP_TYPES:
+                    key = msg.headers.get('command') if msg_type == 'command' else msg_type
+                    self.executor.submit(key, self.bus.publish, msg_type, msg, channel)
+                elif msg_type:
+                    self.bus.publish(msg_type, msg, channel)
                 else:
                     self.bus.publish('__message.genericType', msg, channel)
             except Exception as e:
-                self.log.exception('Failed to handle channel data', e)
-                self.lock.debug('Message ', message_str)
+                self.log.exception('Failed to handle channel data: %s', e)
+                self.log.debug('Message %s', message_str)
         self.channel_manager.on('channel.data', on_channel_data)
 
+    def _build_executor_(self):
+        executor_config = self.config.get('executor') or {}
+        return LimitedExecutor(workers=int(executor_config.get('workers', 8)),
+                               limits=executor_config.get('limits'),
+                               default_limit=int(executor_config.get('default-limit', 0)) or None,
+                               name='Node(%s)-executor' % self.node_id)
+
     def _build_store_(self):
-        store = InMemorySyncedStore(root_path=self.config['store']['path'])
+        store_config = self.config['store']
+        if store_config.get('backend') == 'journal':
+            return LogStore(root_path=store_config['path'],
+                            compact_size=int(store_config.get('compact-size', 1024*1024)),
+                            sync=bool(store_config.get('sync', False)))
+        store = InMemorySyncedStore(root_path=store_config['path'],
+                                    flush_delay=int(store_config.get('flush-delay', 1000)))
         return store
 
     def _start_stats_tracker_(self):
@@ -120,9 +196,18 @@ class Node:
         self.log.info('stats tracking ON')
 
     def _start_sync_manager_(self):
+        sync_config = self.config.get('sync') or {}
+        reservations_config = self.config.get('reservations') or {}
         self.sync_manager = self.sync_manager or SyncManager(node=self, channel_manager=self.channel_manager,
-                                        event_processor=None, sync_interval=10000, sync_percent=0.3)
+                                        event_processor=None,
+                                        sync_interval=int(sync_config.get('interval', 10000)),
+                                        sync_percent=float(sync_config.get('percent', 0.3)),
+                                        reservation_settle=int(reservations_config.get('settle', 1000)),
+                                        reservation_ttl=int(reservations_config.get('ttl', 10000)),
+                                        stats_threshold=float(sync_config.get('stats-threshold', 0.05)))
         self.sync_manager.start()
+        self.sync_manager.apps_index.update_node(self.node_id, self.get_apps())
+        self.store.on('apps.changed', self.__on_local_apps_changed)
 
         neighbours = self.config.get('neighbours')
         if neighbours:
@@ -132,32 +217,49 @@ class Node:
                 self.sync_manager.register_node(node)
                 self.log.debug('Added neighbour %s [%s]' % (name, endpoint))
 
+    def _start_failure_detector_(self):
+        fd_config = self.config.get('membership') or {}
+        self.failure_detector = self.failure_detector or FailureDetector(
+            node_id=self.node_id, channel_manager=self.channel_manager, sync_manager=self.sync_manager,
+            bus=self.bus, probe_interval=int(fd_config.get('probe_interval', 1000)),
+            ack_timeout=int(fd_config.get('ack_timeout', 300)),
+            fan_out=int(fd_config.get('fan_out', 3)),
+            suspect_timeout=int(fd_config.get('suspect_timeout', 5000)))
+        self.failure_detector.start()
+
     def __register_to_local(self):
         if self.config.get('lock'):
             endpoint = self.aio_server.get_server_endpoint()
             self.lock.set_info('url', endpoint)
 
     def __register_command_handlers(self):
-        @bus.subscribe('task')
+        @bus.subscribe('task', bus=self.bus)
         def __on_task__(task, inc_channel):
-            try:
-                run = self.runner.run(build_task(task))
-                # FIXME: Add context to runner.
-                self.__reply(task, run.id, inc_channel)
-            except Exception as e:
-                self.log.exception('Failed to run task %s', task)
-                self.__reply(task, str(e), inc_channel, error=True)
+            reply, error = self.__run_task(task, inc_channel)
+            self.__reply(task, reply, inc_channel, error=error)
 
-        @bus.subscribe('command')
+        @bus.subscribe('command', bus=self.bus)
         def __on_command__(command, inc_channel):
             self.log.debug('Received command: %s over channel %s' % (command, inc_channel))
             self.__process_command(command, inc_channel)
 
+        @bus.subscribe('batch', bus=self.bus)
+        def __on_batch__(batch, inc_channel):
+            self.__process_batch(batch, inc_channel)
+
     def __register_commands(self):
         self.command_handler('apps', self.__list_apps)
         self.command_handler('info', self.__get_info)
         self.command_handler('task-result', self.__task_result)
         self.command_handler('run-app', self.__run_app)
+        self.command_handler('timers', self.__timer_stats)
+        self.command_handler('executor', self.__executor_stats)
+        self.command_handler('channels', self.__channel_stats)
+        self.command_handler('processes', self.__process_stats)
+        self.command_handler('tasks', self.__task_stats)
+        self.command_handler('task-subscribe', self.__subscribe_task_output, with_channel=True)
+        self.command_handler('task-credit', self.__grant_task_output_credits)
+        self.command_handler('task-unsubscribe', self.__unsubscribe_task_output)
 
     def __run_app(self, command):
         print('RUN APP COMMAND RECEIVED: %s' % command)
@@ -165,68 +267,192 @@ class Node:
         return self.run_app(app_name=command.data['app'])
 
     def __list_apps(self, command):
-        return self.get_available_apps()
+        return self.sync_manager.apps_index.snapshot()
+
+    def __on_local_apps_changed(self):
+        self.sync_manager.apps_index.update_node(self.node_id, self.get_apps())
 
     def __get_info(self, command):
         return self.get_node_info()
 
+    def __timer_stats(self, command):
+        return default_scheduler().stats()
+
+    def __executor_stats(self, command):
+        return self.executor.stats()
+
+    def __channel_stats(self, command):
+        return {name: channel.stats() for name, channel in list(self.aio_server.channels.items())}
+
+    def __process_stats(self, command):
+        return self.runner.supervisor.stats()
+
+    def __task_stats(self, command):
+        return self.runner.counters
+
     def __task_result(self, command):
-        stats = self.runner.stats
-        task_id = command.data['task-id']
-        status = stats.get(task_id)
-        if not status:
+        run = self.runner.get(command.data['task-id'])
+        if not run and self.remote_tasks:
+            run = self.remote_tasks.get(command.data['task-id'])
+            if run and run.status == TaskRun.ERROR:
+                raise Exception('Task failed on %s: %s' % (run.node, run.error))
+            if run and run.status == TaskRun.DONE:
+                return run.result
+        if not run:
             raise Exception('No such task')
-        if status['status'] is not 'DONE':
-            raise Exception('Task status %s' % status['status'])
-        run = self.runner.tasks[task_id]
+        if run.status is not TaskRun.DONE:
+            raise Exception('Task status %s' % run.status)
         self.log.debug('Task result: [%s]' % run.task.result)
         return run.task.result
 
-    def command_handler(self, command, handler):
+    def __subscribe_task_output(self, command, channel):
+        """Streams the output of a running process task over the channel the
+        command came on, as ``task-output`` messages. See
+        :class:`troup.tasks.OutputSubscription`.
+        """
+        data = command.data or {}
+        run = self.runner.get(data.get('task-id'))
+        if not run:
+            raise Exception('No such task')
+        stream = data.get('stream') or 'stdout'
+        subscription = OutputSubscription(run.task, send=None, stream=stream,
+                                          offset=int(data.get('offset') or 0),
+                                          credits=int(data.get('credits') or 8),
+                                          chunk_size=int(data.get('chunk-size') or 65536),
+                                          subscription_id=data.get('subscription'),
+                                          on_close=lambda s: self.subscriptions.pop(s.id, None))
+
+        def send(chunk):
+            if not channel.codec.binary:
+                chunk['data'] = b64encode(chunk['data']).decode('ascii')
+                chunk['encoding'] = 'base64'
+            chunk['stream'] = stream
+            channel.send_message(message().header('type', 'task-output').
+                                 header('subscription', subscription.id).
+                                 header('task-id', run.task.id).
+                                 data(chunk).build())
+
+        subscription.send = send
+        self.subscriptions[subscription.id] = subscription
+        subscription.start()
+        return {'subscription': subscription.id, 'stream': stream, 'offset': subscription.buffer.start}
+
+    def __grant_task_output_credits(self, command):
+        subscription = self.subscriptions.get(command.data['subscription'])
+        if not subscription:
+            raise Exception('No such subscription')
+        subscription.grant(int(command.data['credits']))
+        return True
+
+    def __unsubscribe_task_output(self, command):
+        subscription = self.subscriptions.get(command.data['subscription'])
+        if subscription:
+            subscription.close()
+        return True
+
+    def command_handler(self, command, handler, with_channel=False):
+        """Registers the *handler* of a command. The handler is called with
+        the command message, and the channel it came on if *with_channel*
+        is set.
+        """
         self.commands[command] = handler
+        if with_channel:
+            self.channel_commands.add(command)
+        else:
+            self.channel_commands.discard(command)
 
     def __process_command(self, command, channel):
-        handler = self.commands.get(command.headers['command'])
+        reply, error = self.__execute_command(command, channel)
+        self.__reply(command, reply=reply, error=error, channel=channel)
+
+    def __execute_command(self, command, channel=None):
+        name = command.headers.get('command')
+        handler = self.commands.get(name)
         if not handler:
-            self.__reply(command, reply='Unknown command', error=True, channel=channel)
-            return
+            return 'Unknown command', True
         try:
-            reply = handler(command)
-            self.__reply(command, reply=reply, channel=channel)
+            if name in self.channel_commands:
+                return handler(command, channel), None
+            return handler(command), None
         except Exception as e:
-            self.__reply(command, reply=str(e), error=True, channel=channel)
             logging.exception('Failed to execute command %s', command)
+            return str(e), True
+
+    def __run_task(self, task, channel=None):
+        """Queues the task in the priority class from its ``priority`` header
+        (``interactive``, ``normal`` or ``batch``), on behalf of the submitter
+        from its ``submitter`` header, or else of the channel it came on.
+        """
+        submitter = task.headers.get('submitter') or (channel.name if channel else None)
+        try:
+            run = self.runner.run(build_task(task), priority=task.headers.get('priority'), submitter=submitter)
+            if task.headers.get('report-status') and channel:
+                self.__report_status(run, channel)
+            # FIXME: Add context to runner.
+            return run.id, None
+        except Exception as e:
+            self.log.exception('Failed to run task %s', task)
+            return str(e), True
+
+    def __report_status(self, run, channel):
+        """Sends the status of the run over the channel its task came on, as
+        ``task-status`` messages: once it is running and once it is over,
+        with its result or error.
+        """
+        def send(status, data):
+            data['status'] = status
+            try:
+                channel.send_message(message().header('type', 'task-status').header('task-id', run.id).
+                                     data(data).build())
+            except (ChannelError, ConnectionError) as e:
+                self.log.debug('Failed to report the status of task %s: %s', run.id, e)
+
+        def on_status(run, previous, status):
+            if status is TaskRun.RUNNING:
+                send(status, {})
+
+        def on_done(future):
+            if run.status is TaskRun.ERROR:
+                send(run.status, {'error': str(run.error)})
+            else:
+                send(run.status, {'result': run.task.result})
+
+        run.add_status_listener(on_status)
+        if run.status is TaskRun.RUNNING:
+            send(run.status, {})
+        run.future.add_done_callback(on_done)
+
+    def __process_batch(self, batch, channel):
+        """Executes the commands and tasks in a batch message in order and
+        sends back all of their replies in a single ``batch-reply`` message.
+        """
+        replies = []
+        for item in batch.data.get('messages') or []:
+            msg = deserialize_dict(item, Message)
+            msg_type = msg.headers.get('type')
+            if msg_type == 'command':
+                reply, error = self.__execute_command(msg, channel)
+            elif msg_type == 'task':
+                reply, error = self.__run_task(msg, channel)
+            else:
+                reply, error = 'Unsupported message type in batch: %s' % msg_type, True
+            replies.append({'reply-for': msg.id, 'error': error, 'reply': reply})
+        reply_msg = message().header('reply-for', batch.id).\
+            header('type', 'batch-reply').\
+            value('replies', replies).build()
+        channel.send_message(reply_msg)
 
     def __reply(self, msg, reply, channel, error=None):
         reply_msg = message().header('reply-for', msg.id).\
             header('type', 'reply').\
             value('error', error).value('reply', reply).build()
-        ser_msg = serialize(reply_msg)
-        channel.send(ser_msg)
-
-    def _merge_apps(apps, napps, node):
-        for napp in napps:
-            app = apps.get(napp.name)
-            if not app:
-                app = {
-                    'name': napp.name,
-                    'description': napp.description,
-                    'command': napp.command,
-                    'params': napp.params,
-                    'needs': napp.needs,
-                    'nodes': []
-                }
-                apps[napp.name] = app
-            app['nodes'].append(node)
+        channel.send_message(reply_msg)
 
     def get_available_apps(self):
-        apps = {}
-        Node._merge_apps(apps, self.get_apps(), self.get_node_info())
-
-        for node_name, node_info in self.sync_manager.known_nodes.items():
-            if node_name is not self.node_id:
-                Node._merge_apps(apps, node_info.apps, node_info)
-        return apps
+        """Apps available on this node and on the known nodes - a dict of app
+        name to the app and the names of the nodes that provide it.
+        """
+        return self.sync_manager.apps_index.snapshot()['apps']
 
     def get_stats(self):
         pass
@@ -240,55 +466,93 @@ class Node:
     def run_app(self, app_name):
         # find app
         # sort nodes by requirements
-        apps = self.get_available_apps()
-
-        app = apps.get(app_name)
+        app = self.sync_manager.apps_index.get(app_name)
         if not app:
             raise Exception('No such app %s' % app_name)
 
-        ranked = Node._rank_nodes(app['needs'], app['nodes'])
-        for ranked_node in ranked:
+        node_stats = self.sync_manager.node_stats
+        reservations = self.sync_manager.reservations
+        stats = self.stats_tracker.get_stats()
+        node_stats.update(self.node_id, stats)
+        reservations.on_stats(self.node_id, stats.measured_at)
+        reservations.expire()
+
+        candidates = int((self.config.get('ranking') or {}).get('candidates', 3))
+        tried = set()
+        for attempt in range(candidates):
+            # the needs are reserved on the best node before the launch, so
+            # concurrent launches see them
+            with reservations.lock:
+                ranked = node_stats.rank(app['needs'], names=[n for n in app['nodes'] if n not in tried], k=1)
+                if not ranked:
+                    break
+                name, score = ranked[0]
+                reservation = reservations.reserve(name, app['needs'])
             try:
-                return self._run_as_task(app, ranked[0])
+                return self._run_as_task(app, {'node': name, 'score': score})
             except Exception as e:
-                logging.exception('Failed to run on node %s' % ranked_node)
+                logging.exception('Failed to run on node %s' % name)
+                reservations.release(reservation)
+                tried.add(name)
         raise Exception('Failed to run app %s'%app_name)
 
     def _run_as_task(self, app, ranked_node):
+        """Runs the app on the ranked node. An app placed on another node is
+        forwarded to it as a task (see :class:`troup.remote.RemoteTasks`),
+        unless it is launched over ssh - if the app asks for it (``ssh``,
+        ``forward_video`` or ``forward_audio`` in its params) or the node is
+        configured to.
+        """
         remote = ranked_node['node'] != self.node_id
         node = {'name': ranked_node['node']}
 
+        if remote and not self._launch_over_ssh_(app):
+            return self._forward_task_(app, ranked_node['node'])
+
         if remote:
             node_info = self.sync_manager.get_node_info(ranked_node['node'])
+            ssh = (node_info.data or {}).get('ssh') or {}
             node['host'] = node_info.hostname
-            node['port'] = node_info.data['ssh'].get('port') or 22
-            node['ssh_user'] = node_info.data['ssh'].get('user') or 'root'
+            node['port'] = ssh.get('port') or 22
+            node['ssh_user'] = ssh.get('user') or 'root'
 
         task = task_for_app(app=app, remote=remote, node=node)
-        return self.runner.run(task)
-
-    def _rank_nodes(app_needs, nodes_info):
-        m = max([v for k,v in app_needs.items()])
-        W = {}
-        for k, v in app_needs.items():
-            W[k] = v/m
-
-        return sorted([{'score': Node._calc_score(node_info.stats, W), 'stats': node_info.stats, 'node': node_info.name} for node_info in nodes_info], key=lambda x: x['score'], reverse=True)
-
-    def _calc_score(stats, W):
-        score = 0
-        # CPU score
-        score += Node._relevant_cpu_value(stats) * W['cpu']
-        score += stats.memory['available'] * W['memory']
-        score += stats.disk['ioload'] * (-W['disk'])
-        # FIXME: add network score
-        return score
-
-    def _relevant_cpu_value(stats):
-        # available bogomips = total bogomips - cpu usage * total bogomips = total bogomips * (1 - cpu usage)
-        total_bogomips = stats.cpu['bogomips']['total']
-        usage = stats.cpu['usage']
-        return total_bogomips * (1 - usage)
+        # app launches must not wait behind batch jobs
+        return self.runner.run(task, priority='interactive', submitter='run-app')
+
+    def _launch_over_ssh_(self, app):
+        if (self.config.get('remote') or {}).get('launch') == 'ssh':
+            return True
+        params = app.get('params') or {}
+        return any(params.get(name) for name in ('ssh', 'forward_video', 'forward_audio'))
+
+    def _forward_task_(self, app, name):
+        node_info = self.sync_manager.known_nodes.get(name)
+        if not node_info or not node_info.endpoint:
+            raise Exception('No endpoint for node %s' % name)
+        remote_config = self.config.get('remote') or {}
+        task = message().header('type', 'task').header('task-type', 'process').\
+            header('process-type', 'LocalProcess').header('priority', 'interactive').\
+            header('ttl', int(remote_config.get('ttl', 60000))).\
+            value('process', app_process_data(app)).value('needs', app.get('needs')).build()
+        return self.remote_tasks.forward(name, node_info.endpoint, task)
+
+    def _start_remote_tasks_(self):
+        remote_config = self.config.get('remote') or {}
+        self.remote_tasks = self.remote_tasks or RemoteTasks(
+            node_id=self.node_id, channel_manager=self.channel_manager, bus=self.bus,
+            reply_timeout=int(remote_config.get('reply-timeout', 10000)),
+            retain=int(remote_config.get('retain', 60000)))
+        self.remote_tasks.start()
+        self.sync_manager.add_left_listener(self.remote_tasks.node_left)
+
+    def _rank_nodes(app_needs, nodes_info, k=None):
+        table = NodeStatsTable()
+        stats = {}
+        for node_info in nodes_info:
+            table.update_node(node_info)
+            stats[node_info.name] = node_info.stats
+        return [{'score': score, 'stats': stats[name], 'node': name} for name, score in table.rank(app_needs, k=k)]
 
     def start(self):
         if self.config.get('lock'):
@@ -297,6 +561,8 @@ class Node:
         self.log.info('Node %s started' % self.node_id)
         self._start_stats_tracker_()
         self._start_sync_manager_()
+        self._start_failure_detector_()
+        self._start_remote_tasks_()
         self.__register_message_dispatcher__()
         self.__register_to_local()
         self.__register_command_handlers()
@@ -309,40 +575,57 @@ class Node:
         if self.aio_server:
             self.aio_server.stop()
             self.log.info('Async I/O Server notified to stop')
+        if self.failure_detector:
+            self.failure_detector.stop()
         if self.sync_manager:
             self.sync_manager.stop()
+        if self.remote_tasks:
+            self.remote_tasks.stop()
+        if self.channel_manager:
+            self.channel_manager.shutdown()
         if self.lock:
             self.lock.unlock()
+        self.store.remove_listener('apps.changed', self.__on_local_apps_changed)
+        self.store.close()
+        for subscription in list(self.subscriptions.values()):
+            subscription.close()
+        self.executor.shutdown()
         self.runner.shutdown()
+        if self.supervisor:
+            self.supervisor.shutdown()
         self.log.debug('Runner stopped')
 
     def get_node_info(self):
         return NodeInfo(name=self.node_id, stats=self.stats_tracker.get_stats(),
                         apps=self.get_apps(), endpoint=self.aio_server.get_server_endpoint(),
-                        hostname=self.stats_tracker.hostname)
+                        hostname=self.stats_tracker.hostname, data={'backlog': self.runner.backlog()})
 
 
 class NodeInfo:
-    def __init__(self, name=None, stats=None, apps=None, endpoint=None, hostname=None, data=None):
+    """Information about a node as it is gossiped between the nodes.
+
+    *version* is increased by the node every time it publishes new info about
+    itself. Peers keep only the entry with the highest version.
+    """
+    def __init__(self, name=None, stats=None, apps=None, endpoint=None, hostname=None, data=None, version=0):
         self.name = name
         self.stats = stats
         self.apps = apps
         self.endpoint = endpoint
         self.hostname = hostname
         self.data = data or {}
+        self.version = version
+
 
+register_schema(Message, NodeInfo, SystemStats, App)
 
-def node_info_from_dict(node_dict):
-    apps = []
-    dapps = node_dict.get('apps') or []
 
-    for dapp in dapps:
-        app = deserialize_dict(dapp, App)
-        apps.append(app)
+def node_info_from_dict(node_dict, strict=False):
+    app_from_dict = schemas.schema(App, strict).construct
+    apps = [app_from_dict(dapp) for dapp in node_dict.get('apps') or []]
 
-    dstats = node_dict.get('stats') or {}
-    stats = deserialize_dict(dstats, SystemStats)
-    node = deserialize_dict(node_dict, NodeInfo)
+    stats = schemas.schema(SystemStats, strict).construct(node_dict.get('stats') or {})
+    node = schemas.schema(NodeInfo, strict).construct(node_dict)
     node.apps = apps
     node.stats = stats
     return node
@@ -370,39 +653,112 @@ class RandomBuffer:
 
 
 class SyncManager:
+    """Keeps the list of known nodes in sync by gossiping with random nodes.
+
+    Every node keeps a version for its own info. On each sync tick a
+    ``sync-digest`` message with the name and version of every known node is
+    sent to a random subset of nodes. The peer replies with a ``sync-message``
+    carrying only the entries that are newer than in the digest, and requests
+    the entries for which the digest has a newer version. The requested entries
+    are sent back in a final ``sync-message``. The cost of a sync round depends
+    on the amount of changed info, not on the number of known nodes.
+
+    The digest also carries the reservations of the
+    :class:`troup.ranking.ReservationLedger` made or received in the last few
+    ticks, so capacity reserved for launches on one node is seen by the
+    others before fresh stats arrive.
+
+    The version of this node is increased on a sync tick only if its info
+    changed since it was last published: its apps, the needs reserved on it,
+    or a stat by more than *stats_threshold* (a fraction of the published
+    value; an absolute difference for the io load).
+    """
 
-    def __init__(self, node, channel_manager, event_processor, sync_interval=60000, sync_percent=0.3):
+    def __init__(self, node, channel_manager, event_processor, sync_interval=60000, sync_percent=0.3,
+                 reservation_settle=1000, reservation_ttl=10000, stats_threshold=0.05):
         self.node = node
         self.channel_manager = channel_manager
         self.event_processor = event_processor
         self.sync_percent = sync_percent
         self.known_nodes = {}
+        self.left_nodes = {}
+        self.left_listeners = []
+        self.node_stats = NodeStatsTable()
+        self.apps_index = AppsIndex(local_node=node.node_id)
+        self.reservations = ReservationLedger(self.node_stats, local_node=node.node_id,
+                                              settle=reservation_settle, ttl=reservation_ttl)
+        self.version = int(time() * 1000)
+        self.stats_threshold = stats_threshold
+        self.published = None
         self.random_buffer = RandomBuffer(self.known_nodes)
-        self.sync_timer = IntervalTimer(offset=sync_interval, interval=sync_interval, target=self.sync_random_nodes)
+        self.sync_timer = IntervalTimer(offset=sync_interval, interval=sync_interval, target=self.sync_random_nodes,
+                                        jitter=0.1, blocking=True)
 
     def _on_message_(self, msg_str, channel):
         msg = deserialize(msg_str, as_type=Message)
-        #print('Got message [%s]' % msg.__dict__)
-        if msg.headers.get('type') == 'sync-message':
-            self._on_sync_message_(msg)
+        msg_type = msg.headers.get('type')
+        if msg_type == 'sync-digest':
+            self._on_sync_digest_(msg, channel)
+        elif msg_type == 'sync-message':
+            self._on_sync_message_(msg, channel)
+
+    def _on_sync_digest_(self, msg, channel):
+        self.reservations.merge(msg.data.get('reservations') or [])
+        digest = msg.data.get('digest') or {}
+        newer = self._newer_than_(digest)
+        requested = self._newer_in_(digest)
+        if newer or requested:
+            self._send_(channel, self.get_sync_message(newer, request=requested))
+
+    def _on_sync_message_(self, msg, channel=None):
+        nodes = [node_info_from_dict(node) for node in msg.data.get('known_nodes') or []]
+        self._merge_nodes_list_(nodes)
 
-    def _on_sync_message_(self, msg):
-        #print('Got sync message -> %s' % msg)
-        #print(' : From node %s(%s)' % (msg.data['node']['name'], msg.data['node']['endpoint']))
-        nodes = [node_info_from_dict(msg.data['node'])]
+        requested = msg.data.get('request')
+        if requested and channel:
+            self._send_(channel, self.get_sync_message(requested))
+
+    def _newer_than_(self, digest):
+        """Names of the nodes for which this node has newer info than the digest."""
+        names = []
+        if self.version > digest.get(self.node.node_id, -1):
+            names.append(self.node.node_id)
+        for name, node in list(self.known_nodes.items()):
+            if node.version and node.version > digest.get(name, -1):
+                names.append(name)
+        return names
+
+    def _newer_in_(self, digest):
+        """Names of the nodes for which the digest has newer info than this node."""
+        names = []
+        for name, version in digest.items():
+            if name == self.node.node_id:
+                continue
+            node = self.known_nodes.get(name)
+            if not node or node.version < version:
+                names.append(name)
+        return names
 
-        known_nodes = [node_info_from_dict(node) for node in msg.data['known_nodes']]
-        nodes = nodes + known_nodes
-        self._merge_nodes_list_(nodes)
+    def _send_(self, channel, msg):
+        try:
+            channel.send_message(msg)
+        except ChannelError as e:
+            logging.debug('Failed to send sync message over %s: %s' % (channel, e))
 
     def _merge_nodes_list_(self, nodes):
         for node in nodes:
             if node.name == self.node.node_id:
                 continue
-            if not self.known_nodes.get(node.name):
+            if node.version <= self.left_nodes.get(node.name, -1):
+                # stale info about a node that has already left
+                continue
+            existing = self.known_nodes.get(node.name)
+            if not existing:
                 self.known_nodes[node.name] = node
                 logging.info('Node %s has joined' % node.name)
                 self._print_known_nodes_()
+            elif node.version <= existing.version:
+                continue
             self._merge_node_(node)
 
     def _print_known_nodes_(self):
@@ -413,6 +769,10 @@ class SyncManager:
     def _merge_node_(self, node):
         existing = self.known_nodes[node.name]
         self.known_nodes[node.name] = node
+        self.node_stats.update_node(node)
+        self.apps_index.update_node(node.name, node.apps)
+        if node.stats:
+            self.reservations.on_stats(node.name, node.stats.measured_at)
         if existing.endpoint != node.endpoint:
             self.channel_manager.close_channel(existing.endpoint)
 
@@ -424,7 +784,24 @@ class SyncManager:
 
         for name in to_remove:
             del self.known_nodes[name]
+            self.node_stats.remove(name)
+            self.apps_index.remove_node(name)
+            self.reservations.remove_node(name)
             logging.info('Node %s has probably left' % name)
+            self._notify_left_(name)
+
+    def add_left_listener(self, listener):
+        """Calls ``listener(name)`` when a node leaves or is removed as
+        failed.
+        """
+        self.left_listeners.append(listener)
+
+    def _notify_left_(self, name):
+        for listener in self.left_listeners:
+            try:
+                listener(name)
+            except Exception as e:
+                logging.exception('Left node listener failed: %s', e)
 
     def start(self):
         self.sync_timer.start()
@@ -435,37 +812,99 @@ class SyncManager:
     def stop(self):
         self.sync_timer.cancel()
         self.channel_manager.remove_listener('channel.closed', self._on_closed_channel_)
+        self.channel_manager.remove_listener('channel.data', self._on_message_)
 
     def register_node(self, node):
         if self.known_nodes.get(node.name):
             self._merge_node_(node)
         else:
             self.known_nodes[node.name] = node
+            self.node_stats.update_node(node)
+            self.apps_index.update_node(node.name, node.apps)
 
     def unregister_node(self, node):
         pass
 
+    def remove_node(self, name):
+        """Removes a node that is known to have failed. Gossip about the node
+        is ignored until the node itself publishes info with a newer version.
+        """
+        node = self.known_nodes.pop(name, None)
+        self.node_stats.remove(name)
+        self.apps_index.remove_node(name)
+        self.reservations.remove_node(name)
+        if node:
+            self.left_nodes[name] = node.version
+            logging.info('Node %s has left' % name)
+        self._notify_left_(name)
+        return node
+
     def sync_random_nodes(self):
+        self._refresh_version_()
         nodes = self.random_buffer.next(len(self.known_nodes) * self.sync_percent)
+        if not nodes:
+            return
+        digest = self.get_digest_message()
 
         for name in nodes:
             if self.known_nodes.get(name):
                 node = self.known_nodes[name]
                 logging.debug('Sync with %s [%s]' % (name, node.endpoint))
                 try:
-                    self.channel_manager.send(to_url=node.endpoint, data=serialize(self.get_sync_message(), indent=2))
+                    self.channel_manager.send_message(to_url=node.endpoint, message=digest)
                 except ChannelClosedError as e:
                     pass
                 except Exception as e:
                   raise
 
+    def _refresh_version_(self):
+        """Increases the version of this node if its info changed."""
+        node_info = self.node.get_node_info()
+        current = (serialize(node_info.apps), stats_row(node_info.stats),
+                   sorted(self.reservations.reserved(self.node.node_id).items()))
+        if self.published is None or current[0] != self.published[0] or current[2] != self.published[2] or \
+                self._stats_changed_(self.published[1], current[1]):
+            self.version += 1
+            self.published = current
+            return True
+        return False
+
+    def _stats_changed_(self, published, current):
+        if published is None or current is None:
+            return published != current
+        cpu, memory, ioload = published
+        new_cpu, new_memory, new_ioload = current
+        threshold = self.stats_threshold
+        return abs(new_cpu - cpu) > threshold * max(abs(cpu), 1) or \
+            abs(new_memory - memory) > threshold * max(abs(memory), 1) or \
+            abs(new_ioload - ioload) > threshold
+
     def sync_one_node(self, node, this_node_info):
         pass
 
-    def get_sync_message(self):
-        return message().value('node', self.node.get_node_info()).\
-            value('known_nodes', [n for k, n in self.known_nodes.items()]).\
-            header('type', 'sync-message').build()
+    def get_digest_message(self):
+        digest = {name: node.version for name, node in list(self.known_nodes.items())}
+        digest[self.node.node_id] = self.version
+        return message().value('node', self.node.node_id).value('digest', digest).\
+            value('reservations', self.reservations.gossip()).\
+            header('type', 'sync-digest').build()
+
+    def get_sync_message(self, names, request=None):
+        nodes = []
+        for name in names:
+            if name == self.node.node_id:
+                nodes.append(self.get_local_node_info())
+            elif self.known_nodes.get(name):
+                nodes.append(self.known_nodes[name])
+        msg = message().value('known_nodes', nodes).header('type', 'sync-message')
+        if request:
+            msg.value('request', request)
+        return msg.build()
+
+    def get_local_node_info(self):
+        node_info = self.node.get_node_info()
+        node_info.version = self.version
+        return node_info
 
     def get_node_info(self, node):
         node_info = self.known_nodes.get(node)
@@ -31,5 +31,5 @@ class Observable:
     
     def remove_listener(self, event, listener):
         listeners = self.listeners.get(event)
-        if listeners:
+        if listeners and listener in listeners:
             listeners.remove(listener)
@@ -17,11 +17,35 @@ __author__ = 'pavle'
 # https://docs.python.org/3.5/library/subprocess.html
 
 
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from concurrent.futures import Future, TimeoutError, CancelledError
+from threading import Thread, Event, Lock
+from signal import SIGKILL, SIGTERM
 from os import path, getpid, remove
+from collections import deque
+from time import monotonic
+from types import FunctionType
+from multiprocessing import connection
+import multiprocessing
+import traceback
+import importlib
+import selectors
+import tempfile
+import hashlib
+import shutil
+import signal
+import socket
+import runpy
+import builtins
+import marshal
+import os
+import sys
+import asyncio
 import json
 import logging
 
+from troup.threading import IntervalTimer
+
 
 class Process:
 
@@ -56,6 +80,14 @@ class LocalProcess(Process):
         self.output = self.process.stdout
         self.error = self.process.stderr
 
+    def spawn(self, supervisor, buffer_size=0):
+        """Starts the process under *supervisor* instead of :meth:`execute`.
+        The output of the process is read by the supervisor, so there are no
+        streams to read from. Returns the :class:`SupervisedProcess`.
+        """
+        self.process = supervisor.spawn([self.name]+self.args, cwd=self.cwd, buffer_size=buffer_size)
+        return self.process
+
     def wait(self):
         if self.process:
             return self.process.wait()
@@ -65,10 +97,9 @@ class LocalProcess(Process):
         self.process.kill()
 
     def close_streams(self):
-        self.input.close()
-        self.output.close()
-        self.error.close()
-        pass
+        for stream in (self.input, self.output, self.error):
+            if stream:
+                stream.close()
 
     def get_returncode(self):
         if self.process:
@@ -78,7 +109,7 @@ class LocalProcess(Process):
 
 class SSHRemoteProcess(LocalProcess):
     def __init__(self, id, name, args=None, cwd=None, forward_video=False, forward_audio=False,
-                 compress_stream=False, target_host=None, target_port="22", ssh_user=''):
+                 compress_stream=False, target_host=None, target_port="22", ssh_user='', ssh='/usr/bin/ssh'):
         self.forward_video = forward_video
         self.forward_audio = forward_audio
         self.compress_stream = compress_stream
@@ -88,7 +119,25 @@ class SSHRemoteProcess(LocalProcess):
 
         self.ssh_args = self.get_ssh_args()
         args = self.ssh_args + [name] + args
-        super(SSHRemoteProcess, self).__init__(id=id, name='/usr/bin/ssh', args=args, cwd=cwd)
+        super(SSHRemoteProcess, self).__init__(id=id, name=ssh, args=args, cwd=cwd)
+
+    def spawn(self, supervisor, buffer_size=0):
+        """Starts ssh under *supervisor*, over a shared master connection if
+        the supervisor has :class:`SSHMasters`.
+        """
+        masters = supervisor.ssh_masters
+        if not masters:
+            self.process = supervisor.spawn([self.name] + self.args, cwd=self.cwd, buffer_size=buffer_size)
+            return self.process
+        destination = (self.ssh_user, self.target_host, self.target_port)
+        args = masters.options(*destination) + self.args
+        try:
+            self.process = supervisor.spawn([self.name] + args, cwd=self.cwd, buffer_size=buffer_size)
+        except:
+            masters.release(*destination)
+            raise
+        self.process.add_done_callback(lambda process: masters.release(*destination))
+        return self.process
 
     def get_ssh_args(self):
         args = []
@@ -107,10 +156,1193 @@ class SSHRemoteProcess(LocalProcess):
         return args + ['-f', '-p', self.target_port, '%s@%s' % (self.ssh_user, self.target_host)]
 
 
+class PythonProcess(LocalProcess):
+    """Runs a Python module (or script, if not *module*) with the Python of
+    the node. Under a :class:`ProcessSupervisor` with a :class:`Zygote` it
+    is forked from the zygote, with the modules preloaded there already
+    imported.
+    """
+
+    def __init__(self, id, name, args=None, cwd=None, module=True):
+        super(PythonProcess, self).__init__(id, name, args or [], cwd)
+        self.module = module
+
+    def execute(self):
+        self.process = Popen(args=python_command(self.name, self.args, self.module), cwd=self.cwd,
+                             stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        self.input = self.process.stdin
+        self.output = self.process.stdout
+        self.error = self.process.stderr
+
+    def spawn(self, supervisor, buffer_size=0):
+        self.process = supervisor.spawn_python(self.name, self.args, module=self.module, cwd=self.cwd,
+                                               buffer_size=buffer_size)
+        return self.process
+
+
+def python_command(target, args, module=True):
+    if module:
+        return [sys.executable, '-m', target] + list(args)
+    return [sys.executable, target] + list(args)
+
+
 class RemoteProcess(Process):
     pass
 
 
+class SSHMasters:
+    """Shares one ssh master connection per user, host and port between the
+    ssh processes started by the node (``ControlMaster``).
+
+    The first ssh process to a host becomes the master and stays in the
+    background (``ControlPersist``) after it is done; the ssh processes to
+    the same host after it run over the connection of the master, without
+    connecting and authenticating again. The control sockets of the masters
+    are kept in *directory* (a new temporary directory by default).
+
+    Every *check_interval* milliseconds the masters are checked with ``ssh -O
+    check`` and the ones that have died are forgotten, so that the next ssh
+    process starts a new master. A master is used by the ssh processes
+    started with its :meth:`options` until they :meth:`release` it; once it
+    has not been used for *idle_timeout* milliseconds it is stopped with
+    ``ssh -O stop`` - it takes no new sessions and ``ControlPersist`` ends
+    it after the sessions still open over it, which are not torn down.
+    """
+
+    def __init__(self, directory=None, idle_timeout=300000, check_interval=30000, ssh='/usr/bin/ssh',
+                 scheduler=None):
+        self.directory = directory
+        self.own_directory = directory is None
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.ssh = ssh
+        self.scheduler = scheduler
+        self.masters = {}
+        self.sessions = {}
+        self.timer = None
+        self._lock = Lock()
+        self._reused = 0
+        self._started = 0
+        self._evicted = 0
+        self._dead = 0
+
+    def control_path(self, user, host, port):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='troup-ssh-')
+        # unix socket paths are short; the name is a digest of the destination
+        digest = hashlib.sha1(('%s@%s:%s' % (user, host, port)).encode('utf-8')).hexdigest()[:16]
+        return path.join(self.directory, digest)
+
+    def options(self, user, host, port):
+        """The ssh options for a connection to *user* at *host* and *port*."""
+        key = (user, host, str(port))
+        control_path = self.control_path(*key)
+        with self._lock:
+            if self.timer is None:
+                self.timer = IntervalTimer(self.check_interval, offset=self.check_interval, target=self.maintain,
+                                           name='SSHMasters', scheduler=self.scheduler, blocking=True)
+                self.timer.start()
+            if path.exists(control_path):
+                self._reused += 1
+            else:
+                self._started += 1
+            self.masters[key] = monotonic()
+            self.sessions[key] = self.sessions.get(key, 0) + 1
+        persist = max(1, (self.idle_timeout + self.check_interval) // 1000)
+        return ['-o', 'ControlMaster=auto', '-o', 'ControlPath=%s' % control_path,
+                '-o', 'ControlPersist=%d' % persist]
+
+    def release(self, user, host, port):
+        """Marks the end of an ssh process started with :meth:`options`."""
+        key = (user, host, str(port))
+        with self._lock:
+            sessions = self.sessions.get(key, 0) - 1
+            if sessions > 0:
+                self.sessions[key] = sessions
+            else:
+                self.sessions.pop(key, None)
+            if key in self.masters:
+                self.masters[key] = monotonic()
+
+    def maintain(self):
+        """Forgets the dead masters and stops the idle ones."""
+        now = monotonic()
+        with self._lock:
+            masters = [(key, last_used, self.sessions.get(key, 0)) for key, last_used in self.masters.items()]
+        for key, last_used, sessions in masters:
+            control_path = self.control_path(*key)
+            if not sessions and now - last_used >= self.idle_timeout / 1000:
+                self.__control(key, control_path, 'stop')
+                self.__forget(key, last_used, control_path)
+                with self._lock:
+                    self._evicted += 1
+            elif path.exists(control_path) and self.__control(key, control_path, 'check') != 0:
+                self.__forget(key, last_used, control_path)
+                with self._lock:
+                    self._dead += 1
+
+    def __control(self, key, control_path, command):
+        user, host, port = key
+        try:
+            return Popen([self.ssh, '-o', 'ControlPath=%s' % control_path, '-O', command, '-p', port,
+                          '%s@%s' % (user, host)], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL).wait(10)
+        except (OSError, TimeoutExpired):
+            logging.exception('Failed to %s ssh master for %s@%s:%s', command, user, host, port)
+            return None
+
+    def __forget(self, key, last_used, control_path):
+        with self._lock:
+            # unless used again in the meantime
+            if self.masters.get(key) == last_used:
+                del self.masters[key]
+        if path.exists(control_path):
+            try:
+                remove(control_path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'masters': len(self.masters),
+                'sessions': sum(self.sessions.values()),
+                'started': self._started,
+                'reused': self._reused,
+                'evicted': self._evicted,
+                'dead': self._dead
+            }
+
+    def close(self):
+        """Stops all the masters."""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        with self._lock:
+            masters, self.masters = list(self.masters), {}
+        for key in masters:
+            self.__control(key, self.control_path(*key), 'stop')
+        if self.own_directory and self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+class ByteRingBuffer:
+    """Keeps the last *capacity* bytes written to it.
+
+    The bytes are kept in a single ``bytearray`` of exactly *capacity* bytes,
+    allocated on the first write. A write copies the data once (wrapping
+    around the end of the array) and :meth:`getvalue` joins the two parts of
+    the ring, so both are linear in the size of the data.
+
+    Every byte written has an offset - the number of bytes written before
+    it; :attr:`total` is the offset of the next byte. The byte at offset
+    ``o`` is kept at ``o % capacity`` while it is among the last *capacity*.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self._buffer = None
+        self._size = 0
+
+    @property
+    def start(self):
+        """Offset of the oldest byte kept."""
+        return self.total - self._size
+
+    def write(self, data):
+        n = len(data)
+        self.total += n
+        if not self.capacity or not n:
+            return
+        if self._buffer is None:
+            self._buffer = bytearray(self.capacity)
+        view = memoryview(data)
+        if n > self.capacity:
+            view = view[n - self.capacity:]
+            n = self.capacity
+        start = (self.total - n) % self.capacity
+        first = min(n, self.capacity - start)
+        self._buffer[start:start + first] = view[:first]
+        if first < n:
+            self._buffer[:n - first] = view[first:]
+        self._size = min(self.capacity, self._size + n)
+
+    def read(self, offset, size):
+        """Reads at most *size* bytes from *offset*. Returns the offset of the
+        bytes read and the bytes, which start at the oldest byte kept if
+        *offset* is older than that.
+        """
+        offset = max(offset, self.start)
+        size = min(size, self.total - offset)
+        if size <= 0:
+            return offset, b''
+        view = memoryview(self._buffer)
+        i = offset % self.capacity
+        first = min(size, self.capacity - i)
+        if first == size:
+            return offset, bytes(view[i:i + size])
+        return offset, b''.join((view[i:], view[:size - first]))
+
+    def getvalue(self):
+        return self.read(self.start, self._size)[1]
+
+    def decode(self, encoding='utf-8', errors='replace'):
+        # the first bytes kept may be the tail of a multi-byte character
+        return self.getvalue().decode(encoding, errors)
+
+    def __len__(self):
+        return self._size
+
+
+class SupervisedProcess:
+    """A child process started by a :class:`ProcessSupervisor`.
+
+    Has the part of the ``subprocess.Popen`` interface used for waiting on and
+    signalling a process (``pid``, ``returncode``, ``poll``, ``wait``,
+    ``send_signal``, ``terminate`` and ``kill``). The output of the process
+    is read by the supervisor; the last *buffer_size* bytes of stdout and
+    stderr are kept in a :class:`ByteRingBuffer` for each (:attr:`output`).
+    """
+
+    def __init__(self, supervisor, args, cwd=None, env=None, buffer_size=0):
+        self.supervisor = supervisor
+        self.args = args
+        self.cwd = cwd
+        self.env = env
+        self.buffer_size = buffer_size
+        self.pid = None
+        self.returncode = None
+        self.output = {'stdout': ByteRingBuffer(buffer_size), 'stderr': ByteRingBuffer(buffer_size)}
+        self.output_listeners = []
+        self._transport = None
+        self._error = None
+        self._started = Event()
+        self._exited = Future()
+
+    @property
+    def stdout(self):
+        return self.output['stdout'].getvalue()
+
+    @property
+    def stderr(self):
+        return self.output['stderr'].getvalue()
+
+    @property
+    def bytes_read(self):
+        return self.output['stdout'].total + self.output['stderr'].total
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        try:
+            return self._exited.result(timeout)
+        except TimeoutError:
+            raise TimeoutExpired(self.args, timeout)
+
+    def done(self):
+        return self._exited.done()
+
+    def add_done_callback(self, callback):
+        """Calls *callback* with this process once it has exited and all of
+        its output has been read. The callback runs on the loop of the
+        supervisor, so it must not block.
+        """
+        self._exited.add_done_callback(lambda f: callback(self))
+
+    def add_output_listener(self, listener):
+        """Calls *listener* with the name of the stream (``stdout`` or
+        ``stderr``) after output of the process was written to
+        :attr:`output`. Like the done callbacks, it runs on the loop of the
+        supervisor.
+        """
+        self.output_listeners.append(listener)
+
+    def remove_output_listener(self, listener):
+        if listener in self.output_listeners:
+            self.output_listeners.remove(listener)
+
+    def call_soon(self, callback, *args):
+        """Calls *callback* on the loop of the supervisor."""
+        self.supervisor.loop.call_soon_threadsafe(callback, *args)
+
+    def _output_received(self, stream, data):
+        self.output[stream].write(data)
+        for listener in list(self.output_listeners):
+            try:
+                listener(stream)
+            except Exception:
+                logging.exception('Output listener failed for %s', self)
+
+    def send_signal(self, sig):
+        if self.returncode is None and self._transport:
+            self.supervisor.loop.call_soon_threadsafe(self.__signal, sig)
+
+    def terminate(self):
+        self.send_signal(SIGTERM)
+
+    def kill(self):
+        self.send_signal(SIGKILL)
+
+    def __signal(self, sig):
+        try:
+            if self.returncode is None:
+                self._transport.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+    def __repr__(self):
+        return '<SupervisedProcess %s pid=%s returncode=%s>' % (self.args, self.pid, self.returncode)
+
+
+class _SupervisedProtocol(asyncio.SubprocessProtocol):
+
+    STREAMS = {1: 'stdout', 2: 'stderr'}
+
+    def __init__(self, process, loop):
+        self.process = process
+        self.pipes = set(self.STREAMS)
+        self.exited = loop.create_future()
+        self.drained = loop.create_future()
+
+    def pipe_data_received(self, fd, data):
+        self.process._output_received(self.STREAMS[fd], data)
+
+    def pipe_connection_lost(self, fd, exc):
+        self.pipes.discard(fd)
+        if not self.pipes and not self.drained.done():
+            self.drained.set_result(None)
+
+    def process_exited(self):
+        if not self.exited.done():
+            self.exited.set_result(None)
+
+
+class ProcessSupervisor:
+    """Runs child processes on a single event loop with ``asyncio.subprocess``.
+
+    The loop runs in one daemon thread and reads the stdout and stderr of all
+    the children as large chunks become available, so a process costs no
+    threads of its own. Where the platform supports it (Linux, pidfd), the
+    exits of the children are watched on the loop as well; otherwise asyncio
+    falls back to a waiting thread per child.
+
+    The output left in the pipes of a process that has exited is read for at
+    most *drain_timeout* seconds.
+
+    With a *zygote* (see :class:`Zygote`), Python entry points started with
+    :meth:`spawn_python` are forked from it instead of starting a new
+    interpreter, while it has fewer than ``max_workers`` of them running.
+    With *ssh_masters* (see :class:`SSHMasters`), the ssh processes of
+    :class:`SSHRemoteProcess` share master connections.
+    """
+
+    def __init__(self, drain_timeout=0.5, name='ProcessSupervisor', zygote=None, ssh_masters=None):
+        self.drain_timeout = drain_timeout
+        self.name = name
+        self.zygote = zygote
+        self.ssh_masters = ssh_masters
+        self.loop = None
+        self.thread = None
+        self.processes = {}
+        self._lock = Lock()
+        self._started = 0
+        self._exited = 0
+        self._failed = 0
+
+    def start(self):
+        with self._lock:
+            if self.thread:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = Thread(target=self.__run_loop, name=self.name, daemon=True)
+            self.thread.start()
+
+    def __run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        _install_child_watcher()
+        self.loop.run_forever()
+
+    def spawn(self, args, cwd=None, env=None, buffer_size=0):
+        """Starts the process and returns its :class:`SupervisedProcess`
+        once it is running. Raises the error of starting the process (for
+        example ``FileNotFoundError``) like ``Popen`` does.
+
+        Must not be called from the loop of the supervisor.
+        """
+        self.start()
+        process = SupervisedProcess(self, list(args), cwd=cwd, env=env, buffer_size=buffer_size)
+        asyncio.run_coroutine_threadsafe(self.__supervise(process), self.loop)
+        return self.__wait_started(process)
+
+    def spawn_python(self, target, args=(), module=True, cwd=None, env=None, buffer_size=0):
+        """Runs the Python module *target* (or the script at *target*, if not
+        *module*) with *args*, like :meth:`spawn` does ``python -m target``.
+        Forks it from the zygote of the supervisor if it has one, and it has
+        room for another worker.
+        """
+        self.start()
+        process = SupervisedProcess(self, python_command(target, args, module), cwd=cwd, env=env,
+                                    buffer_size=buffer_size)
+        job = {'target': target, 'args': list(args), 'module': module, 'cwd': cwd, 'env': env}
+        asyncio.run_coroutine_threadsafe(self.__supervise_python(process, job), self.loop)
+        return self.__wait_started(process)
+
+    def __wait_started(self, process):
+        process._started.wait()
+        if process._error:
+            raise process._error
+        return process
+
+    async def __supervise(self, process):
+        try:
+            transport, protocol = await self.loop.subprocess_exec(
+                lambda: _SupervisedProtocol(process, self.loop), *process.args, cwd=process.cwd, env=process.env,
+                stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+        except Exception as e:
+            process._error = e
+            with self._lock:
+                self._failed += 1
+            process._started.set()
+            return
+        process._transport = transport
+        process.pid = transport.get_pid()
+        with self._lock:
+            self.processes[process.pid] = process
+            self._started += 1
+        process._started.set()
+        await protocol.exited
+        # children of the process (ssh -f for one) may keep the pipes open
+        # after it has exited, so the output is read for a while only
+        await asyncio.wait([protocol.drained], timeout=self.drain_timeout)
+        returncode = transport.get_returncode()
+        transport.close()
+        self.__exited(process, returncode)
+
+    async def __supervise_python(self, process, job):
+        if self.zygote is None or not self.zygote.has_room():
+            await self.__supervise(process)
+            return
+        stdout, stdout_w = os.pipe()
+        stderr, stderr_w = os.pipe()
+        try:
+            started, exited = self.zygote.fork(self.loop, job, [stdout_w, stderr_w])
+            pid = await started
+        except Exception as e:
+            os.close(stdout)
+            os.close(stderr)
+            process._error = e
+            with self._lock:
+                self._failed += 1
+            process._started.set()
+            return
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+        protocol = _SupervisedProtocol(process, self.loop)
+        pipes = []
+        for fd, stream in ((1, stdout), (2, stderr)):
+            transport, _ = await self.loop.connect_read_pipe(lambda: _PipeProtocol(protocol, fd),
+                                                             os.fdopen(stream, 'rb', 0))
+            pipes.append(transport)
+        process._transport = _ForkedTransport(pid, exited)
+        process.pid = pid
+        with self._lock:
+            self.processes[pid] = process
+            self._started += 1
+        process._started.set()
+        returncode = await exited
+        await asyncio.wait([protocol.drained], timeout=self.drain_timeout)
+        for transport in pipes:
+            transport.close()
+        self.__exited(process, returncode)
+
+    def __exited(self, process, returncode):
+        with self._lock:
+            self.processes.pop(process.pid, None)
+            self._exited += 1
+        process.returncode = returncode
+        process._exited.set_result(returncode)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'running': len(self.processes),
+                'started': self._started,
+                'exited': self._exited,
+                'failed': self._failed
+            }
+        if self.zygote:
+            stats['zygote'] = self.zygote.stats()
+        if self.ssh_masters:
+            stats['ssh'] = self.ssh_masters.stats()
+        return stats
+
+    def shutdown(self, kill=True):
+        if self.ssh_masters:
+            self.ssh_masters.close()
+        with self._lock:
+            if not self.thread:
+                return
+            processes = list(self.processes.values())
+        if kill:
+            for process in processes:
+                process.kill()
+            for process in processes:
+                try:
+                    process.wait(5)
+                except TimeoutExpired:
+                    pass
+        if self.zygote:
+            asyncio.run_coroutine_threadsafe(self.__close_zygote(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        with self._lock:
+            self.thread = None
+            self.loop = None
+
+
+    async def __close_zygote(self):
+        self.zygote.close()
+
+
+class _PipeProtocol(asyncio.Protocol):
+    # Feeds an output pipe of a forked process to its _SupervisedProtocol.
+
+    def __init__(self, protocol, fd):
+        self.protocol = protocol
+        self.fd = fd
+
+    def data_received(self, data):
+        self.protocol.pipe_data_received(self.fd, data)
+
+    def connection_lost(self, exc):
+        self.protocol.pipe_connection_lost(self.fd, exc)
+
+
+class _ForkedTransport:
+    # Signals a process forked by the zygote, as SubprocessTransport does.
+
+    def __init__(self, pid, exited):
+        self.pid = pid
+        self.exited = exited
+
+    def send_signal(self, sig):
+        if not self.exited.done():
+            os.kill(self.pid, sig)
+
+
+def zygote_supported():
+    """Whether this Python can run a :class:`Zygote`: passing the pipes over
+    the socket and decoding the exit codes need Python 3.9.
+    """
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds') and hasattr(socket, 'recv_fds') and \
+        hasattr(os, 'waitstatus_to_exitcode')
+
+
+class Zygote:
+    """A Python process with *preload* modules imported, that forks workers
+    running Python entry points.
+
+    A forked worker starts with the interpreter of the zygote already up and
+    its modules imported, so short Python tasks do not pay for the start-up
+    of the interpreter. At most *max_workers* workers run at a time.
+
+    The zygote is started on the first fork and talks to the supervisor over
+    a unix socket: a request to fork carries the entry point and the pipes
+    for the stdout and stderr of the worker, and the zygote replies with the
+    pid of the worker, and later with its exit code.
+
+    Where the zygote is not supported (see :func:`zygote_supported`) it never
+    has room, and the supervisor starts every Python process with exec.
+    """
+
+    def __init__(self, preload=(), max_workers=16):
+        self.preload = list(preload)
+        self.max_workers = max_workers
+        self.supported = zygote_supported()
+        if not self.supported:
+            logging.warning('The zygote needs Python 3.9 or newer; Python processes are started with exec')
+        self.process = None
+        self.socket = None
+        self.loop = None
+        self.jobs = {}
+        self._seq = 0
+        self._forked = 0
+        self._restarts = 0
+
+    def has_room(self):
+        return self.supported and len(self.jobs) < self.max_workers
+
+    def fork(self, loop, job, fds):
+        """Asks the zygote to fork a worker for *job*, with its stdout and
+        stderr on *fds*. Returns futures of the pid and the exit code of the
+        worker. Must be called on *loop*.
+        """
+        self._seq += 1
+        job = dict(job, id=self._seq)
+        data = json.dumps(job).encode('utf-8')
+        for attempt in range(2):
+            if self.socket is None:
+                self.__start(loop)
+            try:
+                socket.send_fds(self.socket, [data], fds)
+                break
+            except (BrokenPipeError, ConnectionResetError):
+                # the zygote has exited, and we have not read the end of the socket yet
+                self.__closed()
+                if attempt:
+                    raise
+        started, exited = loop.create_future(), loop.create_future()
+        self.jobs[self._seq] = (started, exited)
+        return started, exited
+
+    def stats(self):
+        return {
+            'supported': self.supported,
+            'running': len(self.jobs),
+            'max_workers': self.max_workers,
+            'forked': self._forked,
+            'restarts': self._restarts
+        }
+
+    def close(self):
+        """Stops the zygote. The workers it forked keep running."""
+        if self.socket is None:
+            return
+        self.__closed()
+        try:
+            self.process.wait(5)
+        except TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def __start(self, loop):
+        if self.process:
+            self._restarts += 1
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        root = path.dirname(path.dirname(path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+        try:
+            self.process = Popen([sys.executable, '-c', 'import sys; from troup.process import _zygote_main; '
+                                  '_zygote_main(int(sys.argv[1]), sys.argv[2:])', str(theirs.fileno())] +
+                                 self.preload, pass_fds=[theirs.fileno()], stdin=DEVNULL, env=env)
+        finally:
+            theirs.close()
+        ours.setblocking(False)
+        self.socket = ours
+        self.loop = loop
+        loop.add_reader(ours, self.__read)
+
+    def __read(self):
+        while self.socket:
+            try:
+                data = self.socket.recv(65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self.__closed()
+                return
+            message = json.loads(data.decode('utf-8'))
+            started, exited = self.jobs.get(message['id'], (None, None))
+            if not started:
+                continue
+            if 'error' in message:
+                del self.jobs[message['id']]
+                started.set_exception(OSError(message['error']))
+            elif 'returncode' in message:
+                del self.jobs[message['id']]
+                exited.set_result(message['returncode'])
+            else:
+                self._forked += 1
+                started.set_result(message['pid'])
+
+    def __closed(self):
+        # the zygote is gone: the exit codes of its workers are lost
+        self.loop.remove_reader(self.socket)
+        self.socket.close()
+        self.socket = None
+        jobs, self.jobs = self.jobs, {}
+        for started, exited in jobs.values():
+            if not started.done():
+                started.set_exception(OSError('The zygote has exited'))
+            elif not exited.done():
+                exited.set_result(255)
+
+
+def _zygote_main(fd, preload):
+    # The zygote: forks a worker for every job read from the socket and
+    # reports the exit codes of the workers, until the socket is closed.
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            traceback.print_exc()
+    sock = socket.socket(fileno=fd)
+    wakeup, wakeup_w = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    selector.register(wakeup, selectors.EVENT_READ)
+    jobs = {}
+    while True:
+        for key, events in selector.select():
+            if key.fileobj is sock:
+                data, fds, flags, address = socket.recv_fds(sock, 1 << 20, 2)
+                if not data:
+                    return
+                job = json.loads(data.decode('utf-8'))
+                sys.stdout.flush()
+                sys.stderr.flush()
+                try:
+                    pid = os.fork()
+                except OSError as e:
+                    sock.send(json.dumps({'id': job['id'], 'error': str(e)}).encode('utf-8'))
+                    pid = None
+                if pid == 0:
+                    selector.close()
+                    for descriptor in (sock.fileno(), wakeup, wakeup_w):
+                        os.close(descriptor)
+                    _zygote_worker(job, fds)
+                for descriptor in fds:
+                    os.close(descriptor)
+                if pid:
+                    jobs[pid] = job['id']
+                    sock.send(json.dumps({'id': job['id'], 'pid': pid}).encode('utf-8'))
+            else:
+                try:
+                    while os.read(wakeup, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+        while jobs:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            job_id = jobs.pop(pid, None)
+            if job_id is not None:
+                sock.send(json.dumps({'id': job_id, 'returncode': os.waitstatus_to_exitcode(status)}).encode('utf-8'))
+
+
+def _zygote_worker(job, fds):
+    # Runs the entry point of the job in a freshly forked worker; never returns.
+    code = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for descriptor in [devnull] + list(fds):
+            os.close(descriptor)
+        if job.get('cwd'):
+            os.chdir(job['cwd'])
+        if job.get('env') is not None:
+            os.environ.clear()
+            os.environ.update(job['env'])
+        sys.argv = [job['target']] + job['args']
+        if job['module']:
+            runpy.run_module(job['target'], run_name='__main__', alter_sys=True)
+        else:
+            runpy.run_path(job['target'], run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+class _PidfdChildWatcher(asyncio.AbstractChildWatcher):
+    """Waits for a child on the loop that started it, with a pidfd.
+
+    Unlike ``asyncio.PidfdChildWatcher`` (Python 3.9 to 3.11), which is
+    attached to a single loop, it serves any number of loops.
+    """
+
+    def __init__(self):
+        self._children = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def is_active(self):
+        return True
+
+    def close(self):
+        pass
+
+    def attach_loop(self, loop):
+        pass
+
+    def add_child_handler(self, pid, callback, *args):
+        loop = asyncio.get_event_loop()
+        pidfd = os.pidfd_open(pid)
+        self._children[pid] = (loop, pidfd)
+        loop.add_reader(pidfd, self._do_wait, pid, callback, args)
+
+    def remove_child_handler(self, pid):
+        child = self._children.pop(pid, None)
+        if not child:
+            return False
+        loop, pidfd = child
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+        return True
+
+    def _do_wait(self, pid, callback, args):
+        self.remove_child_handler(pid)
+        try:
+            _, status = os.waitpid(pid, 0)
+            returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            returncode = 255
+        callback(pid, returncode, *args)
+
+
+def _install_child_watcher():
+    # Before Python 3.12 asyncio waits for every child in a thread of its own
+    # by default. The pidfd watcher waits on the loop instead.
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return
+    if type(asyncio.get_child_watcher()) is asyncio.ThreadedChildWatcher:
+        asyncio.set_child_watcher(_PidfdChildWatcher())
+
+
+_default_supervisor = None
+_default_supervisor_lock = Lock()
+
+
+def default_supervisor():
+    global _default_supervisor
+    with _default_supervisor_lock:
+        if _default_supervisor is None:
+            _default_supervisor = ProcessSupervisor()
+        return _default_supervisor
+
+
+class CodeError(Exception):
+    """The code run in a :class:`CodePool` failed. The message holds the
+    traceback from the worker process.
+    """
+    pass
+
+
+def _run_code(conn):
+    # Main loop of a CodePool worker: runs the jobs sent over the connection
+    # one at a time, until None or the end of the connection.
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        code, defaults, args, kwargs = job
+        try:
+            function = FunctionType(marshal.loads(code), {'__builtins__': builtins, '__name__': '__troup__'},
+                                    None, tuple(defaults) if defaults else None)
+            result = (True, function(*args, **kwargs))
+        except Exception:
+            result = (False, traceback.format_exc())
+        try:
+            conn.send(result)
+        except Exception as e:
+            conn.send((False, 'Cannot send the result back: %s' % e))
+
+
+class _CodeWorker:
+
+    def __init__(self, context, name):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_run_code, args=(child,), name=name, daemon=True)
+        self.process.start()
+        child.close()
+        self.tasks = 0
+        self.job = None
+
+    def retire(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.connection.close()
+
+    def signal_kill(self):
+        # Process.kill() is new in Python 3.7
+        try:
+            os.kill(self.process.pid, SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        self.signal_kill()
+        self.process.join()
+        self.connection.close()
+
+
+class _CodeJob:
+
+    def __init__(self, code, defaults, args, kwargs, timeout):
+        self.payload = (code, defaults, list(args), dict(kwargs or {}))
+        self.timeout = timeout
+        self.deadline = None
+        self.cancelled = False
+        self.future = Future()
+
+
+class CodePool:
+    """A pool of warm worker processes that run marshalled function code.
+
+    Each of the *size* workers runs one job at a time, so CPU bound code is
+    not held back by the GIL of the node. A worker is replaced with a fresh
+    one after *max_tasks* jobs, and is killed when a job runs longer than
+    its timeout. The workers are started with *start_method* (see
+    :mod:`multiprocessing`) on the first :meth:`submit`.
+
+    A single dispatcher thread hands the jobs to the workers and collects
+    the results.
+    """
+
+    def __init__(self, size=None, max_tasks=100, start_method='spawn', name='CodePool'):
+        self.size = size or os.cpu_count() or 1
+        self.max_tasks = max_tasks
+        self.name = name
+        self.context = multiprocessing.get_context(start_method)
+        self.thread = None
+        self._lock = Lock()
+        self._pending = deque()
+        self._idle = []
+        self._busy = {}
+        self._seq = 0
+        self._stopped = False
+        self._wakeup_reader, self._wakeup_writer = self.context.Pipe(duplex=False)
+        self._completed = 0
+        self._failed = 0
+        self._timeouts = 0
+        self._recycled = 0
+
+    def start(self):
+        with self._lock:
+            if self.thread or self._stopped:
+                return
+            self._idle = [self.__new_worker() for i in range(self.size)]
+            self.thread = Thread(target=self.__dispatch, name=self.name, daemon=True)
+            self.thread.start()
+
+    def submit(self, code, args=(), kwargs=None, timeout=None, defaults=None):
+        """Runs the function with the marshalled *code* object in a worker
+        with *args* and *kwargs*. Returns a future of its result; the future
+        fails with :class:`CodeError` if the function raised, and with a
+        ``TimeoutError`` if it did not return in *timeout* seconds.
+        """
+        self.start()
+        job = _CodeJob(code, defaults, args, kwargs, timeout)
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError('%s is shut down' % self.name)
+            self._pending.append(job)
+        self.__wakeup()
+        return job.future
+
+    def cancel(self, future):
+        """Cancels a queued job, or kills the worker running it."""
+        if future.cancel():
+            return
+        with self._lock:
+            for worker in self._busy.values():
+                if worker.job.future is future:
+                    worker.job.cancelled = True
+                    worker.signal_kill()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.size,
+                'busy': len(self._busy),
+                'pending': len(self._pending),
+                'completed': self._completed,
+                'failed': self._failed,
+                'timeouts': self._timeouts,
+                'recycled': self._recycled
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            thread = self.thread
+        if not thread:
+            self.__close_wakeup()
+            return
+        self.__wakeup()
+        if wait:
+            thread.join()
+
+    def __new_worker(self):
+        self._seq += 1
+        return _CodeWorker(self.context, '%s-worker-%d' % (self.name, self._seq))
+
+    def __wakeup(self):
+        try:
+            self._wakeup_writer.send_bytes(b'')
+        except OSError:
+            pass
+
+    def __dispatch(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    break
+                self.__assign()
+                deadlines = [worker.job.deadline for worker in self._busy.values() if worker.job.deadline]
+                waiting = list(self._busy)
+            timeout = max(0, min(deadlines) - monotonic()) if deadlines else None
+            try:
+                for conn in connection.wait(waiting + [self._wakeup_reader], timeout):
+                    if conn is self._wakeup_reader:
+                        while self._wakeup_reader.poll():
+                            self._wakeup_reader.recv_bytes()
+                    else:
+                        self.__collect(conn)
+                self.__expire()
+            except Exception as e:
+                # the jobs fail on their own; the dispatcher must go on
+                logging.exception('%s dispatcher failed: %s', self.name, e)
+        self.__stop_workers()
+
+    def __assign(self):
+        while self._pending and self._idle:
+            job = self._pending.popleft()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            worker = self._idle.pop()
+            worker.job = job
+            if job.timeout:
+                job.deadline = monotonic() + job.timeout
+            try:
+                worker.connection.send(job.payload)
+            except Exception as e:
+                # the job could not be pickled; the worker is still fine
+                worker.job = None
+                self._idle.append(worker)
+                self._failed += 1
+                job.future.set_exception(e)
+                continue
+            self._busy[worker.connection] = worker
+
+    def __collect(self, conn):
+        with self._lock:
+            worker = self._busy.pop(conn)
+            job, worker.job = worker.job, None
+        try:
+            ok, value = conn.recv()
+        except (EOFError, OSError):
+            if job.cancelled:
+                error = CancelledError()
+            else:
+                error = CodeError('Worker exited with code %s' % worker.process.exitcode)
+            self.__replace(worker, recycled=False)
+            self.__fail(job, error)
+            return
+        worker.tasks += 1
+        if self.max_tasks and worker.tasks >= self.max_tasks:
+            self.__replace(worker, recycled=True)
+        else:
+            with self._lock:
+                self._idle.append(worker)
+        if ok:
+            with self._lock:
+                self._completed += 1
+            job.future.set_result(value)
+        else:
+            self.__fail(job, CodeError(value))
+
+    def __expire(self):
+        now = monotonic()
+        with self._lock:
+            expired = [worker for worker in self._busy.values() if worker.job.deadline and worker.job.deadline <= now]
+            for worker in expired:
+                del self._busy[worker.connection]
+                self._timeouts += 1
+        for worker in expired:
+            job, worker.job = worker.job, None
+            self.__replace(worker, recycled=False)
+            self.__fail(job, TimeoutError('Code did not finish in %s seconds' % job.timeout))
+
+    def __replace(self, worker, recycled):
+        try:
+            if recycled:
+                worker.retire()
+            else:
+                worker.kill()
+        except Exception as e:
+            logging.exception('Failed to stop worker %s: %s', worker.process.name, e)
+        with self._lock:
+            if recycled:
+                self._recycled += 1
+            if not self._stopped:
+                self._idle.append(self.__new_worker())
+
+    def __fail(self, job, error):
+        with self._lock:
+            self._failed += 1
+        job.future.set_exception(error)
+
+    def __stop_workers(self):
+        with self._lock:
+            pending, self._pending = list(self._pending), deque()
+            busy, self._busy = list(self._busy.values()), {}
+            idle, self._idle = self._idle, []
+        for job in pending:
+            job.future.cancel()
+        for worker in busy:
+            job, worker.job = worker.job, None
+            worker.kill()
+            job.future.set_exception(CodeError('%s was shut down' % self.name))
+        for worker in idle:
+            worker.retire()
+        for worker in idle:
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.signal_kill()
+        self.__close_wakeup()
+
+    def __close_wakeup(self):
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
 # Process lock-files and IPC
 
 class LockFile:
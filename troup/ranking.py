@@ -0,0 +1,376 @@
+# Copyright 2016 Pavle Jonoski
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = 'pavle'
+
+from heapq import nlargest, heappush, heappop
+from threading import RLock
+from time import time
+from uuid import uuid4
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_weights_cache = {}
+
+
+def normalized_weights(needs):
+    """Weights of the needs of an app, normalized to the largest need. The
+    result is cached for every distinct set of needs.
+    """
+    key = tuple(sorted(needs.items()))
+    weights = _weights_cache.get(key)
+    if weights is None:
+        m = max(needs.values())
+        weights = _weights_cache[key] = {k: v/m for k, v in needs.items()}
+    return weights
+
+
+MB = 1024 * 1024
+
+
+def needs_row(needs):
+    """The (cpu, memory, disk) values to subtract from the stats row of a node
+    for reserved *needs*, in the units of the stats (see :func:`stats_row`).
+
+    The needs of an app (:attr:`troup.apps.App.needs`) are given as ``cpu``
+    in bogomips, ``memory`` in megabytes and ``disk`` in percent of the io
+    capacity of the node. Reserved disk needs add to the io load.
+    """
+    return (needs.get('cpu', 0), needs.get('memory', 0) * MB, -needs.get('disk', 0) / 100)
+
+
+def stats_row(stats):
+    """The (cpu, memory, disk) values of the stats of a node used for ranking.
+    The cpu value is the available bogomips: total bogomips * (1 - cpu usage).
+    """
+    if stats is None:
+        return None
+    return (stats.cpu['bogomips']['total'] * (1 - stats.cpu['usage']),
+            stats.memory['available'],
+            stats.disk['ioload'])
+
+
+class NodeStatsTable:
+    """Stats of the known nodes, kept in columns (one array per stat), so all
+    the nodes are scored in a single vectorized pass.
+
+    The columns are NumPy arrays when NumPy is available, plain lists
+    otherwise. Nodes without stats are always ranked last.
+
+    The score of a node is ``cpu * W['cpu'] + memory * W['memory'] - disk * W['disk']``
+    where ``W`` are the needs of the app normalized by :func:`normalized_weights`.
+    Needs reserved on a node with :meth:`set_reserved` are subtracted from its
+    stats before scoring.
+    """
+
+    def __init__(self, use_numpy=None):
+        self.use_numpy = (numpy is not None) if use_numpy is None else use_numpy
+        self.names = []
+        self.index = {}
+        self.lock = RLock()
+        if self.use_numpy:
+            self.columns = numpy.zeros((3, 16))
+            self.reserved = numpy.zeros((3, 16))
+            self.valid = numpy.zeros(16, dtype=bool)
+        else:
+            self.columns = [[], [], []]
+            self.reserved = [[], [], []]
+            self.valid = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def update(self, name, stats):
+        row = stats_row(stats)
+        with self.lock:
+            i = self.__row(name)
+            if row is None:
+                self.valid[i] = False
+            else:
+                self.valid[i] = True
+                for column, value in zip(self.columns, row):
+                    column[i] = value
+
+    def update_node(self, node_info):
+        self.update(node_info.name, node_info.stats)
+
+    def set_reserved(self, name, needs):
+        """Sets the total *needs* reserved on the node."""
+        with self.lock:
+            i = self.__row(name)
+            for column, value in zip(self.reserved, needs_row(needs)):
+                column[i] = value
+
+    def __row(self, name):
+        i = self.index.get(name)
+        if i is None:
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+            self.__append_row()
+        return i
+
+    def remove(self, name):
+        """Removes the row of the node by moving the last row in its place."""
+        with self.lock:
+            i = self.index.pop(name, None)
+            if i is None:
+                return
+            last = len(self.names) - 1
+            if i != last:
+                moved = self.names[last]
+                self.names[i] = moved
+                self.index[moved] = i
+                for column in self.columns:
+                    column[i] = column[last]
+                for column in self.reserved:
+                    column[i] = column[last]
+                self.valid[i] = self.valid[last]
+            self.names.pop()
+            if not self.use_numpy:
+                for column in self.columns + self.reserved:
+                    column.pop()
+                self.valid.pop()
+
+    def rank(self, needs, names=None, k=None):
+        """Ranks the nodes (all or only *names*) for an app with the given
+        *needs*. Returns at most *k* ``(name, score)`` pairs with the highest
+        scores, best first. The score of a node without stats is ``None``.
+        """
+        weights = normalized_weights(needs)
+        w = (weights.get('cpu', 0), weights.get('memory', 0), -weights.get('disk', 0))
+        with self.lock:
+            if names is None:
+                rows = list(range(len(self.names)))
+            else:
+                rows = [self.index[name] for name in names if name in self.index]
+            if k is None or k > len(rows):
+                k = len(rows)
+            if not k:
+                return []
+            if self.use_numpy:
+                return self.__rank_numpy(rows, w, k)
+            return self.__rank_lists(rows, w, k)
+
+    def __rank_numpy(self, rows, w, k):
+        rows = numpy.array(rows, dtype=numpy.intp)
+        valid = self.valid[rows]
+        scores = numpy.dot(w, self.columns[:, rows] - self.reserved[:, rows])
+        scores[~valid] = -numpy.inf
+        if k < len(rows):
+            top = numpy.argpartition(-scores, k - 1)[:k]
+        else:
+            top = numpy.arange(len(rows))
+        top = top[numpy.argsort(-scores[top], kind='stable')]
+        return [(self.names[rows[i]], float(scores[i]) if valid[i] else None) for i in top]
+
+    def __rank_lists(self, rows, w, k):
+        cpu, memory, disk = self.columns
+        rcpu, rmemory, rdisk = self.reserved
+        wc, wm, wd = w
+        valid = self.valid
+        scored = [((cpu[i] - rcpu[i]) * wc + (memory[i] - rmemory[i]) * wm + (disk[i] - rdisk[i]) * wd
+                   if valid[i] else float('-inf'), i) for i in rows]
+        top = nlargest(k, scored, key=lambda s: s[0])
+        return [(self.names[i], score if valid[i] else None) for score, i in top]
+
+    def __append_row(self):
+        if not self.use_numpy:
+            for column in self.columns + self.reserved:
+                column.append(0)
+            self.valid.append(False)
+            return
+        size = len(self.names)
+        if size > self.valid.shape[0]:
+            capacity = self.valid.shape[0] * 2
+            columns = numpy.zeros((3, capacity))
+            columns[:, :size - 1] = self.columns[:, :size - 1]
+            reserved = numpy.zeros((3, capacity))
+            reserved[:, :size - 1] = self.reserved[:, :size - 1]
+            valid = numpy.zeros(capacity, dtype=bool)
+            valid[:size - 1] = self.valid[:size - 1]
+            self.columns = columns
+            self.reserved = reserved
+            self.valid = valid
+        self.valid[size - 1] = False
+        self.reserved[:, size - 1] = 0
+
+
+class ReservationLedger:
+    """Capacity reserved on the nodes for apps placed on them, which the
+    gossiped stats of the nodes do not show yet.
+
+    A reservation holds the needs of an app placed on a node. The total needs
+    reserved on a node are subtracted from its stats in the
+    :class:`NodeStatsTable`. A reservation is released when stats of the node
+    measured at least *settle* milliseconds after the placement arrive (see
+    :meth:`on_stats`), or when it is older than *ttl* milliseconds.
+
+    The reservations are gossiped as rumours: a reservation made here or
+    newly received is returned by :meth:`gossip` for the next *retransmit*
+    digests, and :meth:`merge` adds the ones received from other nodes. The
+    times are wall clock milliseconds, so the clocks of the nodes should be
+    roughly in sync. The reservations expire from a heap ordered by their
+    deadline.
+    """
+
+    def __init__(self, node_stats, local_node=None, settle=1000, ttl=10000, retransmit=3):
+        self.node_stats = node_stats
+        self.local_node = local_node
+        self.settle = settle
+        self.ttl = ttl
+        self.retransmit = retransmit
+        self.reservations = {}
+        self.by_node = {}
+        self.stats_at = {}
+        self.rumours = {}
+        self.deadlines = []
+        self.lock = RLock()
+
+    def reserve(self, node, needs, reservation_id=None, at=None):
+        """Reserves *needs* on *node* and returns the id of the reservation."""
+        reservation = {
+            'id': reservation_id or str(uuid4()),
+            'node': node,
+            'needs': dict(needs or {}),
+            'at': at or int(time() * 1000),
+            'by': self.local_node
+        }
+        with self.lock:
+            self.__add(reservation)
+            self.__update_totals(node)
+        return reservation['id']
+
+    def release(self, reservation_id):
+        with self.lock:
+            reservation = self.__remove(reservation_id)
+            if reservation:
+                self.__update_totals(reservation['node'])
+
+    def on_stats(self, node, measured_at):
+        """Releases the reservations on *node* that stats measured at
+        *measured_at* already account for.
+        """
+        if not measured_at:
+            return
+        with self.lock:
+            if measured_at <= self.stats_at.get(node, 0):
+                return
+            self.stats_at[node] = measured_at
+            released = [rid for rid in self.by_node.get(node, ())
+                        if self.reservations[rid]['at'] + self.settle <= measured_at]
+            for rid in released:
+                self.__remove(rid)
+            if released:
+                self.__update_totals(node)
+
+    def remove_node(self, node):
+        with self.lock:
+            for rid in list(self.by_node.get(node, ())):
+                self.__remove(rid)
+            self.stats_at.pop(node, None)
+
+    def expire(self, now=None):
+        now = now or int(time() * 1000)
+        with self.lock:
+            nodes = set()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, rid = heappop(self.deadlines)
+                # released reservations stay in the heap until their deadline
+                reservation = self.__remove(rid)
+                if reservation:
+                    nodes.add(reservation['node'])
+            for node in nodes:
+                self.__update_totals(node)
+
+    def merge(self, reservations, now=None):
+        """Adds the reservations received from another node, unless they are
+        known, expired or already accounted for in the stats.
+        """
+        now = now or int(time() * 1000)
+        with self.lock:
+            nodes = set()
+            for reservation in reservations:
+                rid = reservation.get('id')
+                node = reservation.get('node')
+                at = reservation.get('at') or 0
+                if not rid or not node or rid in self.reservations:
+                    continue
+                if at + self.ttl <= now or at + self.settle <= self.stats_at.get(node, 0):
+                    continue
+                self.__add(dict(reservation))
+                nodes.add(node)
+            for node in nodes:
+                self.__update_totals(node)
+
+    def active(self):
+        """All reservations that have not expired."""
+        self.expire()
+        with self.lock:
+            return list(self.reservations.values())
+
+    def gossip(self):
+        """The reservations to send in the next digest: the ones made or
+        received in the last *retransmit* calls.
+        """
+        self.expire()
+        with self.lock:
+            reservations = []
+            for rid in list(self.rumours):
+                reservations.append(self.reservations[rid])
+                self.rumours[rid] -= 1
+                if self.rumours[rid] <= 0:
+                    del self.rumours[rid]
+            return reservations
+
+    def reserved(self, node):
+        """Total needs reserved on *node*."""
+        with self.lock:
+            totals = {}
+            for rid in self.by_node.get(node, ()):
+                for need, value in self.reservations[rid]['needs'].items():
+                    totals[need] = totals.get(need, 0) + value
+            return totals
+
+    def __len__(self):
+        return len(self.reservations)
+
+    def __add(self, reservation):
+        self.reservations[reservation['id']] = reservation
+        self.rumours[reservation['id']] = self.retransmit
+        heappush(self.deadlines, (reservation['at'] + self.ttl, reservation['id']))
+        ids = self.by_node.get(reservation['node'])
+        if ids is None:
+            ids = self.by_node[reservation['node']] = set()
+        ids.add(reservation['id'])
+
+    def __remove(self, rid):
+        reservation = self.reservations.pop(rid, None)
+        self.rumours.pop(rid, None)
+        if reservation:
+            ids = self.by_node.get(reservation['node'])
+            ids.discard(rid)
+            if not ids:
+                del self.by_node[reservation['node']]
+        return reservation
+
+    def __update_totals(self, node):
+        if node in self.node_stats or node in self.by_node:
+            self.node_stats.set_reserved(node, self.reserved(node))
@@ -0,0 +1,184 @@
+# Copyright 2016 Pavle Jonoski
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = 'pavle'
+
+from troup.tasks import TaskRun, TaskException
+from troup.threading import ExpiryHeap
+from concurrent.futures import Future, TimeoutError
+from threading import RLock
+from uuid import uuid4
+import logging
+
+
+class RemoteTaskException(TaskException):
+    pass
+
+
+class RemoteTaskRun:
+    """A run of a task forwarded to another node.
+
+    The node runs the task with its own :class:`troup.tasks.TasksRunner` and
+    reports back the status of the run (``task-status`` messages); the
+    status, the result and the error are those of the run on that node.
+    :attr:`future` is done once the run is over.
+    """
+
+    FINAL = (TaskRun.DONE, TaskRun.ERROR)
+    STATUSES = {status: status for status in TaskRun.STATUSES}
+
+    def __init__(self, node, task_id):
+        self.node = node
+        self.id = task_id
+        self.status = TaskRun.CREATED
+        self.result = None
+        self.error = None
+        self.accepted = Future()
+        self.future = Future()
+
+    def update(self, status, result=None, error=None):
+        """Applies a status reported by the node. Returns whether the run is
+        over; the reports that come after that are ignored.
+        """
+        if self.status in RemoteTaskRun.FINAL:
+            return False
+        # the decoded status is mapped back to the TaskRun constant
+        status = RemoteTaskRun.STATUSES.get(status, status)
+        self.status = status
+        if status not in RemoteTaskRun.FINAL:
+            return False
+        self.result = result
+        self.error = error
+        self.future.set_result(None)
+        return True
+
+    def __repr__(self):
+        return '<RemoteTaskRun %s on %s: %s>' % (self.id, self.node, self.status)
+
+
+class RemoteTasks:
+    """Forwards tasks to other nodes over the channels of the
+    :class:`troup.infrastructure.ChannelManager` and tracks their runs.
+
+    A forwarded task is sent as a ``task`` message with the
+    ``report-status`` header, and the node running it sends the changes of
+    its status back over the same channel. The ``reply`` and ``task-status``
+    messages are taken from the message *bus* of the node. Runs that are
+    over are kept for *retain* milliseconds. The runs on a node that left
+    fail (see :meth:`node_left`).
+    """
+
+    def __init__(self, node_id, channel_manager, bus, reply_timeout=10000, retain=60000):
+        self.node_id = node_id
+        self.channel_manager = channel_manager
+        self.bus = bus
+        self.reply_timeout = reply_timeout
+        self.retain = retain
+        self.pending = {}
+        self.runs = {}
+        self.retained = ExpiryHeap(on_expired=self.__on_expired)
+        self._lock = RLock()
+        self.log = logging.getLogger('RemoteTasks(%s)' % node_id)
+
+    def start(self):
+        self.bus.on('reply', self.on_reply)
+        self.bus.on('task-status', self.on_status)
+
+    def stop(self):
+        self.bus.remove('reply', self.on_reply)
+        self.bus.remove('task-status', self.on_status)
+        self.retained.clear()
+
+    def forward(self, node, endpoint, task):
+        """Sends the *task* message to *node* at *endpoint* and waits until the
+        node has accepted it. Returns the :class:`RemoteTaskRun`; raises
+        :class:`RemoteTaskException` if the node refused the task or did not
+        reply in time.
+        """
+        task_id = task.headers.get('task-id') or str(uuid4())
+        task.headers['task-id'] = task_id
+        task.headers['report-status'] = True
+        task.headers['submitter'] = self.node_id
+        run = RemoteTaskRun(node, task_id)
+        with self._lock:
+            self.pending[task.id] = run
+            self.runs[task_id] = run
+        try:
+            self.channel_manager.send_message(to_url=endpoint, message=task)
+            run.accepted.result(self.reply_timeout / 1000)
+        except Exception as e:
+            with self._lock:
+                self.runs.pop(task_id, None)
+            if isinstance(e, TimeoutError):
+                raise RemoteTaskException('Node %s did not accept task %s in time' % (node, task_id))
+            raise
+        finally:
+            with self._lock:
+                self.pending.pop(task.id, None)
+        return run
+
+    def get(self, task_id):
+        return self.runs.get(task_id)
+
+    def stats(self):
+        with self._lock:
+            statuses = {}
+            for run in self.runs.values():
+                statuses[run.status] = statuses.get(run.status, 0) + 1
+            return {'runs': len(self.runs), 'retained': len(self.retained), 'statuses': statuses}
+
+    def node_left(self, node):
+        """Fails the runs on *node*, which has left or is known to have
+        failed.
+        """
+        error = 'Node %s left' % node
+        failed = 0
+        with self._lock:
+            for run in list(self.runs.values()):
+                if run.node != node or run.status in RemoteTaskRun.FINAL:
+                    continue
+                if not run.accepted.done():
+                    run.accepted.set_exception(RemoteTaskException(error))
+                if run.update(TaskRun.ERROR, error=error):
+                    self.retained.add(run.id, run, self.retain)
+                failed += 1
+        if failed:
+            self.log.info('%d runs on node %s failed as the node left', failed, node)
+
+    def on_reply(self, msg, channel=None):
+        data = msg.data or {}
+        with self._lock:
+            run = self.pending.get(msg.headers.get('reply-for'))
+            if not run or run.accepted.done():
+                return
+            if data.get('error'):
+                run.accepted.set_exception(RemoteTaskException('Node %s refused task %s: %s' %
+                                                               (run.node, run.id, data.get('reply'))))
+            else:
+                run.accepted.set_result(data.get('reply'))
+
+    def on_status(self, msg, channel=None):
+        data = msg.data or {}
+        with self._lock:
+            run = self.runs.get(msg.headers.get('task-id'))
+            if not run:
+                return
+            if run.update(data.get('status'), data.get('result'), data.get('error')):
+                self.log.debug('Task %s on %s is over: %s', run.id, run.node, run.status)
+                self.retained.add(run.id, run, self.retain)
+
+    def __on_expired(self, task_id, run):
+        with self._lock:
+            if self.runs.get(task_id) is run:
+                del self.runs[task_id]
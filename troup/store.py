@@ -14,12 +14,20 @@
 
 import json
 import os
+import logging
+from collections import deque
+from threading import RLock
 from troup.apps import App
+from troup.observer import Observable
+from troup.threading import default_scheduler
 
 __author__ = 'pavle'
 
 
-class Store:
+class Store(Observable):
+    """Local storage of the apps and settings of a node. Triggers
+    ``apps.changed`` whenever the stored apps change.
+    """
 
     def add_app(self, app):
         pass
@@ -48,18 +56,83 @@ class Store:
     def set_setting(self, name, value):
         pass
 
+    def flush(self):
+        """Writes the pending changes to the storage."""
+        pass
+
+    def close(self):
+        self.flush()
+
+
+def atomic_write(path, data):
+    """Replaces the content of the file at *path* with *data*.
+
+    The data is written to a temporary file next to it, synced to disk and
+    renamed over the file, so the file holds either the old or the new
+    content even if the process crashes in the middle of the write.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def app_from_json(app_json):
+    return App(name=app_json['name'], description=app_json.get('description'),\
+        command=app_json['command'], params=app_json.get('params'),\
+        needs=app_json.get('needs'))
+
 
 class InMemorySyncedStore(Store):
+    """Keeps the apps and settings in memory and writes them to JSON files
+    under *root_path*.
+
+    The changes are written behind: a change marks the apps or settings as
+    dirty and they are written *flush_delay* milliseconds later, so the
+    changes made in the meantime go in a single write. With no delay every
+    change is written right away; a delayed write that fails is retried
+    *flush_delay* milliseconds later. :meth:`flush` writes the pending changes
+    immediately. The files are always replaced atomically (see
+    :func:`atomic_write`).
+    """
 
     APPS_FILE = 'apps.json'
     SETTINGS_FILE = 'settings.json'
 
-    def __init__(self, root_path, apps_file=None, settings_file=None):
+    def __init__(self, root_path, apps_file=None, settings_file=None, flush_delay=0, scheduler=None):
+        super(InMemorySyncedStore, self).__init__()
         self.root_path = root_path
         self.apps = {}
         self.settings = {}
         self.apps_file = apps_file or InMemorySyncedStore.APPS_FILE
         self.settings_file = settings_file or InMemorySyncedStore.SETTINGS_FILE
+        self.flush_delay = flush_delay
+        self.scheduler = scheduler or default_scheduler()
+        self.dirty = set()
+        self.changes = 0
+        self.writes = 0
+        self._flush_call = None
+        self._closed = False
+        self._lock = RLock()
+        self._flush_lock = RLock()
+        self.log = logging.getLogger('InMemorySyncedStore')
         self.__check_storage_files__()
         self.load_from_file()
 
@@ -71,8 +144,7 @@ class InMemorySyncedStore(Store):
 
     def __check_storage_file__(self, f_path):
         if not self.__exists_and_is_file__(f_path):
-            with open(self.__to_path__(f_path), 'w') as file:
-                file.write('{}')
+            atomic_write(self.__to_path__(f_path), '{}')
 
     def __exists_and_is_file__(self, path):
         path = self.__to_path__(path)
@@ -87,12 +159,10 @@ class InMemorySyncedStore(Store):
         return apps
 
     def __get_app__(self, app_json):
-        return App(name=app_json['name'], description=app_json.get('description'),\
-            command=app_json['command'], params=app_json.get('params'),\
-            needs=app_json.get('needs'))
+        return app_from_json(app_json)
 
     def __load__settings__(self):
-        return json.loads(self.__load__(self.__to_path__(self.apps_file)))
+        return json.loads(self.__load__(self.__to_path__(self.settings_file)))
 
     def __to_path__(self, file_name):
         return os.path.join(self.root_path, file_name)
@@ -104,38 +174,114 @@ class InMemorySyncedStore(Store):
         raise Exception('Unable to read: %s. File does not exist or is not a file' % path)
 
     def __store__(self, path, data):
-        path = self.__to_path__(path)
-        with open(path, 'w') as file:
-            file.write(data)
+        atomic_write(self.__to_path__(path), data)
+        self.writes += 1
 
     def load_from_file(self):
         self.apps = self.__load_apps__()
+        self.trigger('apps.changed')
         self.settings = self.__load__settings__()
 
     def ___store_apps___(self):
-        apps_json = json.dumps(self.apps, cls=DictEncoder)
-        self.__store__(self.apps_file, apps_json)
+        self.__changed__('apps')
 
     def __store_settings__(self):
-        settings_json = json.dumps(self.settings)
-        self.__store__(self.settings_file, settings_json)
+        self.__changed__('settings')
+
+    def __changed__(self, what):
+        with self._lock:
+            self.dirty.add(what)
+            self.changes += 1
+            if self.flush_delay and not self._flush_call:
+                self._flush_call = self.scheduler.call_later(self.flush_delay, self.__flush_later__,
+                                                             name='store-flush', blocking=True)
+        if not self.flush_delay:
+            self.flush()
+
+    def __flush_later__(self):
+        with self._lock:
+            self._flush_call = None
+        try:
+            self.flush()
+        except Exception as e:
+            self.log.exception('Failed to write the store, retrying in %dms: %s', self.flush_delay, e)
+            # the changes are still pending, but nothing else would write them
+            with self._lock:
+                if not self._flush_call and not self._closed:
+                    self._flush_call = self.scheduler.call_later(self.flush_delay, self.__flush_later__,
+                                                                 name='store-flush', blocking=True)
+
+    def flush(self):
+        """Writes the pending changes now. The files are written in the calling
+        thread; a write that fails leaves its changes pending and the error is
+        raised once the other files are written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty = self.dirty
+                self.dirty = set()
+                writes = []
+                if 'apps' in dirty:
+                    writes.append(('apps', self.apps_file, json.dumps(self.apps, cls=DictEncoder)))
+                if 'settings' in dirty:
+                    writes.append(('settings', self.settings_file, json.dumps(self.settings)))
+            error = None
+            for what, path, content in writes:
+                try:
+                    self.__store__(path, content)
+                except Exception as e:
+                    # the other files are still written; the failed one stays pending
+                    with self._lock:
+                        self.dirty.add(what)
+                    error = error or e
+            if error:
+                raise error
 
     def sync(self):
-        self.___store_apps___()
-        self.__store_settings__()
+        with self._lock:
+            self.dirty.update(('apps', 'settings'))
+        self.flush()
+
+    def close(self):
+        """Cancels the delayed write and writes the pending changes."""
+        with self._lock:
+            self._closed = True
+            if self._flush_call:
+                self._flush_call.cancel()
+                self._flush_call = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'changes': self.changes, 'writes': self.writes, 'dirty': sorted(self.dirty)}
 
     def add_app(self, app):
-        self.apps[app.name] = app
+        with self._lock:
+            self.apps[app.name] = app
+        self.___store_apps___()
+        self.trigger('apps.changed')
+
+    def add_apps(self, apps):
+        """Adds (or replaces) all *apps* as a single change."""
+        with self._lock:
+            for app in apps:
+                self.apps[app.name] = app
         self.___store_apps___()
+        self.trigger('apps.changed')
 
     def remove_app(self, app_name):
-        if self.apps.get(app_name):
+        with self._lock:
+            if not self.apps.get(app_name):
+                return
             del self.apps[app_name]
-            self.___store_apps___()
+        self.___store_apps___()
+        self.trigger('apps.changed')
 
     def update_app(self, app):
-        self.apps[app.name] = app
+        with self._lock:
+            self.apps[app.name] = app
         self.___store_apps___()
+        self.trigger('apps.changed')
 
     def find_app(self, app_name):
         return self.apps.get(app_name)
@@ -149,7 +295,8 @@ class InMemorySyncedStore(Store):
         return apps
 
     def store_settings(self, settings):
-        self.settings.update(settings)
+        with self._lock:
+            self.settings.update(settings)
         self.__store_settings__()
 
     def get_settings(self):
@@ -159,10 +306,208 @@ class InMemorySyncedStore(Store):
         return self.settings.get(setting_name)
 
     def set_setting(self, name, value):
-        self.settings[name] = value
+        with self._lock:
+            self.settings[name] = value
         self.__store_settings__()
 
 
+class LogStore(Store):
+    """Keeps the apps and settings in memory and records every change as an
+    entry appended to a journal file under *root_path*, so a change costs one
+    append regardless of the number of apps.
+
+    On start the state is loaded from the snapshot file and the journal
+    entries written after it are replayed; a torn entry at the end of the
+    journal (from a crash in the middle of an append) is dropped. Once the
+    journal grows past *compact_size* bytes (and past the size of the
+    snapshot) the state is written to a new snapshot and the journal is
+    started anew.
+
+    The entries are appended to the journal but synced to disk only with
+    *sync* set, on :meth:`flush` and on compaction. Every entry has a
+    sequence number; :meth:`changes` returns the last *feed_size* entries
+    and every new entry is triggered as ``store.changed``.
+    """
+
+    JOURNAL_FILE = 'journal.log'
+    SNAPSHOT_FILE = 'snapshot.json'
+
+    def __init__(self, root_path, journal_file=None, snapshot_file=None, compact_size=1024*1024, sync=False,
+                 feed_size=1000):
+        super(LogStore, self).__init__()
+        self.root_path = root_path
+        self.journal_path = os.path.join(root_path, journal_file or LogStore.JOURNAL_FILE)
+        self.snapshot_path = os.path.join(root_path, snapshot_file or LogStore.SNAPSHOT_FILE)
+        self.compact_size = compact_size
+        self.sync = sync
+        self.apps = {}
+        self.settings = {}
+        self.seq = 0
+        self.feed = deque(maxlen=feed_size)
+        self.journal = None
+        self.journal_size = 0
+        self.snapshot_size = 0
+        self.appends = 0
+        self.compactions = 0
+        self._lock = RLock()
+        self.log = logging.getLogger('LogStore')
+        if not os.path.exists(root_path):
+            os.makedirs(root_path, 0o755)
+        self.__load__()
+
+    def __load__(self):
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+            self.seq = snapshot.get('seq', 0)
+            self.apps = {name: app_from_json(app) for name, app in snapshot.get('apps', {}).items()}
+            self.settings = snapshot.get('settings') or {}
+            self.snapshot_size = os.path.getsize(self.snapshot_path)
+        valid = self.__replay__()
+        self.journal = open(self.journal_path, 'ab')
+        if self.journal.tell() > valid:
+            self.log.warning('Dropping the torn end of the journal %s at %d', self.journal_path, valid)
+            self.journal.truncate(valid)
+            self.journal.seek(valid)
+        self.journal_size = valid
+        self.trigger('apps.changed')
+
+    def __replay__(self):
+        """Applies the journal entries that are not in the snapshot. Returns
+        the length of the valid part of the journal.
+        """
+        valid = 0
+        if not os.path.isfile(self.journal_path):
+            return valid
+        with open(self.journal_path, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                valid += len(line)
+                if entry['seq'] > self.seq:
+                    self.__apply__(entry)
+                    self.seq = entry['seq']
+        return valid
+
+    def __apply__(self, entry):
+        op = entry['op']
+        if op == 'app':
+            app = app_from_json(entry['app'])
+            self.apps[app.name] = app
+        elif op == 'remove-app':
+            self.apps.pop(entry['name'], None)
+        elif op == 'settings':
+            self.settings.update(entry['settings'])
+        else:
+            raise Exception('Unknown journal entry %s' % op)
+
+    def __append__(self, entries):
+        with self._lock:
+            data = []
+            for entry in entries:
+                self.seq += 1
+                entry['seq'] = self.seq
+                self.__apply__(entry)
+                data.append(json.dumps(entry, cls=DictEncoder))
+                self.feed.append(entry)
+            data = ('\n'.join(data) + '\n').encode('utf-8')
+            self.journal.write(data)
+            self.journal.flush()
+            if self.sync:
+                os.fsync(self.journal.fileno())
+            self.journal_size += len(data)
+            self.appends += 1
+            if self.journal_size > max(self.compact_size, self.snapshot_size):
+                self.compact()
+        for entry in entries:
+            self.trigger('store.changed', entry)
+
+    def compact(self):
+        """Writes the state to the snapshot and empties the journal."""
+        with self._lock:
+            snapshot = json.dumps({'seq': self.seq, 'apps': self.apps, 'settings': self.settings},
+                                  cls=DictEncoder)
+            atomic_write(self.snapshot_path, snapshot)
+            self.snapshot_size = len(snapshot)
+            # the entries left in the journal if this truncate is lost are
+            # skipped on replay as their sequence numbers are in the snapshot
+            self.journal.truncate(0)
+            self.journal.seek(0)
+            self.journal_size = 0
+            self.compactions += 1
+
+    def changes(self, since=0):
+        """The entries appended after sequence number *since*, or ``None`` if
+        some of them are no longer kept.
+        """
+        with self._lock:
+            if since >= self.seq:
+                return []
+            if not self.feed or self.feed[0]['seq'] > since + 1:
+                return None
+            return [entry for entry in self.feed if entry['seq'] > since]
+
+    def flush(self):
+        with self._lock:
+            if self.journal:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+
+    def close(self):
+        with self._lock:
+            if self.journal:
+                self.flush()
+                self.journal.close()
+                self.journal = None
+
+    def stats(self):
+        with self._lock:
+            return {'seq': self.seq, 'appends': self.appends, 'compactions': self.compactions,
+                    'journal_size': self.journal_size, 'snapshot_size': self.snapshot_size}
+
+    def add_app(self, app):
+        self.__append__([{'op': 'app', 'app': dict(vars(app))}])
+        self.trigger('apps.changed')
+
+    def add_apps(self, apps):
+        """Adds (or replaces) all *apps* with a single append."""
+        self.__append__([{'op': 'app', 'app': dict(vars(app))} for app in apps])
+        self.trigger('apps.changed')
+
+    def remove_app(self, app_name):
+        if not self.apps.get(app_name):
+            return
+        self.__append__([{'op': 'remove-app', 'name': app_name}])
+        self.trigger('apps.changed')
+
+    def update_app(self, app):
+        self.add_app(app)
+
+    def find_app(self, app_name):
+        return self.apps.get(app_name)
+
+    def search_apps(self, query):
+        ql = query.lower()
+        return [app for name, app in list(self.apps.items())
+                if ql in name.lower() or (app.description and ql in app.description.lower())]
+
+    def store_settings(self, settings):
+        self.__append__([{'op': 'settings', 'settings': dict(settings)}])
+
+    def get_settings(self):
+        return self.settings
+
+    def get_setting(self, setting_name):
+        return self.settings.get(setting_name)
+
+    def set_setting(self, name, value):
+        self.store_settings({name: value})
+
+
 class DictEncoder(json.JSONEncoder):
     
     def default(self, o):
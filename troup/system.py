@@ -18,6 +18,7 @@ import psutil
 import os
 import platform
 import re
+from time import time
 
 from troup.threading import IntervalTimer
 
@@ -47,6 +48,7 @@ class SystemStats:
             * "ioload" (number): Normalized Input/Output load of the system - a number
                 between 0.0 and 1.0. This is the average value for the disk usage in a 
                 previous time interval.
+        measured_at (int): Time of the measurement, in milliseconds since the epoch.
     """
 
     def __init__(self):
@@ -54,6 +56,7 @@ class SystemStats:
         self.memory = {'total': 0, 'used': 0, 'available': 0}
         self.system = {'load': [0.0, 0.0, 0.0], 'name': '', 'platform': ''}
         self.disk = {'ioload': 0.0}
+        self.measured_at = 0
                 
 
 class StatsTracker:
@@ -72,6 +75,8 @@ class StatsTracker:
     def refresh_values(self):
         cpu_usage = psutil.cpu_percent(percpu=True)
         self.cpu_usage = [usage/100 for usage in cpu_usage]
+        if self.cpu_usage:
+            self.cpu_usage_avg = sum(self.cpu_usage)/len(self.cpu_usage)
     
     def get_stats(self):
         stats = SystemStats()
@@ -80,6 +85,7 @@ class StatsTracker:
         stats.memory = self._get_mem_stats_()
         stats.system = self._get_system_stats_()
         stats.disk = self._get_disk_stats_()
+        stats.measured_at = int(time() * 1000)
         
         return stats
     
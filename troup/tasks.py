@@ -13,15 +13,17 @@
 # limitations under the License.
 
 from uuid import uuid4
-from concurrent.futures import ThreadPoolExecutor
-from threading import Thread
-from collections import deque
+from base64 import b64encode, b64decode
+from concurrent.futures import Future
 import logging
-from functools import reduce
 
-from troup.process import LocalProcess, SSHRemoteProcess
-from troup.threading import IntervalTimer
-from datetime import datetime, timedelta
+from troup.process import LocalProcess, SSHRemoteProcess, PythonProcess, CodePool, default_supervisor
+from troup.threading import ExpiryHeap, FairShareQueue, ElasticPool, IntervalTimer, call_later
+from troup.ranking import needs_row
+from threading import RLock
+from datetime import datetime
+import marshal
+import sys
 
 class TaskException(Exception):
     pass
@@ -38,16 +40,44 @@ class TaskRun:
     STOPPING = 'STOPPING'
     DONE = 'DONE'
     ERROR = 'ERROR'
+
+    STATUSES = (CREATED, RUNNING, STOPPING, DONE, ERROR)
     
-    def __init__(self, task, future=None, run_id=None):
+    def __init__(self, task, future=None, run_id=None, on_status=None):
         self.task = task
-        self.status = TaskRun.CREATED
+        self._status = TaskRun.CREATED
+        self.on_status = on_status
         self.result = None
         self.error = None
         self.future = future
         self.start_time = None
         self.ttl = task.ttl
         self.id = run_id or task.id or str(uuid4())
+        self.status_listeners = []
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        previous = self._status
+        self._status = status
+        if previous is status:
+            return
+        if self.on_status:
+            self.on_status(self, previous, status)
+        for listener in list(self.status_listeners):
+            try:
+                listener(self, previous, status)
+            except Exception:
+                logging.exception('Status listener failed for %s', self.task)
+
+    def add_status_listener(self, listener):
+        """Calls *listener* with the run, the previous and the new status
+        whenever the status of the run changes.
+        """
+        self.status_listeners.append(listener)
 
     def start(self):
         if self.status is not TaskRun.CREATED:
@@ -63,6 +93,44 @@ class TaskRun:
             self.status = TaskRun.ERROR
             self.error = e
 
+    def start_async(self, supervisor=None, code_pool=None):
+        """Starts an asynchronous task (see :meth:`Task.run_async`) without
+        blocking. Returns a future that is done once the run is over.
+        """
+        if self.status is not TaskRun.CREATED:
+            raise TaskRunException('Failed to start task: invalid Status %s' % self.status)
+        self.status = TaskRun.RUNNING
+        self.start_time = datetime.now()
+        self.future = self.future or Future()
+        try:
+            self.task.run_async(supervisor, code_pool).add_done_callback(self.__on_async_done)
+        except Exception as e:
+            logging.exception('Failed to execute task')
+            self.status = TaskRun.ERROR
+            self.error = e
+            self.future.set_result(None)
+        return self.future
+
+    def __on_async_done(self, done):
+        try:
+            done.result()
+            if self.status is TaskRun.RUNNING:
+                self.stop()
+        except Exception as e:
+            # a task that was stopped is expected to fail (killed process)
+            if self.status is TaskRun.RUNNING:
+                logging.exception('Failed to execute task')
+                self.status = TaskRun.ERROR
+                self.error = e
+        finally:
+            self.future.set_result(None)
+
+    def cancel(self):
+        """Cancels a run that has not started yet."""
+        if self.status is not TaskRun.CREATED:
+            raise TaskRunException('Failed to cancel task: invalid Status %s' % self.status)
+        self.status = TaskRun.DONE
+
     def stop(self, reason=None):
         if self.status is not TaskRun.RUNNING:
             raise TaskRunException('Failed to stop task: invalid Status %s' % self.status)
@@ -82,67 +150,298 @@ class TaskRun:
         self.task.stop(reason)
 
 
-class TasksRunner:
+class SlotScaler:
+    """Chooses how many runs of one kind may run at once, between *minimum*
+    and *maximum*.
+
+    On every check the slots should grow when runs are waiting, all the slots
+    are in use and the node has room for the next queued runs: the cpu usage
+    is below *max_cpu*, and the free cpu (bogomips) and the available memory
+    cover the ``needs`` the runs declare (see :func:`troup.ranking.needs_row`). They grow by the number of waiting
+    runs, at most doubling. The slots should shrink by *step* when the cpu
+    usage is above *max_cpu*, the available memory is below *min_memory*, or
+    more than *step* slots are idle with no runs waiting.
+
+    The slots change only after *grow_after* (or *shrink_after*) consecutive
+    checks agree, so short spikes do not make them flap.
+    """
+
+    def __init__(self, minimum, maximum, step=1, grow_after=2, shrink_after=5, max_cpu=0.9, min_memory=0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.grow_after = grow_after
+        self.shrink_after = shrink_after
+        self.max_cpu = max_cpu
+        self.min_memory = min_memory
+        self.grow_streak = 0
+        self.shrink_streak = 0
+
+    def growth(self, slots, queued):
+        """By how many slots to grow with *queued* runs waiting."""
+        return min(queued, max(self.step, slots), self.maximum - slots)
+
+    def update(self, slots, queued, active, stats=None, needs=()):
+        """Returns the new number of slots. *needs* are the needs of the next
+        queued runs (as many as :meth:`growth`).
+        """
+        want = self.__want(slots, queued, active, stats, needs)
+        self.grow_streak = self.grow_streak + 1 if want > 0 else 0
+        self.shrink_streak = self.shrink_streak + 1 if want < 0 else 0
+        if self.grow_streak >= self.grow_after:
+            self.grow_streak = 0
+            return slots + self.growth(slots, queued)
+        if self.shrink_streak >= self.shrink_after:
+            self.shrink_streak = 0
+            return max(self.minimum, slots - self.step)
+        return slots
+
+    def __want(self, slots, queued, active, stats, needs):
+        if stats is not None and (stats.cpu['usage'] > self.max_cpu or stats.memory['available'] < self.min_memory):
+            return -1 if slots > self.minimum else 0
+        if queued and active >= slots and slots < self.maximum and self.__fits(stats, needs):
+            return 1
+        if not queued and slots - active > self.step and slots > self.minimum:
+            return -1
+        return 0
+
+    def __fits(self, stats, needs):
+        if stats is None:
+            return True
+        rows = [needs_row(n) for n in needs]
+        cpu = sum(row[0] for row in rows)
+        memory = sum(row[1] for row in rows)
+        total_cpu = stats.cpu['bogomips']['total']
+        if cpu and total_cpu and total_cpu * (1 - stats.cpu['usage']) < cpu:
+            return False
+        return stats.memory['available'] - memory >= self.min_memory
+
 
-    def __init__(self, max_workers=3):
+class TasksRunner:
+    """Runs tasks and keeps their runs until their results are collected.
+
+    Runs are admitted from a :class:`troup.threading.FairShareQueue`: a run
+    waits in the queue for its *priority* class, sharing it fairly with the
+    runs of other submitters, until a slot is free. Tasks that run on a
+    thread get one of *max_workers* worker threads; asynchronous (process)
+    tasks one of *max_processes* slots (unlimited if 0 or ``None``).
+
+    With *min_workers* (or *min_processes*) set, the slots of that kind are
+    elastic: every *scale_interval* milliseconds a :class:`SlotScaler`
+    resizes them between the minimum and the maximum from the queue, the
+    slots in use, the stats returned by *system_stats* (a callable returning
+    :class:`troup.system.SystemStats`, optional) and the needs of the queued
+    tasks. *scaling* holds extra arguments for the scalers.
+
+    Code tasks run in the worker processes of *code_pool* (a
+    :class:`troup.process.CodePool` of its own by default), and take process
+    slots while they are queued or run there.
+
+    A run of a task without a *ttl* is dropped as soon as it is over. A run
+    with a positive *ttl* is kept for *ttl* milliseconds after it is over, in
+    an :class:`troup.threading.ExpiryHeap`, so dropping the runs costs one
+    timer per expiration instead of periodic scans of all runs. A negative
+    *ttl* keeps the run until it is cleared. The number of runs in each
+    status is counted as the runs change status.
+    """
+
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+    def __init__(self, max_workers=3, supervisor=None, scheduler=None, max_processes=64,
+                 priorities=('interactive', 'normal', 'batch'), weights=None,
+                 min_workers=None, min_processes=None, system_stats=None, scale_interval=1000, scaling=None,
+                 code_pool=None):
         self.tasks = {}
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
-        self.checker = IntervalTimer(1000, offset=1000, target=self._check_tasks, name='TasksRunnerMaintenanceTimer')
-        self.checker.start()
-
-    def _check_tasks(self):
-        to_remove = []
-        for id, task_run in self.tasks.items():
-            if task_run.status is TaskRun.DONE or task_run.status is TaskRun.ERROR:
-                to_remove.append(task_run)
-        for task_run in to_remove:
-            self.__remove_task(task_run)
-
-    def run(self, task):
-        if self.tasks.get(task.id):
-            raise TaskRunException('Task already running %s' % str(task))
-
-        task_run = TaskRun(task=task)
-        self.tasks[task.id] = task_run
-
-        def start_task():
+        self.code_pool = code_pool or CodePool()
+        self.supervisor = supervisor or default_supervisor()
+        self.retained = ExpiryHeap(on_expired=self.__on_expired, scheduler=scheduler)
+        self.counts = {status: 0 for status in TaskRun.STATUSES}
+        self.expired = 0
+        self.system_stats = system_stats
+        self.scalers = {}
+        if min_workers is not None and min_workers < max_workers:
+            self.scalers[TasksRunner.THREAD] = SlotScaler(min_workers, max_workers, **(scaling or {}))
+            max_workers = min_workers
+        if min_processes is not None and max_processes and min_processes < max_processes:
+            self.scalers[TasksRunner.PROCESS] = SlotScaler(min_processes, max_processes, **(scaling or {}))
+            max_processes = min_processes
+        self.workers = ElasticPool(max_workers, name='TasksRunnerWorker')
+        self.limits = {TasksRunner.THREAD: max_workers, TasksRunner.PROCESS: max_processes}
+        self.queues = {kind: FairShareQueue(classes=priorities, weights=weights) for kind in self.limits}
+        self.active = {kind: 0 for kind in self.limits}
+        self._admitted = set()
+        self._lock = RLock()
+        self.scaler_timer = None
+        if self.scalers:
+            self.scaler_timer = IntervalTimer(scale_interval, offset=scale_interval, target=self.scale,
+                                              name='TasksRunnerScaler', scheduler=scheduler)
+            self.scaler_timer.start()
+
+    def scale(self):
+        """Resizes the elastic slots once (see :class:`SlotScaler`)."""
+        try:
+            stats = self.system_stats() if self.system_stats else None
+        except Exception:
+            logging.exception('Failed to get stats for scaling')
+            stats = None
+        for kind, scaler in self.scalers.items():
+            with self._lock:
+                slots = self.limits[kind]
+                queue = self.queues[kind]
+                needs = [run.task.needs for run in queue.peek(scaler.growth(slots, len(queue)))]
+                size = scaler.update(slots, len(queue), self.active[kind], stats, needs)
+                if size == slots:
+                    continue
+                self.limits[kind] = size
+                if kind == TasksRunner.THREAD:
+                    self.workers.resize(size)
+            logging.debug('Task runner %s slots: %d -> %d', kind, slots, size)
+            self.__admit(kind)
+
+    def __track(self, run):
+        with self._lock:
+            if self.tasks.get(run.task.id):
+                raise TaskRunException('Task already running %s' % str(run.task))
+            self.tasks[run.task.id] = run
+            self.counts[run.status] += 1
+
+    def __untrack(self, run):
+        with self._lock:
+            if self.tasks.get(run.task.id) is not run:
+                return False
+            del self.tasks[run.task.id]
+            self.counts[run.status] -= 1
+            self.retained.remove(run.task.id)
+            return True
+
+    def __on_status(self, run, previous, status):
+        with self._lock:
+            if self.tasks.get(run.task.id) is run:
+                self.counts[previous] -= 1
+                self.counts[status] += 1
+
+    def __on_expired(self, task_id, run):
+        if self.__untrack(run):
+            self.expired += 1
+
+    @staticmethod
+    def __kind(task):
+        return TasksRunner.PROCESS if task.asynchronous else TasksRunner.THREAD
+
+    def run(self, task, priority=None, submitter=None):
+        """Queues a run of *task* in the *priority* class, on behalf of
+        *submitter*, and returns the run. The future of the run is done once
+        the run is over.
+        """
+        task_run = TaskRun(task=task, future=Future(), on_status=self.__on_status)
+        self.__track(task_run)
+        task_run.future.add_done_callback(lambda f: self.__on_done(task_run))
+        kind = self.__kind(task)
+        self.queues[kind].put(task_run, priority=priority, submitter=submitter)
+        self.__admit(kind)
+        return task_run
+
+    def __admit(self, kind):
+        while True:
+            with self._lock:
+                limit = self.limits[kind]
+                if limit and self.active[kind] >= limit:
+                    return
+                task_run = self.queues[kind].get()
+                if task_run is None:
+                    return
+                if task_run.status is not TaskRun.CREATED:
+                    # cancelled while queued
+                    continue
+                self.active[kind] += 1
+                self._admitted.add(task_run)
+            self.__start(kind, task_run)
+
+    def __start(self, kind, task_run):
+        try:
+            if kind == TasksRunner.PROCESS:
+                task_run.start_async(self.supervisor, self.code_pool)
+            else:
+                self.workers.submit(self.__run_on_thread, task_run)
+        except Exception as e:
+            logging.exception('Failed to schedule task run for %s', task_run.task)
+            task_run.status = TaskRun.ERROR
+            task_run.error = TaskRunException('Failed to schedule task run for %s' % str(task_run.task))
+            if not task_run.future.done():
+                task_run.future.set_result(None)
+
+    def __run_on_thread(self, task_run):
+        try:
             print('Running task [%s]' % task_run.id)
             task_run.start()
             print('Run and done - task [%s]' % task_run.id)
-
-        def on_done(*args):
-            if self.tasks.get(task.id):
-                run = self.tasks[task.id]
-                run.result = run.future.result()
-                if not run.ttl:
-                    del self.tasks[task.id]
-
-        try:
-            future = self.executor.submit(start_task)
-            task_run.future = future
-            future.add_done_callback(on_done)
-            return task_run
-        except Exception as e:
-            del self.tasks[task.id]
-            raise TaskRunException('Failed to schedule task run for %s' % str(task)) from e
+        finally:
+            task_run.future.set_result(None)
+
+    def __on_done(self, task_run):
+        kind = self.__kind(task_run.task)
+        with self._lock:
+            admitted = task_run in self._admitted
+            if admitted:
+                self._admitted.discard(task_run)
+                self.active[kind] -= 1
+        task_run.result = task_run.future.result()
+        if not task_run.ttl:
+            self.__untrack(task_run)
+        elif task_run.ttl > 0:
+            with self._lock:
+                if self.tasks.get(task_run.task.id) is task_run:
+                    self.retained.add(task_run.task.id, task_run, task_run.ttl)
+        if admitted:
+            if kind == TasksRunner.PROCESS:
+                # the runs of processes end on the loop of the supervisor,
+                # where no process can be started
+                call_later(0, self.__admit, kind)
+            else:
+                self.__admit(kind)
 
     def stop(self, task_id, wait=False, timeout=None):
         if not self.tasks.get(task_id):
             raise TaskException('No task with id %s' % task_id)
         task = self.tasks[task_id]
         try:
-            task.stop()
+            with self._lock:
+                queued = task.status is TaskRun.CREATED
+                if queued:
+                    task.cancel()
+            if queued:
+                task.future.set_result(None)
+            else:
+                task.stop()
             if wait:
                 task.future.result(timeout=timeout)
         except Exception as e:
             raise TaskException('Failed to stop task %s' % str(task)) from e
         finally:
-            if self.tasks.get(task_id):
-                del self.tasks[task_id]
+            self.__untrack(task)
+
+    def backlog(self):
+        """Queued runs per priority class and the runs admitted, by kind."""
+        with self._lock:
+            classes = {}
+            for queue in self.queues.values():
+                for name, depth in queue.depth().items():
+                    classes[name] = classes.get(name, 0) + depth
+            return {
+                'queued': sum(classes.values()),
+                'classes': classes,
+                'active': dict(self.active),
+                'limits': dict(self.limits),
+                'elastic': {kind: [scaler.minimum, scaler.maximum] for kind, scaler in self.scalers.items()}
+            }
 
     def shutdown(self):
-        self.checker.cancel()
-        self.executor.shutdown(wait=True)
+        if self.scaler_timer:
+            self.scaler_timer.cancel()
+        self.retained.clear()
+        self.workers.shutdown(wait=True)
+        self.code_pool.shutdown()
 
     def __get_task(self, task_id):
         task = self.tasks.get(task_id)
@@ -150,48 +449,63 @@ class TasksRunner:
             raise TaskException('No task with id %s' % task_id)
         return task
 
-    def __remove_task(self, task, force=False):
-        if force or not task.ttl:
-            del self.tasks[task.id]
-        elif task.ttl > 0:
-            td = datetime.now() - task.start_time
-            ttl = timedelta(microseconds=task.ttl*1000)
-            if td > ttl:
-                del self.tasks[task.id]
+    def get(self, task_id):
+        return self.tasks.get(task_id)
 
     def clear(self, task_id):
         task_run = self.__get_task(task_id)
-        if task_run is TaskRun.RUNNING:
+        if task_run.status is TaskRun.RUNNING:
             raise TaskException('Task is running')
-        self.__remove_task(task=task_run, force=True)
+        self.__untrack(task_run)
+
+    @property
+    def counters(self):
+        """Number of runs in each status, and of runs dropped after their ttl."""
+        with self._lock:
+            counters = dict(self.counts)
+            counters['total'] = len(self.tasks)
+            counters['retained'] = len(self.retained)
+            counters['expired'] = self.expired
+            counters['backlog'] = self.backlog()
+            return counters
 
     @property
     def stats(self):
         result = {
-            'total': len(self.tasks)
+            'total': len(self.tasks),
+            'running': self.counts[TaskRun.RUNNING]
         }
-        running = 0
-        for id, run in self.tasks.items():
+        for id, run in list(self.tasks.items()):
             result[id] = {
                 'id': id,
                 'status': run.status,
                 'since': run.start_time
             }
-            if run.status is TaskRun.RUNNING:
-                running += 1
-        result['running'] = running
         return result
 
 
 class Task:
-    def __init__(self, task_id=None, ttl=None):
+
+    # Asynchronous tasks are started with run_async and do not occupy a thread
+    # of the TasksRunner while they run.
+    asynchronous = False
+
+    def __init__(self, task_id=None, ttl=None, needs=None):
         self.id = task_id or str(uuid4())
         self.ttl = ttl
+        self.needs = needs or {}
         self.result = None
     
     def run(self, context=None):
         pass
 
+    def run_async(self, supervisor=None, code_pool=None):
+        """Starts an asynchronous task and returns a future that is done when
+        the task is. *supervisor* is the :class:`troup.process.ProcessSupervisor`
+        and *code_pool* the :class:`troup.process.CodePool` of the runner.
+        """
+        raise TaskException('Task %s is not asynchronous' % self)
+
     def stop(self, reason=None):
         pass
 
@@ -211,49 +525,88 @@ class Task:
 
 
 class CodeTask(Task):
-    def __init__(self, task_id, code, exec_type, ttl=None, data=None):
-        super(CodeTask, self).__init__(task_id, ttl)
+    """Runs Python code in a worker process of a :class:`troup.process.CodePool`.
+
+    *timeout* is in milliseconds. Subclasses submit the code to the pool in
+    :meth:`submit`.
+    """
+
+    asynchronous = True
+
+    def __init__(self, task_id, code, exec_type, ttl=None, data=None, timeout=None, needs=None):
+        super(CodeTask, self).__init__(task_id, ttl, needs=needs)
         self.code = code
         self.type = exec_type
         self.data = data
-        
-    def run(self, context):
-        if not context.get('locals'):
-            context['locals'] = {}
-        if not context.get('globals'):
-            context['globals'] = globals()
-    
-        return self.__exec__(context['locals'], context['globals'])
-    
-    def __exec__(self, task_globals, task_locals):
-        if not task_locals.get('result'):
-            task_locals['result'] = self.__set_result__
-        result = self.exec(task_globals, task_locals)
-        if result is not None:
-            self.result = result
-        return self.result
-    
-    def exec(self, task_globals, task_locals):
-        pass
-    
-    def __set_result__(self, result):
-        self.result = result
+        self.timeout = timeout
+        self.pool = None
+        self.future = None
 
+    def run(self, context=None):
+        pool = CodePool(size=1)
+        try:
+            return self.run_async(code_pool=pool).result()
+        finally:
+            pool.shutdown()
 
-class FunctionBytecodeTask(CodeTask):
-    
-    def __init__(self, task_id, bytecode, fn_args, fn_kwargs, data, ttl=None):
-        super(FunctionBytecodeTask, self).__init__(task_id, code=bytecode, data=data, exec_type="FunctionBytecode", ttl=ttl)
-        self.fn_args = fn_args
-        self.function = None
-        
-    def __build_function(self, fn_locals, fn_globals):
-        #FunctionType()
-        pass
+    def run_async(self, supervisor=None, code_pool=None):
+        if code_pool is None:
+            raise TaskException('No code pool to run %s' % self)
+        self.pool = code_pool
+        self.future = self.submit(code_pool)
+        self.future.add_done_callback(self.__set_result__)
+        return self.future
 
-    def exec(self, fn_locals, fn_globals):
-        #self.function = self.__build_function()
-        pass
+    def submit(self, pool):
+        raise TaskException('Cannot run code of type %s' % self.type)
+
+    def stop(self, reason=None):
+        if self.future and not self.future.done():
+            self.pool.cancel(self.future)
+
+    def __set_result__(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.result = future.result()
+
+
+class FunctionBytecodeTask(CodeTask):
+    """Calls a function shipped as its marshalled code object (see
+    :func:`function_task_data`) with *fn_args* and *fn_kwargs*.
+    """
+
+    def __init__(self, task_id, bytecode, fn_args, fn_kwargs, data, ttl=None, defaults=None, timeout=None,
+                 needs=None):
+        super(FunctionBytecodeTask, self).__init__(task_id, code=bytecode, data=data, exec_type="FunctionBytecode",
+                                                   ttl=ttl, timeout=timeout, needs=needs)
+        self.fn_args = fn_args or []
+        self.fn_kwargs = fn_kwargs or {}
+        self.defaults = defaults
+
+    def submit(self, pool):
+        return pool.submit(self.code, self.fn_args, self.fn_kwargs, defaults=self.defaults,
+                           timeout=self.timeout / 1000 if self.timeout else None)
+
+
+PYTHON_VERSION = '%d.%d' % sys.version_info[:2]
+
+
+def function_task_data(function, args=(), kwargs=None):
+    """The data of a ``function`` task message calling *function*.
+
+    Only the code of the function and its default values are sent, so it must
+    import what it uses within its body, and cannot be a closure. The node
+    must run the same Python version, as the code is marshalled.
+    """
+    code = function.__code__
+    if code.co_freevars:
+        raise TaskException('Cannot send closure %s' % function.__name__)
+    return {
+        'code': b64encode(marshal.dumps(code)).decode('ascii'),
+        'defaults': list(function.__defaults__ or []),
+        'args': list(args),
+        'kwargs': kwargs or {},
+        'python': PYTHON_VERSION
+    }
 
 
 class ProcessTaskException(TaskException):
@@ -289,55 +642,27 @@ class LocalProcessTask(Task):
 
         return process
 
+    def __PythonProcessBuilder(id, data):
+        module = data.get('module')
+        return PythonProcess(id=id, name=module or data['script'], args=data.get('args', []),
+                             cwd=data.get('directory'), module=bool(module))
+
     PROCESS_BUILDERS = {
         'LocalProcess': __LocalProcessBuilder,
-        'SSHProcess': __SSHProcessBuilder
+        'SSHProcess': __SSHProcessBuilder,
+        'PythonProcess': __PythonProcessBuilder
     }
 
+    asynchronous = True
+
     def __init__(self, process_type, process_data, task_id=None, ttl=None,
-                 consume_process_out=False, buffer_size=100000):
-        super(LocalProcessTask, self).__init__(task_id=task_id, ttl=ttl)
+                 consume_process_out=False, buffer_size=100000, needs=None):
+        super(LocalProcessTask, self).__init__(task_id=task_id, ttl=ttl, needs=needs)
         self.process = None
         self.__build_process(process_type, process_data)
-        self.buffer_size = buffer_size
+        self.buffer_size = buffer_size or 100000
         self.consume_process_out = consume_process_out
 
-        if self.consume_process_out:
-            self._setup_process_consumers()
-
-    def _setup_process_consumers(self):
-        self._out_buffer = deque(maxlen=self.buffer_size)
-        self._err_buffer = deque(maxlen=self.buffer_size)
-        self._out_consumer = Thread(target=self._consume_out, name='Consumer:OUT:%s' % self.id)
-        self._err_consumer = Thread(target=self._consume_err, name='Consumer:ERR:%s' % self.id)
-
-    def _consume_out(self):
-        try:
-            while self.process and self.process.output and not self.process.output.closed:
-                line = self.process.output.readline()
-                print('[OUT]%s' % line)
-                if not line:
-                    break
-                self._out_buffer.appendleft(line)
-        except:
-            logging.exception('Failed to read process output')
-
-    def _consume_err(self):
-        try:
-            while self.process and self.process.error and not self.process.error.closed:
-                line = self.process.error.readline()
-                print('[ERR]%s' % line)
-                if not line:
-                    break
-                self._out_buffer.appendleft(line)
-        except:
-            logging.exception('Failed to read process error')
-
-    def _run_consumers(self):
-        if self.consume_process_out:
-            self._out_consumer.start()
-            self._err_consumer.start()
-
     def __build_process(self, process_type, process_data):
         builder = LocalProcessTask.PROCESS_BUILDERS.get(process_type)
         if not builder:
@@ -348,34 +673,39 @@ class LocalProcessTask(Task):
             raise ProcessTaskException('Failed to build process of type %s' % process_type) from e
 
     def run(self, context=None):
-        print('Executing process %s' % self.process)
-        self.process.execute()
-        if self.consume_process_out:
-            self._run_consumers()
-        print('Process started. Waiting...')
-        returncode = self.process.wait()
-        print('Process ended with code %d' % returncode)
-        try:
-            if returncode:
-                msg = self._handle_error(returncode)
-            else:
+        return self.run_async().result()
+
+    def run_async(self, supervisor=None, code_pool=None):
+        """Starts the process under *supervisor* (the default supervisor if not
+        given). The output is read by the supervisor and only the last
+        *buffer_size* bytes of stdout and stderr are kept, when
+        *consume_process_out* is set.
+        """
+        done = Future()
+        buffer_size = self.buffer_size if self.consume_process_out else 0
+        process = self.process.spawn(supervisor or default_supervisor(), buffer_size=buffer_size)
+
+        def on_exit(process):
+            try:
+                if process.returncode:
+                    self._handle_error(process.returncode)
                 self.result = self._collect_result()
-                print('[[RESULT]]: ', self.result)
-        finally:
-            self.process.close_streams()
+                done.set_result(self.result)
+            except Exception as e:
+                done.set_exception(e)
+
+        process.add_done_callback(on_exit)
+        return done
 
     def _collect_result(self):
-        result = ''
-        print('Track process out -> ', self.consume_process_out)
         if self.consume_process_out:
-            result += reduce(lambda a, b: a + str(b, 'utf-8'), self._out_buffer, '')
-        return result
+            return self.process.process.output['stdout'].decode()
+        return ''
 
     def _handle_error(self, returncode):
         message = 'code: %d' % returncode
         if self.consume_process_out:
-            err_msg = reduce(lambda a, b: a + str(b, 'utf-8'), self._err_buffer, '')
-            message += err_msg
+            message += self.process.process.output['stderr'].decode()
 
         raise ProcessTaskException(message)
 
@@ -383,6 +713,90 @@ class LocalProcessTask(Task):
         self.process.kill()
 
 
+class OutputSubscription:
+    """Streams the output of a running process task to a subscriber.
+
+    The output is read from the buffer of the task (see
+    :class:`troup.process.ByteRingBuffer`) from *offset* on, in chunks of at
+    most *chunk_size* bytes, and passed to *send* as dicts with the
+    ``offset`` and the ``data`` of the chunk. Every chunk uses one credit;
+    with no credits left nothing is sent until the subscriber grants more
+    with :meth:`grant`. Nothing is buffered for the subscriber: output that
+    is overwritten in the buffer before it is sent is skipped, which the
+    subscriber sees as a gap in the offsets.
+
+    Once the process has exited and all of its output was sent, a last dict
+    with ``eof`` set and the ``returncode`` is sent (without using a
+    credit) and the subscription is closed.
+
+    All the reading and sending is done on the loop of the process
+    supervisor, where the output is written.
+    """
+
+    def __init__(self, task, send, stream='stdout', offset=0, credits=8, chunk_size=65536,
+                 subscription_id=None, on_close=None):
+        process = getattr(task.process, 'process', None)
+        if process is None or not hasattr(process, 'output'):
+            raise TaskException('Task %s has no process output to subscribe to' % task)
+        if stream not in process.output:
+            raise TaskException('No output stream %s' % stream)
+        if not process.output[stream].capacity:
+            raise TaskException('Output of task %s is not captured' % task)
+        self.id = subscription_id or str(uuid4())
+        self.task = task
+        self.process = process
+        self.buffer = process.output[stream]
+        self.stream = stream
+        self.send = send
+        self.offset = offset
+        self.credits = credits
+        self.chunk_size = chunk_size
+        self.on_close = on_close
+        self.closed = False
+
+    def start(self):
+        self.process.add_output_listener(self.__on_output)
+        self.process.add_done_callback(lambda process: self.process.call_soon(self.pump))
+        self.process.call_soon(self.pump)
+
+    def grant(self, credits):
+        def add():
+            self.credits += credits
+            self.pump()
+        self.process.call_soon(add)
+
+    def __on_output(self, stream):
+        if stream == self.stream:
+            self.pump()
+
+    def pump(self):
+        if self.closed:
+            return
+        try:
+            while self.credits > 0:
+                offset, data = self.buffer.read(self.offset, self.chunk_size)
+                if not data:
+                    break
+                self.send({'offset': offset, 'data': data, 'eof': False})
+                self.offset = offset + len(data)
+                self.credits -= 1
+            if self.process.done() and self.offset >= self.buffer.total:
+                self.close()
+                self.send({'offset': self.offset, 'data': b'', 'eof': True,
+                           'returncode': self.process.returncode})
+        except Exception:
+            logging.exception('Failed to send output of task %s', self.task)
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.process.remove_output_listener(self.__on_output)
+        if self.on_close:
+            self.on_close(self)
+
+
 def __local_process_task_from_message(msg):
     process_type = msg.headers.get('process-type')
     if not process_type:
@@ -390,13 +804,24 @@ def __local_process_task_from_message(msg):
     process_data = msg.data['process']
     task_id = msg.headers.get('task-id') or str(uuid4())
     ttl = int(msg.headers.get('ttl') or 0)
-    buffer_size = msg.headers.get('buffer-size')
+    buffer_size = int(msg.headers.get('buffer-size') or 0)
     consume_out = msg.headers.get('consume-out') or False
     return LocalProcessTask(process_type=process_type, process_data=process_data, task_id=task_id,
-                            ttl=ttl, buffer_size=buffer_size, consume_process_out=consume_out)
+                            ttl=ttl, buffer_size=buffer_size, consume_process_out=consume_out,
+                            needs=msg.data.get('needs'))
+
+def __function_task_from_message(msg):
+    data = msg.data
+    if data.get('python') != PYTHON_VERSION:
+        raise TaskException('Cannot run code of Python %s on Python %s' % (data.get('python'), PYTHON_VERSION))
+    return FunctionBytecodeTask(task_id=msg.headers.get('task-id') or str(uuid4()), bytecode=b64decode(data['code']),
+                                fn_args=data.get('args'), fn_kwargs=data.get('kwargs'), data=None,
+                                ttl=int(msg.headers.get('ttl') or 0), defaults=data.get('defaults'),
+                                timeout=int(msg.headers.get('timeout') or 0), needs=data.get('needs'))
 
 __TASK_BUILDERS = {
-    'process': __local_process_task_from_message
+    'process': __local_process_task_from_message,
+    'function': __function_task_from_message
 }
 
 
@@ -410,26 +835,27 @@ def build_task(msg):
     return builder(msg)
 
 
-def task_for_app(app, remote=False, node=None, ttl=0, consume_output=False, buffer_size=1024*1024):
-    process_type = 'SSHProcess' if remote else 'LocalProcess'
+def app_process_data(app, **extra):
+    """The data of the process that runs *app*."""
     process_data = {
         'executable': app['command']
     }
-
-    if remote:
-        process_data.update({
-            'host': node['host'],
-            'port': node['port'],
-            'ssh_user': node['ssh_user'],
-            'args': []
-        })
-
-    process_data.update(app['params'])
+    process_data.update(extra)
+    process_data.update(app.get('params') or {})
 
     if not process_data.get('args'):
         process_data['args'] = []
+    return process_data
+
+
+def task_for_app(app, remote=False, node=None, ttl=0, consume_output=False, buffer_size=1024*1024):
+    process_type = 'SSHProcess' if remote else 'LocalProcess'
+    if remote:
+        process_data = app_process_data(app, host=node['host'], port=node['port'], ssh_user=node['ssh_user'])
+    else:
+        process_data = app_process_data(app)
 
     task = LocalProcessTask(process_type=process_type, process_data=process_data, task_id=str(uuid4()), ttl=ttl,
-                            consume_process_out=consume_output, buffer_size=buffer_size)
+                            consume_process_out=consume_output, buffer_size=buffer_size, needs=app.get('needs'))
     return task
 
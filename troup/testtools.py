@@ -14,6 +14,11 @@
 
 
 import json
+import logging
+import socket
+import tempfile
+import shutil
+import time
 from functools import wraps
 
 class expect_content:
@@ -134,3 +139,85 @@ def dict_compare(given, expected):
 def load_json(file_path):
     with open(file_path) as fl:
         return json.loads(fl.read())
+
+
+def free_ports(count, host='127.0.0.1'):
+    sockets = []
+    try:
+        for i in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind((host, 0))
+            sockets.append(sock)
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+class LocalCluster:
+    """Runs *size* nodes in this process, each listening on its own loopback
+    port and having all the other nodes as neighbours.
+
+    *config* is merged into the configuration of every node; use it to set
+    shorter sync and probe intervals in tests.
+    """
+
+    def __init__(self, size, config=None, host='127.0.0.1'):
+        self.size = size
+        self.config = config or {}
+        self.host = host
+        self.nodes = []
+        self.store_paths = []
+
+    def start(self):
+        from troup.node import Node
+        from troup.infrastructure import MessageBus
+
+        ports = free_ports(self.size, self.host)
+        names = ['node-%d' % i for i in range(self.size)]
+        for i, name in enumerate(names):
+            store_path = tempfile.mkdtemp(prefix='troup-%s-' % name)
+            self.store_paths.append(store_path)
+            config = {
+                'store': {'path': store_path},
+                'server': {'hostname': self.host, 'port': ports[i]},
+                'stats': {'update_interval': 1000},
+                'neighbours': ['%s:ws://%s:%d' % (names[j], self.host, ports[j])
+                               for j in range(self.size) if j != i]
+            }
+            config.update(self.config)
+            self.nodes.append(Node(node_id=name, config=config, bus=MessageBus()))
+        for node in self.nodes:
+            node.start()
+        wait_for(lambda: all(node.aio_server.server_address for node in self.nodes))
+        return self
+
+    def stop(self):
+        for node in self.nodes:
+            try:
+                node.stop()
+            except Exception:
+                logging.exception('Failed to stop node %s', node.node_id)
+        for path in self.store_paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def __getitem__(self, index):
+        return self.nodes[index]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def wait_for(condition, timeout=10, interval=0.05):
+    """Polls *condition* until it returns a true value or *timeout* seconds
+    pass. Returns the last value returned by the condition.
+    """
+    deadline = time.time() + timeout
+    result = condition()
+    while not result and time.time() < deadline:
+        time.sleep(interval)
+        result = condition()
+    return result
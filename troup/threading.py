@@ -12,7 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from threading import Timer, Condition
+from threading import Thread, Condition, RLock, current_thread
+from queue import Queue
+from time import monotonic
+from heapq import heappush, heappop, heapify, nsmallest
+from itertools import count
+from collections import deque
+import random
+import logging
 
 
 class AtomicOperation:
@@ -58,39 +65,627 @@ def _next_id(pref):
     return '%s-%s' %(pref, _id_inc)
 
 
+class ScheduledCall:
+    """A call registered with the :class:`TimerScheduler`.
+
+    One-shot calls run once, *delay* milliseconds after being scheduled.
+    Periodic calls (with *interval* set) run every *interval* milliseconds
+    after that. With *drift_correction* the deadlines are kept on a fixed
+    grid - a late or slow tick does not push the following ones back and
+    missed ticks are skipped. *jitter* (0.0 - 1.0) randomly moves every tick
+    by up to that fraction of the interval, without accumulating. A
+    *blocking* call runs on the blocking workers of the scheduler.
+    """
+
+    def __init__(self, scheduler, delay, callback, args=None, interval=None, drift_correction=True,
+                 jitter=0.0, name=None, blocking=False):
+        self.scheduler = scheduler
+        self.blocking = blocking
+        self.callback = callback
+        self.args = args or ()
+        self.interval = interval
+        self.drift_correction = drift_correction
+        self.jitter = jitter
+        self.name = name
+        self.cancelled = False
+        self.fired = False
+        self.running = False
+        self.base = monotonic() + delay/1000
+        self.deadline = self.base
+
+    @property
+    def periodic(self):
+        return self.interval is not None
+
+    def cancel(self):
+        self.scheduler._cancel(self)
+
+    def _next_deadline(self, now):
+        interval = self.interval/1000
+        if self.drift_correction:
+            self.base += interval
+            if self.base <= now:
+                self.base += interval * ((now - self.base) // interval + 1)
+        else:
+            self.base = now + interval
+        self.deadline = self.base
+        if self.jitter:
+            self.deadline += random.uniform(-self.jitter, self.jitter) * interval
+        return self.deadline
+
+    def __repr__(self):
+        return '<ScheduledCall %s at %f>' % (self.name or self.callback, self.deadline)
+
+
+class TimerScheduler:
+    """Runs all timers of the process from a single scheduler thread.
+
+    The scheduled calls are kept in a heap ordered by deadline. The scheduler
+    thread sleeps until the earliest deadline and hands the due calls to a
+    fixed number of worker threads. The callbacks must not block: a callback
+    that holds a worker delays the other timers once all *workers* are held.
+    Calls whose callbacks may block (on the network, the disk or a
+    subprocess) are scheduled as *blocking* and run on a separate, fixed
+    pool of *blocking_workers* threads, so they only delay each other. A
+    periodic call whose previous run has not finished yet skips the tick, so
+    a periodic call never holds more than one worker.
+
+    :meth:`stats` reports the number of timers, how late the ticks were and
+    how busy the blocking workers are.
+    """
+
+    def __init__(self, workers=2, blocking_workers=4, name='TimerScheduler'):
+        self.name = name
+        self.workers = workers
+        self.blocking_workers = blocking_workers
+        self._heap = []
+        self._seq = count()
+        self._cond = Condition()
+        self._queue = Queue()
+        self._blocking_queue = Queue()
+        self._blocking_busy = 0
+        self._thread = None
+        self._cancelled = 0
+        self._periodic = 0
+        self._one_shot = 0
+        self._ticks = 0
+        self._skipped = 0
+        self._late_ticks = 0
+        self._total_lateness = 0.0
+        self._max_lateness = 0.0
+        self.late_threshold = 0.01
+        self.log = logging.getLogger(name)
+
+    def call_later(self, delay, callback, *args, name=None, blocking=False):
+        """Runs *callback* once after *delay* milliseconds."""
+        return self._schedule(ScheduledCall(self, delay, callback, args, name=name, blocking=blocking))
+
+    def call_every(self, interval, callback, *args, offset=0, drift_correction=True, jitter=0.0, name=None,
+                   blocking=False):
+        """Runs *callback* every *interval* milliseconds, first after *offset*."""
+        return self._schedule(ScheduledCall(self, offset, callback, args, interval=interval,
+                                            drift_correction=drift_correction, jitter=jitter, name=name,
+                                            blocking=blocking))
+
+    def _schedule(self, call):
+        with self._cond:
+            self._start()
+            if call.periodic:
+                self._periodic += 1
+            else:
+                self._one_shot += 1
+            heappush(self._heap, (call.deadline, next(self._seq), call))
+            self._cond.notify()
+        return call
+
+    def _cancel(self, call):
+        with self._cond:
+            if call.cancelled or call.fired:
+                return
+            call.cancelled = True
+            self._forget(call)
+            self._cancelled += 1
+            if self._cancelled > len(self._heap) / 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapify(self._heap)
+                self._cancelled = 0
+
+    def _forget(self, call):
+        if call.periodic:
+            self._periodic -= 1
+        else:
+            self._one_shot -= 1
+
+    def _start(self):
+        if self._thread:
+            return
+        self._thread = Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        for i in range(self.workers):
+            Thread(target=self._work, name='%s-worker-%d' % (self.name, i), daemon=True).start()
+        for i in range(self.blocking_workers):
+            Thread(target=self._work_blocking, name='%s-blocking-%d' % (self.name, i), daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > monotonic():
+                    self._cond.wait(self._heap[0][0] - monotonic() if self._heap else None)
+                deadline, seq, call = heappop(self._heap)
+                if call.cancelled:
+                    self._cancelled -= 1
+                    continue
+                if call.periodic:
+                    heappush(self._heap, (call._next_deadline(monotonic()), next(self._seq), call))
+                    if call.running:
+                        self._skipped += 1
+                        continue
+                else:
+                    call.fired = True
+                    self._forget(call)
+                call.running = True
+            if call.blocking:
+                self._blocking_queue.put((deadline, call))
+            else:
+                self._queue.put((deadline, call))
+
+    def _work(self):
+        while True:
+            deadline, call = self._queue.get()
+            self._record(monotonic() - deadline)
+            self._call(call)
+
+    def _work_blocking(self):
+        while True:
+            deadline, call = self._blocking_queue.get()
+            self._record(monotonic() - deadline)
+            with self._cond:
+                self._blocking_busy += 1
+            try:
+                self._call(call)
+            finally:
+                with self._cond:
+                    self._blocking_busy -= 1
+
+    def _call(self, call):
+        try:
+            call.callback(*call.args)
+        except Exception as e:
+            self.log.exception('Timer %s failed: %s', call, e)
+        finally:
+            call.running = False
+
+    def _record(self, lateness):
+        with self._cond:
+            self._ticks += 1
+            self._total_lateness += lateness
+            if lateness > self._max_lateness:
+                self._max_lateness = lateness
+            if lateness > self.late_threshold:
+                self._late_ticks += 1
+
+    def stats(self):
+        """Number of timers, tick lateness (in milliseconds) and the use of the
+        blocking workers.
+        """
+        with self._cond:
+            return {
+                'timers': self._periodic + self._one_shot,
+                'periodic': self._periodic,
+                'one_shot': self._one_shot,
+                'ticks': self._ticks,
+                'skipped_ticks': self._skipped,
+                'late_ticks': self._late_ticks,
+                'avg_lateness': (self._total_lateness / self._ticks * 1000) if self._ticks else 0.0,
+                'max_lateness': self._max_lateness * 1000,
+                'blocking_workers': self.blocking_workers,
+                'blocking_busy': self._blocking_busy,
+                'blocking_queued': self._blocking_queue.qsize()
+            }
+
+
+class LimitedExecutor:
+    """Runs jobs on a fixed pool of worker threads and limits how many jobs with
+    the same key run at the same time.
+
+    A job over the limit of its key waits in a queue for that key and is handed
+    to the workers when a running job with the same key finishes. A burst of one
+    slow kind of job occupies at most its limit of workers, and the jobs with
+    other keys keep running. *limits* maps keys to their limit; the other keys
+    are limited to *default_limit* - by default one less than the number of
+    workers, so one worker is always left for the other keys.
+
+    Jobs with different keys run concurrently, so they may finish (and start)
+    in another order than they were submitted in.
+    """
+
+    def __init__(self, workers=8, limits=None, default_limit=None, name='LimitedExecutor'):
+        self.name = name
+        self.workers = workers
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit or max(1, workers - 1)
+        self._lock = RLock()
+        self._queue = Queue()
+        self._running = {}
+        self._waiting = {}
+        self._completed = 0
+        self._threads = []
+        self._stopped = False
+        self.log = logging.getLogger(name)
+
+    def limit(self, key):
+        return self.limits.get(key, self.default_limit)
+
+    def submit(self, key, callback, *args):
+        """Runs *callback* with *args* on a worker, within the limit of *key*."""
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError('%s is shut down' % self.name)
+            self._start()
+            running = self._running.get(key, 0)
+            if running < self.limit(key):
+                self._running[key] = running + 1
+                self._queue.put((key, callback, args))
+            else:
+                waiting = self._waiting.get(key)
+                if waiting is None:
+                    waiting = self._waiting[key] = deque()
+                waiting.append((callback, args))
+
+    def shutdown(self):
+        """Stops the workers once the jobs already handed to them are done.
+        Jobs still waiting for their key are dropped.
+        """
+        with self._lock:
+            self._stopped = True
+            self._waiting = {}
+            for thread in self._threads:
+                self._queue.put(None)
+
+    def _start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name='%s-worker-%d' % (self.name, i), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            key, callback, args = job
+            try:
+                callback(*args)
+            except Exception as e:
+                self.log.exception('Job %s failed: %s', key, e)
+            finally:
+                self._finished(key)
+
+    def _finished(self, key):
+        with self._lock:
+            self._completed += 1
+            waiting = self._waiting.get(key)
+            if waiting:
+                callback, args = waiting.popleft()
+                if not waiting:
+                    del self._waiting[key]
+                self._queue.put((key, callback, args))
+            elif self._running.get(key, 0) > 1:
+                self._running[key] -= 1
+            else:
+                self._running.pop(key, None)
+
+    def stats(self):
+        """Running and waiting jobs per key and the number of completed jobs."""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'running': dict(self._running),
+                'waiting': {key: len(jobs) for key, jobs in self._waiting.items()},
+                'completed': self._completed
+            }
+
+
+class ElasticPool:
+    """A pool of worker threads that can be resized while it runs.
+
+    Growing starts new workers right away. Shrinking tells as many workers
+    to exit once they have finished the jobs handed to them before.
+    """
+
+    def __init__(self, size, name='ElasticPool'):
+        self.name = name
+        self.size = 0
+        self._queue = Queue()
+        self._lock = RLock()
+        self._threads = set()
+        self._seq = count()
+        self._stopped = False
+        self.log = logging.getLogger(name)
+        self.resize(size)
+
+    def submit(self, callback, *args):
+        if self._stopped:
+            raise RuntimeError('%s is shut down' % self.name)
+        self._queue.put((callback, args))
+
+    def resize(self, size):
+        with self._lock:
+            if self._stopped:
+                return
+            for i in range(size - self.size):
+                thread = Thread(target=self._work, name='%s-worker-%d' % (self.name, next(self._seq)),
+                                daemon=True)
+                self._threads.add(thread)
+                thread.start()
+            for i in range(self.size - size):
+                self._queue.put(None)
+            self.size = size
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._stopped = True
+            for i in range(self.size):
+                self._queue.put(None)
+            self.size = 0
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    @property
+    def threads(self):
+        with self._lock:
+            return len(self._threads)
+
+    def _work(self):
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                callback, args = job
+                try:
+                    callback(*args)
+                except Exception as e:
+                    self.log.exception('Job failed: %s', e)
+        finally:
+            with self._lock:
+                self._threads.discard(current_thread())
+
+
+class FairShareQueue:
+    """A queue of jobs in priority classes, shared fairly between submitters.
+
+    A job is always taken from the first class in *classes* that has jobs, so
+    jobs of a later class wait until the earlier classes are empty. Jobs with
+    an unknown class go to *default_class*.
+
+    Within a class the submitters take turns in proportion to their
+    *weights* (1 by default), with start-time fair queueing: a job is tagged
+    with ``start + cost / weight``, where ``start`` is the later of the
+    virtual time of the class and the tag of the previous job of the same
+    submitter, and the job with the lowest tag is taken next. A submitter
+    that queues many jobs at once only delays the jobs of the others by its
+    share.
+    """
+
+    def __init__(self, classes=('interactive', 'normal', 'batch'), default_class='normal', weights=None):
+        self.classes = list(classes)
+        self.default_class = default_class
+        self.weights = dict(weights or {})
+        self._lock = RLock()
+        self._seq = count()
+        self._heaps = {name: [] for name in self.classes}
+        self._vtime = {name: 0.0 for name in self.classes}
+        self._finish = {name: {} for name in self.classes}
+        self._queued = {}
+
+    def put(self, job, priority=None, submitter=None, cost=1):
+        priority = priority if priority in self._heaps else self.default_class
+        with self._lock:
+            finish = self._finish[priority]
+            start = max(self._vtime[priority], finish.get(submitter, 0.0))
+            tag = finish[submitter] = start + cost / self.weights.get(submitter, 1)
+            heappush(self._heaps[priority], (tag, next(self._seq), start, submitter, job))
+            self._queued[submitter] = self._queued.get(submitter, 0) + 1
+
+    def get(self):
+        """Takes the next job, or returns ``None`` if there are no jobs."""
+        with self._lock:
+            for name in self.classes:
+                heap = self._heaps[name]
+                if heap:
+                    tag, seq, start, submitter, job = heappop(heap)
+                    self._vtime[name] = start
+                    self.__dequeued(name, submitter)
+                    return job
+        return None
+
+    def __dequeued(self, name, submitter):
+        queued = self._queued[submitter] - 1
+        if queued:
+            self._queued[submitter] = queued
+        else:
+            del self._queued[submitter]
+        # the tag of an idle submitter is behind the virtual time, so it
+        # does not have to be kept
+        finish = self._finish[name]
+        if submitter not in self._queued and finish.get(submitter, 0.0) <= self._vtime[name]:
+            finish.pop(submitter, None)
+
+    def __len__(self):
+        return sum(len(heap) for heap in self._heaps.values())
+
+    def peek(self, n):
+        """The next *n* jobs (at most), in the order they would be taken."""
+        jobs = []
+        with self._lock:
+            for name in self.classes:
+                if len(jobs) >= n:
+                    break
+                jobs.extend(entry[4] for entry in nsmallest(n - len(jobs), self._heaps[name]))
+        return jobs
+
+    def depth(self):
+        """Number of jobs queued in each class."""
+        with self._lock:
+            return {name: len(heap) for name, heap in self._heaps.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self),
+                'classes': self.depth(),
+                'submitters': dict(self._queued)
+            }
+
+
+_default_scheduler = None
+_default_scheduler_lock = Condition()
+
+
+def default_scheduler():
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = TimerScheduler()
+        return _default_scheduler
+
+
 class IntervalTimer:
-    
-    def __init__(self, interval, offset=0, target=None, name=None):
+    """Calls *target* (or :meth:`run`) every *interval* milliseconds.
+
+    The first call is made *offset* milliseconds after :meth:`start`. The timer
+    is registered with the shared :class:`TimerScheduler` - no thread is
+    created per timer or per tick.
+    """
+
+    def __init__(self, interval, offset=0, target=None, name=None, drift_correction=True, jitter=0.0,
+                 scheduler=None, blocking=False):
         self.target = target
         self.timer = None
         self.running = False
         self.offset = offset
         self.interval = interval
-        self.first = True
+        self.drift_correction = drift_correction
+        self.jitter = jitter
+        self.scheduler = scheduler
+        self.blocking = blocking
         self.name = name or _next_id('IntervalTimer')
-        
+
     def start(self):
         if self.running:
             return
-        interval = self.interval
-        if self.first:
-            interval = interval + self.offset
-            self.first = False
-        self._run_()
+        self.running = True
+        scheduler = self.scheduler or default_scheduler()
+        self.timer = scheduler.call_every(self.interval, self.run, offset=self.offset,
+                                          drift_correction=self.drift_correction, jitter=self.jitter,
+                                          name=self.name, blocking=self.blocking)
 
     def cancel(self):
         if self.timer:
             self.timer.cancel()
-            self.running = False
-
-    def _run_(self):
-        self.running = True
-        self.timer = Timer(self.interval/1000, self._run_)
-        self.timer.name = self.name
-        self.timer.start()
-        self.run()
+            self.timer = None
         self.running = False
-    
+
     def run(self):
         if self.target:
-            self.target()
\ No newline at end of file
+            self.target()
+
+
+class ExpiryHeap:
+    """A keyed collection of values that expire at a deadline.
+
+    Deadlines are kept in a heap and a single one-shot timer is armed for the
+    earliest one. When it fires, *on_expired(key, value)* is called for every
+    expired entry and the timer is armed again for the next deadline. Removing
+    an entry is a dict operation; the stale heap entries are dropped lazily and
+    the heap is compacted when they outnumber the live entries.
+    """
+
+    def __init__(self, on_expired, scheduler=None):
+        self.on_expired = on_expired
+        self.scheduler = scheduler
+        self.entries = {}
+        self._heap = []
+        self._seq = count()
+        self._lock = RLock()
+        self._timer = None
+        self._timer_deadline = None
+
+    def add(self, key, value, timeout):
+        """Adds *value* under *key*, expiring after *timeout* milliseconds."""
+        self.add_at(key, value, monotonic() + timeout/1000)
+
+    def add_at(self, key, value, deadline):
+        """Adds *value* under *key*, expiring at *deadline* (a monotonic time)."""
+        with self._lock:
+            self.entries[key] = (deadline, value)
+            heappush(self._heap, (deadline, next(self._seq), key))
+            self._compact()
+            if self._timer_deadline is None or deadline < self._timer_deadline:
+                self._arm(deadline)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        return entry[1] if entry else None
+
+    def remove(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            self._compact()
+        return entry[1] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self._heap = []
+            if self._timer:
+                self._timer.cancel()
+            self._timer = self._timer_deadline = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self.entries) + 64:
+            self._heap = [(deadline, seq, key) for deadline, seq, key in self._heap
+                          if self.entries.get(key, (None,))[0] == deadline]
+            heapify(self._heap)
+
+    def _arm(self, deadline):
+        if self._timer:
+            self._timer.cancel()
+        scheduler = self.scheduler or default_scheduler()
+        self._timer_deadline = deadline
+        self._timer = scheduler.call_later(max(deadline - monotonic(), 0) * 1000, self._expire)
+
+    def _expire(self):
+        expired = []
+        with self._lock:
+            self._timer = self._timer_deadline = None
+            now = monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, seq, key = heappop(self._heap)
+                entry = self.entries.get(key)
+                if entry and entry[0] == deadline:
+                    del self.entries[key]
+                    expired.append((key, entry[1]))
+            if self._heap:
+                self._arm(self._heap[0][0])
+        for key, value in expired:
+            try:
+                self.on_expired(key, value)
+            except Exception as e:
+                logging.exception('Failed to handle expired entry %s: %s', key, e)
+
+
+def call_later(delay, callback, *args, blocking=False):
+    """Runs *callback* once, after *delay* milliseconds, on the shared scheduler."""
+    return default_scheduler().call_later(delay, callback, *args, blocking=blocking)